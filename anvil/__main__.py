@@ -149,7 +149,7 @@ def store_current_settings(c_settings):
     try:
         # Remove certain keys that just shouldn't be saved
         to_save = dict(c_settings)
-        for k in ['action', 'verbose', 'dryrun']:
+        for k in ['action', 'verbose', 'dryrun', 'background', 'watch_interval', 'watch_count', 'watch_file']:
             if k in c_settings:
                 to_save.pop(k, None)
         with sh.Rooted(True):
@@ -16,6 +16,7 @@
 
 import abc
 import copy
+import threading
 
 from anvil import cfg
 from anvil import colorizer
@@ -28,6 +29,7 @@ from anvil import phase
 from anvil import settings
 from anvil import shell as sh
 from anvil import utils
+from anvil import workers
 
 from anvil.utils import OrderedDict
 
@@ -60,6 +62,9 @@ class Action(object):
         self.keyring_encrypted = cli_opts.pop('keyring_encrypted')
         self.prompt_for_passwords = cli_opts.pop('prompt_for_passwords', False)
         self.store_passwords = cli_opts.pop('store_passwords', True)
+        # Build steps (compiles, installs, packaging) are ran in the background
+        # so that they get out of the way of anything else running
+        self.background = cli_opts.pop('background', False)
         # Stored for components to get any options
         self.cli_opts = cli_opts
 
@@ -230,6 +235,10 @@ class Action(object):
         LOG.debug("Starting environment settings:")
         utils.log_object(env.get(), logger=LOG, level=logging.DEBUG, item_max_len=64)
         sh.mkdirslist(self.phase_dir)
+        if self.background:
+            LOG.info("Running build steps in the background (with scheduling %s).",
+                     colorizer.quote(" ".join(sh.scheduling_prefix(sh.BACKGROUND_SCHEDULING))))
+            sh.set_build_scheduling(sh.BACKGROUND_SCHEDULING)
         self._establish_passwords(component_order, instances)
         self._verify_components(component_order, instances)
         self._warm_components(component_order, instances)
@@ -247,10 +256,14 @@ class Action(object):
             raise ValueError("Phase name must not be empty")
         return sh.joinpths(self.phase_dir, "%s.phases" % (phase_name))
 
-    def _run_phase(self, functors, component_order, instances, phase_name, *inv_phase_names):
+    def _run_phase(self, functors, component_order, instances, phase_name, *inv_phase_names, **kwargs):
         """
         Run a given 'functor' across all of the components, in order.
+
+        When given a 'concurrently' predicate consecutive components that it
+        is true for are ran at the same time (instead of one after another).
         """
+        concurrently = kwargs.get('concurrently')
         component_results = OrderedDict()
         if not phase_name:
             phase_recorder = phase.NullPhaseRecorder()
@@ -265,6 +278,9 @@ class Action(object):
                 else:
                     neg_phase_recs.append(phase.PhaseRecorder(self._get_phase_filename(n)))
 
+        # The recorders are not safe to use from multiple threads at once
+        record_lock = threading.RLock()
+
         def change_activate(instance, on_off):
             # Activate/deactivate them and there siblings (if any)
             instance.activated = on_off
@@ -272,33 +288,61 @@ class Action(object):
                 sibling_instance.activated = on_off
 
         def run_inverse_recorders(c_name):
-            for n in neg_phase_recs:
-                n.unmark(c_name)
-
-        # Reset all activations
-        for c in component_order:
-            change_activate(instances[c], False)
+            with record_lock:
+                for n in neg_phase_recs:
+                    n.unmark(c_name)
 
-        # Run all components which have not been ran previously (due to phase tracking)
-        for c in component_order:
+        def run_component(c):
             result = None
             instance = instances[c]
-            if c in phase_recorder:
+            with record_lock:
+                already_ran = c in phase_recorder
+            if already_ran:
                 LOG.debug("Skipping phase named %r for component %r since it already happened.", phase_name, c)
             else:
                 try:
-                    with phase_recorder.mark(c):
-                        if functors.start:
-                            functors.start(instance)
-                        if functors.run:
-                            result = functors.run(instance)
-                        if functors.end:
-                            functors.end(instance, result)
+                    if functors.start:
+                        functors.start(instance)
+                    if functors.run:
+                        result = functors.run(instance)
+                    if functors.end:
+                        functors.end(instance, result)
+                    with record_lock:
+                        with phase_recorder.mark(c):
+                            pass
                 except excp.NoTraceException:
                     pass
-            change_activate(instance, True)
+            return result
+
+        def finish_component(c, result):
+            change_activate(instances[c], True)
             component_results[c] = result
             run_inverse_recorders(c)
+
+        # Reset all activations
+        for c in component_order:
+            change_activate(instances[c], False)
+
+        # Group consecutive components that can be ran at the same time
+        groups = []
+        for c in component_order:
+            if concurrently and groups and concurrently(instances[c]) and concurrently(instances[groups[-1][-1]]):
+                groups[-1].append(c)
+            else:
+                groups.append([c])
+
+        # Run all components which have not been ran previously (due to phase tracking)
+        for group in groups:
+            if len(group) == 1:
+                finish_component(group[0], run_component(group[0]))
+                continue
+            with workers.WorkerPool(len(group), phase_name or 'phase') as pool:
+                jobs = [pool.submit(run_component, c) for c in group]
+            for (c, j) in zip(group, jobs):
+                j.wait()
+                if not j.exc_info:
+                    finish_component(c, j.result())
+            workers.wait_all(jobs)
         return component_results
 
     def run(self, persona):
@@ -18,7 +18,9 @@ from StringIO import StringIO
 
 from anvil import action
 from anvil import colorizer
+from anvil import components as comp
 from anvil import log
+from anvil import phase
 from anvil import shell as sh
 from anvil import utils
 
@@ -60,6 +62,20 @@ class InstallAction(action.Action):
                                header="Wrote to %s %s exports" % (path, len(entries)),
                                logger=LOG)
 
+    def _install_persona_packages(self, component_order, instances):
+        # Components that batch there packages with the other components
+        # (and have not been installed yet) get them installed together
+        install_recorder = phase.PhaseRecorder(self._get_phase_filename("install"))
+        batched = []
+        for c in component_order:
+            instance = instances[c]
+            if not isinstance(instance, comp.PkgInstallComponent) or c in install_recorder:
+                continue
+            if instance.get_option('package_batching') == comp.BATCH_PERSONA:
+                batched.append(instance)
+        if batched:
+            comp.install_packages(batched)
+
     def _run(self, persona, component_order, instances):
         removals = []
         self._run_phase(
@@ -118,6 +134,8 @@ class InstallAction(action.Action):
             *removals
             )
 
+        self._install_persona_packages(component_order, instances)
+
         def install_start(instance):
             subsystems = set(list(instance.subsystems))
             if subsystems:
@@ -28,6 +28,12 @@ class StartAction(action.Action):
     def lookup_name(self):
         return 'running'
 
+    def _start(self, instance):
+        started = instance.start()
+        # So that a later restart can tell if the configuration changed
+        instance.record_config_digests()
+        return started
+
     def _run(self, persona, component_order, instances):
         removals = []
         self._run_phase(
@@ -45,7 +51,7 @@ class StartAction(action.Action):
         self._run_phase(
             PhaseFunctors(
                 start=lambda i: LOG.info('Starting %s.', i.name),
-                run=lambda i: i.start(),
+                run=self._start,
                 end=lambda i, result: LOG.info("Start %s applications", colorizer.quote(result)),
             ),
             component_order,
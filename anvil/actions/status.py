@@ -14,9 +14,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import sys
+import time
+
 from anvil import action
 from anvil import colorizer
 from anvil import log
+from anvil import monitor
+from anvil import shell as sh
 from anvil import utils
 
 from anvil.action import PhaseFunctors
@@ -38,13 +43,16 @@ class StatusAction(action.Action):
     def __init__(self, name, distro, root_dir, cli_opts):
         action.Action.__init__(self, name, distro, root_dir, cli_opts)
         self.show_amount = cli_opts.get('show_amount', 0)
+        self.watch_interval = cli_opts.get('watch_interval', 0)
+        self.watch_count = cli_opts.get('watch_count', 0)
+        self.watch_file = cli_opts.get('watch_file')
 
     @property
     def lookup_name(self):
         return 'running'
 
     def _fetch_status(self, component):
-        return component.status()
+        return component.status(details_max=self.show_amount)
 
     def _quote_status(self, status):
         return colorizer.quote(status, quote_color=STATUS_COLOR_MAP.get(status, 'red'))
@@ -77,7 +85,62 @@ class StatusAction(action.Action):
                 if self.show_amount > 0 and s.details:
                     details_printer(s, 4, self.show_amount)
 
+    def _watch_targets(self, component_order, instances, snapshot):
+        targets = []
+        for c in component_order:
+            for (app_name, pid) in instances[c].app_pids(snapshot=snapshot):
+                targets.append((c, app_name, pid))
+        return targets
+
+    def _show_samples(self, samples):
+        lines = monitor.format_table(samples)
+        if sys.stdout.isatty():
+            # Redrawn in place (instead of scrolling)
+            sys.stdout.write("\033[H\033[J")
+        sys.stdout.write("%s\n" % (utils.iso8601()))
+        sys.stdout.write("\n".join(lines))
+        sys.stdout.write("\n\n")
+        sys.stdout.flush()
+
+    def _watch(self, component_order, instances):
+        LOG.info("Sampling the programs of %s components every %s seconds.",
+                 len(component_order), self.watch_interval)
+        writer = None
+        if self.watch_file:
+            LOG.info("Appending samples to %s.", colorizer.quote(self.watch_file))
+            writer = monitor.make_writer(self.watch_file)
+        sampler = monitor.Sampler()
+        taken = 0
+        try:
+            while not self.watch_count or taken < self.watch_count:
+                started = time.time()
+                # Looked up each time since programs may have been restarted,
+                # as root since the programs that run as root can not be
+                # looked into otherwise (given up again before the samples
+                # are written so that the file stays the users)
+                with sh.Rooted(True):
+                    # One scan of the process table (per sample) is used
+                    # to find the programs and then to sample them
+                    snapshot = sampler.snapshot()
+                    targets = self._watch_targets(component_order, instances, snapshot)
+                    samples = sampler.sample(targets, snapshot=snapshot)
+                self._show_samples(samples)
+                if writer:
+                    writer.write(samples)
+                taken += 1
+                if self.watch_count and taken >= self.watch_count:
+                    break
+                time.sleep(max(0, self.watch_interval - (time.time() - started)))
+        except KeyboardInterrupt:
+            LOG.info("Stopped sampling after %s samples.", taken)
+        finally:
+            if writer:
+                writer.close()
+
     def _run(self, persona, component_order, instances):
+        if self.watch_interval > 0:
+            self._watch(component_order, instances)
+            return
         self._run_phase(
             PhaseFunctors(
                 start=None,
@@ -16,6 +16,7 @@
 
 from anvil import action
 from anvil import colorizer
+from anvil import components as comp
 from anvil import log
 
 from anvil.action import PhaseFunctors
@@ -44,5 +45,7 @@ class StopAction(action.Action):
             component_order,
             instances,
             "stopped",
-            *removals
+            *removals,
+            # Forked programs do not depend on each other being stopped first
+            concurrently=lambda i: isinstance(i, comp.PythonRuntime)
             )
@@ -0,0 +1,299 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from anvil import colorizer
+from anvil import log as logging
+from anvil import shell as sh
+
+LOG = logging.getLogger(__name__)
+
+# Where things are placed under the cache directory
+BLOB_DIR = 'blobs'
+EXTRAS_DIR = 'extras'
+TMP_DIR = 'tmp'
+INDEX_FN = 'index.json'
+LOCK_FN = '.lock'
+
+# How much is read at once when hashing
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path, hash_algo='sha1'):
+    hasher = hashlib.new(hash_algo)
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(CHUNK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def _dir_size(path):
+    size = 0
+    for (root, _dirs, files) in os.walk(path):
+        for fn in files:
+            try:
+                size += os.lstat(os.path.join(root, fn)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class ArtifactCache(object):
+    """
+    Stores downloaded artifacts by there content hash.
+
+    Urls map to content hashes in an index (so the same content fetched
+    from different urls is only stored once) and each stored blob may have
+    an 'extras' directory of things derived from it (unpacked images for
+    example). When a maximum size is given the least recently used blobs
+    (and there extras) are evicted to stay under that size, except for the
+    ones that are pinned (being used) by this process.
+    """
+
+    def __init__(self, cache_dir, max_size=0, hash_algo='sha1'):
+        self.cache_dir = cache_dir
+        self.max_size = max(0, int(max_size or 0))
+        self.hash_algo = hash_algo
+        # Digest -> how many users of it there are (in this process)
+        self._pins = {}
+        # Digest -> lock that is held while its extras are made (or checked)
+        self._extras_locks = {}
+        self._lock = threading.Lock()
+
+    def _pin(self, digest):
+        with self._lock:
+            self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def unpin(self, digest):
+        # Call this when done with a blob (and its extras) that was pinned
+        with self._lock:
+            count = self._pins.get(digest, 0) - 1
+            if count > 0:
+                self._pins[digest] = count
+            else:
+                self._pins.pop(digest, None)
+
+    def _pinned(self):
+        with self._lock:
+            return set(self._pins.keys())
+
+    @contextlib.contextmanager
+    def extras_locked(self, digest):
+        # Only one thread (of this process) at a time makes or looks at the
+        # extras of a digest (urls with the same content share them)
+        with self._lock:
+            lock = self._extras_locks.setdefault(digest, threading.Lock())
+        with lock:
+            yield self.extras_path(digest)
+
+    def _path(self, *pieces):
+        return sh.joinpths(self.cache_dir, *pieces)
+
+    def blob_path(self, digest):
+        return self._path(BLOB_DIR, digest)
+
+    def extras_path(self, digest):
+        return self._path(EXTRAS_DIR, digest)
+
+    def _ensure_dirs(self):
+        for d in [BLOB_DIR, EXTRAS_DIR, TMP_DIR]:
+            path = self._path(d)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Serializes index (and blob) changes across processes
+        self._ensure_dirs()
+        with open(self._path(LOCK_FN), 'a') as lock_fh:
+            fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX)
+            try:
+                yield self._read_index()
+            finally:
+                fcntl.flock(lock_fh.fileno(), fcntl.LOCK_UN)
+
+    def _read_index(self):
+        index = {}
+        try:
+            with open(self._path(INDEX_FN), 'rb') as fh:
+                index = json.loads(fh.read())
+        except (IOError, ValueError):
+            pass
+        if not isinstance(index, dict):
+            index = {}
+        index.setdefault('urls', {})
+        index.setdefault('blobs', {})
+        return index
+
+    def _write_index(self, index):
+        # Written to the side and then renamed so readers never see half an index
+        (fd, tmp_fn) = tempfile.mkstemp(dir=self._path(TMP_DIR), suffix='.index')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(json.dumps(index, indent=4, sort_keys=True))
+        os.rename(tmp_fn, self._path(INDEX_FN))
+
+    def _entry_size(self, digest):
+        size = 0
+        try:
+            size += os.lstat(self.blob_path(digest)).st_size
+        except OSError:
+            pass
+        return size + _dir_size(self.extras_path(digest))
+
+    def _remove(self, index, digest):
+        index['blobs'].pop(digest, None)
+        for (url, details) in index['urls'].items():
+            if details.get('digest') == digest:
+                index['urls'].pop(url)
+        try:
+            os.unlink(self.blob_path(digest))
+        except OSError:
+            pass
+        shutil.rmtree(self.extras_path(digest), ignore_errors=True)
+
+    def _evict(self, index, protect=None):
+        if not self.max_size:
+            return []
+        protect = set(protect or []) | self._pinned()
+        total = sum([b.get('size', 0) for b in index['blobs'].values()])
+        # Oldest used first...
+        candidates = sorted(index['blobs'].items(), key=lambda e: e[1].get('used', 0))
+        evicted = []
+        for (digest, details) in candidates:
+            if total <= self.max_size:
+                break
+            if digest in protect:
+                continue
+            LOG.info("Evicting cached artifact %s (%s bytes) to stay under %s bytes.",
+                     colorizer.quote(details.get('name') or digest), details.get('size', 0), self.max_size)
+            self._remove(index, digest)
+            total -= details.get('size', 0)
+            evicted.append(digest)
+        return evicted
+
+    def get(self, url, stamp=None, pin=False):
+        # Returns the (digest, path) of the blob for the given url if we have
+        # it (and its stamp matches, when provided) or (None, None) if not,
+        # when asked to the blob is pinned (until unpinned) when found.
+        with self._locked() as index:
+            details = index['urls'].get(url)
+            if not details:
+                return (None, None)
+            digest = details.get('digest')
+            if stamp is not None and details.get('stamp') != stamp:
+                return (None, None)
+            if digest not in index['blobs'] or not os.path.isfile(self.blob_path(digest)):
+                index['urls'].pop(url)
+                index['blobs'].pop(digest, None)
+                self._write_index(index)
+                return (None, None)
+            index['blobs'][digest]['used'] = time.time()
+            self._write_index(index)
+            if pin:
+                self._pin(digest)
+            return (digest, self.blob_path(digest))
+
+    def add(self, url, path, name=None, stamp=None, move=False, pin=False):
+        # Places the file at path into the cache (by its content hash) and
+        # associates the url to that content, returns the (digest, path) of
+        # the blob that was stored (or already existed).
+        #
+        # Files the cache does not own (move=False) are copied in, linking
+        # to them would let later changes to them change the blob under its
+        # old digest...
+        if move:
+            return self._add(url, path, name=name, stamp=stamp, pin=pin)
+        self._ensure_dirs()
+        tmp_dir = tempfile.mkdtemp(dir=self._path(TMP_DIR))
+        try:
+            tmp_fn = sh.joinpths(tmp_dir, sh.basename(path))
+            sh.copy_sparse(path, tmp_fn)
+            return self._add(url, tmp_fn, name=name, stamp=stamp, pin=pin)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _add(self, url, path, name=None, stamp=None, pin=False):
+        # The file at path is owned by the cache and is moved into it
+        digest = hash_file(path, self.hash_algo)
+        blob_path = self.blob_path(digest)
+        with self._locked() as index:
+            if not os.path.isfile(blob_path):
+                os.rename(path, blob_path)
+            else:
+                os.unlink(path)
+            index['urls'][url] = {
+                'digest': digest,
+                'stamp': stamp,
+            }
+            blob = index['blobs'].setdefault(digest, {})
+            blob['name'] = name or blob.get('name') or sh.basename(url)
+            blob['used'] = time.time()
+            blob['size'] = self._entry_size(digest)
+            if pin:
+                self._pin(digest)
+            self._evict(index, protect=[digest])
+            self._write_index(index)
+        return (digest, blob_path)
+
+    def fetch(self, url, fetcher, name=None, pin=False):
+        # Gets the blob for the url from the cache or calls the fetcher to
+        # download it into a temporary file (which is then added)
+        (digest, path) = self.get(url, pin=pin)
+        if digest:
+            LOG.info("Found cached artifact for %s at %s.", colorizer.quote(url), colorizer.quote(path))
+            return (digest, path)
+        self._ensure_dirs()
+        tmp_dir = tempfile.mkdtemp(dir=self._path(TMP_DIR))
+        try:
+            tmp_fn = sh.joinpths(tmp_dir, name or 'artifact')
+            fetcher(tmp_fn)
+            return self.add(url, tmp_fn, name=name, move=True, pin=pin)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def refresh(self, digest):
+        # Call this after changing a blobs extras so that its size is accounted for
+        with self._locked() as index:
+            if digest not in index['blobs']:
+                return
+            index['blobs'][digest]['size'] = self._entry_size(digest)
+            index['blobs'][digest]['used'] = time.time()
+            self._evict(index, protect=[digest])
+            self._write_index(index)
+
+    def evict(self):
+        with self._locked() as index:
+            evicted = self._evict(index)
+            if evicted:
+                self._write_index(index)
+            return evicted
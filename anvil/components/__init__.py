@@ -31,6 +31,8 @@
 #    under the License.
 
 import functools
+import hashlib
+import json
 import os
 import re
 import weakref
@@ -45,9 +47,11 @@ from anvil import importer
 from anvil import log as logging
 from anvil import packager
 from anvil import patcher
+from anvil import probes
 from anvil import shell as sh
 from anvil import trace as tr
 from anvil import utils
+from anvil import workers
 
 from anvil.packaging import pip
 
@@ -63,6 +67,31 @@ STATUS_STARTED = "started"
 STATUS_STOPPED = "stopped"
 STATUS_UNKNOWN = "unknown"
 
+# How long (in seconds) programs have to become active (unless a component
+# has its own 'start_timeout' option)
+START_TIMEOUT = 60
+
+# How many programs (of a component) may be started at the same time (unless
+# a component has its own 'start_workers' option)
+START_WORKERS = 8
+
+# How much (at most) of the end of a programs output is used as its status
+# details (unless asked for a different amount)
+STATUS_DETAILS_MAX = 64 * 1024
+
+# How distribution packages are installed, one at a time, together per
+# component or together for all components (of a persona) being installed
+BATCH_NONE = 'none'
+BATCH_COMPONENT = 'component'
+BATCH_PERSONA = 'persona'
+
+# Options that control how started programs are scheduled
+SCHEDULING_OPTIONS = ['nice', 'ionice_class', 'ionice_level', 'cpu_affinity']
+
+# Where (in the trace directory) the digests of the configuration that
+# programs were last started with are kept
+CONFIG_DIGESTS_FN = 'config-digests.json'
+
 
 class ProgramStatus(object):
     def __init__(self, status, name=None, details=''):
@@ -102,6 +131,68 @@ def filter_package(pkg):
             n_pkg[k] = v
     return n_pkg
 
+
+def group_packages(pkgs, distro):
+    # Groups packages by the packager that installs them (keeping the order
+    # the packages and packagers were first seen in)
+    groups = []
+    for p in pkgs:
+        installer = make_packager(p, distro.package_manager_class, distro=distro)
+        for (group_installer, group) in groups:
+            if group_installer is installer:
+                group.append(p)
+                break
+        else:
+            groups.append((installer, [p]))
+    return groups
+
+
+def install_packages(components):
+    # Installs the packages of many components together (in as few package
+    # manager transactions as possible), the components will then find
+    # there packages already installed when they are installed (and so
+    # still record them as usual)
+    pkgs = []
+    seen = set()
+    distro = None
+    for c in components:
+        for p in c.packages:
+            # Components commonly share packages, only ask for them once
+            key = (p['name'], p.get('version'))
+            if key not in seen:
+                seen.add(key)
+                pkgs.append(p)
+        distro = c.distro
+    if not pkgs:
+        return 0
+    utils.log_iterable([p['name'] for p in pkgs], logger=LOG,
+                       header="Installing %s distribution packages of %s components together"
+                              % (len(pkgs), len(components)))
+    for (installer, group) in group_packages(pkgs, distro):
+        installer.install_batch(group)
+    return len(pkgs)
+
+
+def _digest_files(paths):
+    # Combines what links point at and the contents of files (missing ones
+    # included) into one digest
+    hasher = hashlib.sha1()
+    for path in sorted(paths):
+        hasher.update("%s\0" % (path))
+        if sh.islink(path):
+            hasher.update("-> %s\0" % (os.readlink(path)))
+        try:
+            with open(path, 'rb') as fh:
+                while True:
+                    data = fh.read(64 * 1024)
+                    if not data:
+                        break
+                    hasher.update(data)
+        except IOError:
+            hasher.update("(missing)")
+        hasher.update("\0")
+    return hasher.hexdigest()
+
 ####
 #### INSTALL CLASSES
 ####
@@ -171,14 +262,26 @@ class PkgInstallComponent(component.Component):
             pkg_names = [p['name'] for p in pkgs]
             utils.log_iterable(pkg_names, logger=LOG,
                                header="Setting up %s distribution packages" % (len(pkg_names)))
+            batching = self.get_option('package_batching', default_value=BATCH_COMPONENT)
             with utils.progress_bar('Installing', len(pkgs)) as p_bar:
-                for (i, p) in enumerate(pkgs):
-                    installer = make_packager(p, self.distro.package_manager_class,
-                                              distro=self.distro)
-                    installer.install(p)
-                    # Mark that this happened so that we can uninstall it
-                    self.tracewriter.package_installed(filter_package(p))
-                    p_bar.update(i + 1)
+                if batching == BATCH_NONE:
+                    # One at a time (in the order they are listed in)
+                    for (i, p) in enumerate(pkgs):
+                        installer = make_packager(p, self.distro.package_manager_class,
+                                                  distro=self.distro)
+                        installer.install(p)
+                        # Mark that this happened so that we can uninstall it
+                        self.tracewriter.package_installed(filter_package(p))
+                        p_bar.update(i + 1)
+                else:
+                    installed_am = 0
+                    for (installer, group) in group_packages(pkgs, self.distro):
+                        installer.install_batch(group)
+                        for p in group:
+                            # Mark that this happened so that we can uninstall it
+                            self.tracewriter.package_installed(filter_package(p))
+                        installed_am += len(group)
+                        p_bar.update(installed_am)
 
     def pre_install(self):
         pkgs = self.packages
@@ -502,7 +605,8 @@ class PythonInstallComponent(PkgInstallComponent):
                 sh.execute(*setup_cmd, cwd=working_dir, run_as_root=True,
                            stderr_fn='%s.stderr' % (setup_fn),
                            stdout_fn='%s.stdout' % (setup_fn),
-                           tracewriter=self.tracewriter)
+                           tracewriter=self.tracewriter,
+                           scheduling=sh.get_build_scheduling())
                 self.tracewriter.py_installed(name, working_dir)
 
     def _python_install(self):
@@ -565,16 +669,113 @@ class ProgramRuntime(component.Component):
             mp['APP_NAME'] = app_name
         return mp
 
+    def app_scheduling(self, app_name):
+        # How the app should be scheduled (its nice value, io scheduling
+        # class and level and cpus), options of the app (in 'app_scheduling')
+        # override those of the component
+        scheduling = {}
+        for k in SCHEDULING_OPTIONS:
+            v = self.get_option(k)
+            if v is not None:
+                scheduling[k] = v
+        app_scheduling = self.get_option('app_scheduling') or {}
+        scheduling.update(app_scheduling.get(app_name) or {})
+        try:
+            sh.scheduling_prefix(scheduling)
+        except ValueError as e:
+            raise excp.ConfigException("Invalid scheduling for %r: %s" % (app_name, e))
+        return scheduling
+
     def restart(self):
         return 0
 
+    def restart_apps(self, app_names):
+        # Programs can not be restarted individually by default so the whole
+        # component is restarted
+        return self.restart()
+
+    def config_inputs(self, app_name=None):
+        # Rendered configuration files (and links to them) that the given app
+        # (or any app, when not given one) uses, as placed by the installer
+        installer = self.siblings.get('install')
+        if installer is None or not hasattr(installer, 'config_files'):
+            return []
+        inputs = set()
+        for fn in installer.config_files:
+            inputs.add(installer.target_config(fn))
+        for links in installer.symlinks.values():
+            inputs.update(links)
+        return sorted(inputs)
+
+    def _config_app_names(self):
+        app_names = [app_info['name'] for app_info in self.apps_to_start]
+        if not app_names:
+            app_names = [self.name]
+        return app_names
+
+    def config_digests(self):
+        digests = {}
+        for app_name in self._config_app_names():
+            inputs = self.config_inputs(app_name)
+            if inputs:
+                digests[app_name] = _digest_files(inputs)
+        return digests
+
+    def _config_digests_fn(self):
+        return sh.joinpths(self.get_option('trace_dir'), CONFIG_DIGESTS_FN)
+
+    def record_config_digests(self):
+        digests = self.config_digests()
+        if digests:
+            sh.mkdirslist(self.get_option('trace_dir'))
+            sh.write_file(self._config_digests_fn(), json.dumps(digests, indent=4, sort_keys=True), quiet=True)
+        return digests
+
+    def recorded_config_digests(self):
+        try:
+            digests = json.loads(sh.load_file(self._config_digests_fn()))
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(digests, dict):
+            return None
+        return digests
+
+    def changed_config_apps(self):
+        # Apps whose configuration differs from what they were started with,
+        # when that is not known all of them are assumed to have changed
+        recorded = self.recorded_config_digests()
+        current = self.config_digests()
+        if recorded is None:
+            return sorted(current.keys())
+        changed = []
+        for (app_name, digest) in current.items():
+            if recorded.get(app_name) != digest:
+                changed.append(app_name)
+        return sorted(changed)
+
+    def restart_changed(self):
+        changed = self.changed_config_apps()
+        if not changed:
+            LOG.info("No configuration of %s has changed since it was started.", colorizer.quote(self.name))
+            return 0
+        utils.log_iterable(changed, logger=LOG,
+                           header="Restarting %s programs of %s whose configuration changed" % (len(changed), self.name))
+        restarted = self.restart_apps(changed)
+        self.record_config_digests()
+        return restarted
+
     def post_start(self):
         pass
 
     def pre_start(self):
         pass
 
-    def status(self):
+    def status(self, details_max=STATUS_DETAILS_MAX):
+        return []
+
+    def app_pids(self, snapshot=None):
+        # The (app name, process id) of each started program (when known),
+        # checked against the given process table snapshot (if any)
         return []
 
     def start(self):
@@ -583,31 +784,37 @@ class ProgramRuntime(component.Component):
     def stop(self):
         return 0
 
-    def wait_active(self, between_wait=1, max_attempts=5):
+    @property
+    def readiness_probes(self):
+        # Probes that must pass (after the programs have started) before
+        # the programs are considered ready to be used
+        return []
+
+    def _programs_started(self, num_started):
+        statii = self.status(details_max=0)
+        if len(statii) != num_started:
+            return (False, "only %s of %s programs found" % (len(statii), num_started))
+        not_worked = [p_status.name for p_status in statii if p_status.status != STATUS_STARTED]
+        if not_worked:
+            return (False, "programs %s not started" % (", ".join([str(n) for n in not_worked])))
+        return (True, None)
+
+    def wait_active(self, timeout=None):
         rt_name = self.name
         num_started = len(self.apps_to_start)
         if not num_started:
             raise excp.StartException("No %r programs started, can not wait for them to become active..." % (rt_name))
-
-        def waiter(try_num):
-            LOG.info("Waiting %s seconds for component %s programs to start.", between_wait, colorizer.quote(rt_name))
-            LOG.info("Please wait...")
-            sh.sleep(between_wait)
-
-        for i in range(0, max_attempts):
-            statii = self.status()
-            if len(statii) == num_started:
-                not_worked = []
-                for p_status in statii:
-                    if p_status.status != STATUS_STARTED:
-                        not_worked.append(p_status)
-                if len(not_worked) == 0:
-                    return
-            waiter(i + 1)
-
-        tot_time = max(0, between_wait * max_attempts)
-        raise excp.StartException("Failed waiting %s seconds for component %r programs to become active..."
-                                  % (tot_time, rt_name))
+        if timeout is None:
+            timeout = self.get_int_option('start_timeout', default_value=START_TIMEOUT)
+        to_wait = [probes.CallableProbe("%s programs" % (rt_name),
+                                        functools.partial(self._programs_started, num_started))]
+        to_wait.extend(self.readiness_probes)
+        LOG.info("Waiting up to %s seconds for component %s programs to become active.", timeout, colorizer.quote(rt_name))
+        failures = probes.wait_for(to_wait, timeout)
+        if failures:
+            reasons = ["%s (%s)" % (probe.name, reason) for (probe, reason) in failures]
+            raise excp.StartException("Failed waiting %s seconds for component %r programs to become active: %s"
+                                      % (timeout, rt_name, ", ".join(reasons)))
 
 
 class EmptyRuntime(ProgramRuntime):
@@ -620,19 +827,71 @@ class PythonRuntime(ProgramRuntime):
         trace_fn = tr.trace_filename(self.get_option('trace_dir'), 'start')
         self.tracewriter = tr.TraceWriter(trace_fn, break_if_there=True)
         self.tracereader = tr.TraceReader(trace_fn)
+        # The readiness probes of the apps (made before they were started)
+        self._ready_probes = {}
+
+    def _start_groups(self):
+        # Apps are started in groups (lowest 'start_group' first) where the
+        # apps in a group are started at the same time
+        groups = {}
+        for app_info in self.apps_to_start:
+            groups.setdefault(int(app_info.get('start_group', 0)), []).append(app_info)
+        return [groups[k] for k in sorted(groups.keys())]
 
     def start(self):
         # Select how we are going to start it
         run_type = self.get_option("run_type", default_value='anvil.runners.fork:ForkRunner')
         starter = importer.construct_entry_point(run_type, self)
+        max_workers = self.get_int_option('start_workers', default_value=START_WORKERS)
+        groups = self._start_groups()
         am_started = 0
-        for app_info in self.apps_to_start:
-            self._start_app(app_info, run_type, starter)
-            self._post_app_start(app_info)
-            am_started += 1
+        # The runners switch to root only for what needs it (forking for
+        # example) so that what is traced here stays the users
+        for (i, group) in enumerate(groups):
+            group_probes = self._make_ready_probes(group)
+            self._start_group(group, run_type, starter, max_workers)
+            am_started += len(group)
+            if i + 1 < len(groups):
+                self._wait_group_ready(group, group_probes)
         return am_started
 
-    def _start_app(self, app_info, run_type, starter):
+    def _start_group(self, group, run_type, starter, max_workers):
+        jobs = []
+        with workers.WorkerPool(min(max_workers, len(group)), 'start-%s' % (self.name)) as pool:
+            for app_info in group:
+                jobs.append(pool.submit(self._start_app, app_info, starter))
+        for j in jobs:
+            j.wait()
+        # Traced from this thread (and in a consistent order) so that what
+        # did start (even if others failed) can always be stopped
+        for (app_info, j) in zip(group, jobs):
+            if not j.exc_info:
+                self.tracewriter.app_started(app_info['name'], j.result(), run_type)
+        workers.wait_all(jobs)
+
+    def _make_ready_probes(self, app_infos):
+        # Made before the apps are (re)started so that what they output
+        # before that (in a previous run) is not mistaken for them being ready
+        made_probes = []
+        for app_info in app_infos:
+            app_probes = self.app_probes(app_info['name'])
+            self._ready_probes[app_info['name']] = app_probes
+            made_probes.extend(app_probes)
+        return made_probes
+
+    def _wait_group_ready(self, group, group_probes):
+        if not group_probes:
+            return
+        timeout = self.get_int_option('start_timeout', default_value=START_TIMEOUT)
+        LOG.info("Waiting up to %s seconds for %s to become ready.",
+                 timeout, ", ".join([colorizer.quote(a['name']) for a in group]))
+        failures = probes.wait_for(group_probes, timeout)
+        if failures:
+            reasons = ["%s (%s)" % (probe.name, reason) for (probe, reason) in failures]
+            raise excp.StartException("Failed waiting %s seconds for component %r programs to become ready: %s"
+                                      % (timeout, self.name, ", ".join(reasons)))
+
+    def _start_app(self, app_info, starter):
         app_name = app_info["name"]
         app_pth = app_info.get("path", app_name)
         app_dir = app_info.get("app_dir", self.get_option('app_dir'))
@@ -642,14 +901,39 @@ class PythonRuntime(ProgramRuntime):
         LOG.debug("Starting %r using %r", app_name, starter)
         details_fn = starter.start(app_name, app_pth=app_pth, app_dir=app_dir, opts=program_opts)
         LOG.info("Started sub-program %s.", colorizer.quote(app_name))
-        # This trace is used to locate details about what/how to stop
-        self.tracewriter.app_started(app_name, details_fn, run_type)
+        # This is traced and used to locate details about what/how to stop
+        return details_fn
+
+    def app_probes(self, app_name):
+        # Any log lines (regexes) listed for the app in the 'ready_logs'
+        # option must show up in its output before it is considered ready
+        pattern = (self.get_option('ready_logs') or {}).get(app_name)
+        if not pattern:
+            return []
+        run_type = self.get_option("run_type", default_value='anvil.runners.fork:ForkRunner')
+        runner = importer.construct_entry_point(run_type, self)
+        log_files = runner.log_files(app_name)
+        if not log_files:
+            LOG.warn("Can not look for %s in the output of %s, no output files are known.",
+                     colorizer.quote(pattern), colorizer.quote(app_name))
+            return []
+        return [probes.LogProbe(log_files, pattern)]
 
-    def _post_app_start(self, app_info):
-        if 'sleep_time' in app_info:
-            LOG.info("%s requested a %s second sleep time, please wait...",
-                     colorizer.quote(app_info.get('name')), app_info.get('sleep_time'))
-            sh.sleep(int(app_info.get('sleep_time')))
+    @property
+    def readiness_probes(self):
+        ready_probes = []
+        for app_info in self.apps_to_start:
+            app_name = app_info['name']
+            if app_name not in self._ready_probes:
+                # Not (re)started by this run so what the app already
+                # output is all there is to look at
+                app_probes = self.app_probes(app_name)
+                for probe in app_probes:
+                    if isinstance(probe, probes.LogProbe):
+                        probe.rewind()
+                self._ready_probes[app_name] = app_probes
+            ready_probes.extend(self._ready_probes[app_name])
+        return ready_probes
 
     def _locate_investigators(self, apps_started):
         investigator_created = {}
@@ -667,6 +951,48 @@ class PythonRuntime(ProgramRuntime):
             to_investigate.append((app_name, investigator))
         return to_investigate
 
+    def restart(self):
+        return self.restart_apps([app_info['name'] for app_info in self.apps_to_start])
+
+    def restart_apps(self, app_names):
+        # Only programs that are running (and still wanted) are restarted
+        apps_started = []
+        try:
+            apps_started = self.tracereader.apps_started()
+        except excp.NoTraceException:
+            pass
+        app_infos = dict((app_info['name'], app_info) for app_info in self.apps_to_start)
+        to_restart = []
+        for (app_name, handler) in self._locate_investigators(apps_started):
+            if app_name in app_names and app_name in app_infos:
+                to_restart.append((app_infos[app_name], handler))
+        if not to_restart:
+            return 0
+        max_workers = self.get_int_option('start_workers', default_value=START_WORKERS)
+        restart_probes = self._make_ready_probes([app_info for (app_info, _handler) in to_restart])
+        jobs = []
+        with workers.WorkerPool(min(max_workers, len(to_restart)), 'restart-%s' % (self.name)) as pool:
+            for (app_info, handler) in to_restart:
+                jobs.append(pool.submit(self._restart_app, app_info, handler))
+        for j in jobs:
+            j.wait()
+        workers.wait_all(jobs)
+        self._wait_group_ready([app_info for (app_info, _handler) in to_restart], restart_probes)
+        return len(to_restart)
+
+    def _restart_app(self, app_info, handler):
+        # Restarted with the runner it was started with (so that the trace
+        # of how it was started stays valid), runners that can restart an app
+        # themselves are asked to (stopping the last app a supervisor runs
+        # would also shut the supervisor down) and the others have the app
+        # stopped and then started again
+        app_name = app_info['name']
+        LOG.info("Restarting sub-program %s.", colorizer.quote(app_name))
+        if handler.restart(app_name):
+            return None
+        handler.stop(app_name)
+        return self._start_app(app_info, handler)
+
     def stop(self):
         # Anything to stop??
         killed_am = 0
@@ -678,14 +1004,33 @@ class PythonRuntime(ProgramRuntime):
         if not apps_started:
             return killed_am
         to_kill = self._locate_investigators(apps_started)
-        for (app_name, handler) in to_kill:
-            handler.stop(app_name)
-            killed_am += 1
+        max_workers = self.get_int_option('start_workers', default_value=START_WORKERS)
+        jobs = []
+        # All stopped at the same time...
+        with workers.WorkerPool(min(max_workers, max(1, len(to_kill))), 'stop-%s' % (self.name)) as pool:
+            for (app_name, handler) in to_kill:
+                jobs.append(pool.submit(handler.stop, app_name))
+        for j in jobs:
+            j.wait()
+        killed_am = len([j for j in jobs if not j.exc_info])
+        workers.wait_all(jobs)
         if len(apps_started) == killed_am:
             sh.unlink(self.tracereader.filename())
         return killed_am
 
-    def status(self):
+    def app_pids(self, snapshot=None):
+        app_pids = []
+        try:
+            apps_started = self.tracereader.apps_started()
+        except excp.NoTraceException:
+            return app_pids
+        for (name, handler) in self._locate_investigators(apps_started):
+            pid = handler.pid(name, snapshot=snapshot)
+            if pid:
+                app_pids.append((name, pid))
+        return app_pids
+
+    def status(self, details_max=STATUS_DETAILS_MAX):
         statii = []
         apps_started = None
         try:
@@ -696,7 +1041,7 @@ class PythonRuntime(ProgramRuntime):
             return statii
         to_check = self._locate_investigators(apps_started)
         for (name, handler) in to_check:
-            (status, details) = handler.status(name)
+            (status, details) = handler.status(name, details_max=details_max)
             statii.append(ProgramStatus(name=name,
                                         status=status,
                                         details=details))
@@ -172,7 +172,7 @@ class DBRuntime(comp.ProgramRuntime):
         sh.execute(*restart_cmd, run_as_root=True, check_exit_code=True)
         return 1
 
-    def status(self):
+    def status(self, details_max=comp.STATUS_DETAILS_MAX):
         status_cmd = self._get_run_actions('status', excp.StatusException)
         (sysout, stderr) = sh.execute(*status_cmd, run_as_root=True, check_exit_code=False)
         combined = (sysout + stderr).lower()
@@ -25,6 +25,7 @@ from anvil import cfg
 from anvil import colorizer
 from anvil import components as comp
 from anvil import log as logging
+from anvil import probes
 from anvil import shell as sh
 from anvil import utils
 
@@ -223,6 +224,16 @@ class GlanceRuntime(comp.PythonRuntime):
                 })
         return apps
 
+    def app_probes(self, app_name):
+        app_probes = comp.PythonRuntime.app_probes(self, app_name)
+        endpoints = ghelper.get_shared_params(**self.options)['endpoints']
+        if app_name == 'glance-api':
+            app_probes.append(probes.HttpProbe(endpoints['public']['uri']))
+        elif app_name == 'glance-registry':
+            app_probes.append(probes.TcpProbe(endpoints['registry']['host'],
+                                              endpoints['registry']['port']))
+        return app_probes
+
     def app_options(self, app):
         if app.find('api') != -1:
             return ['--config-file', sh.joinpths('$CONFIG_DIR', API_CONF)]
@@ -246,9 +257,16 @@ class GlanceRuntime(comp.PythonRuntime):
                                                            service_user='glance',
                                                            **utils.merge_dicts(self.get_option('keystone'),
                                                                                khelper.get_shared_passwords(self)))
-            cache_dir = self.get_option('image_cache_dir')
+            cache_dir = self.get_option('image_cache_dir') or self.get_option('artifact_cache_dir')
             if cache_dir:
                 params['cache_dir'] = cache_dir
+            params['cache_size'] = utils.to_bytes(str(self.get_option('artifact_cache_size', default_value=0)))
+            params['download_segments'] = self.get_int_option('image_download_segments', default_value=1)
+            params['parallel'] = self.get_int_option('image_upload_parallel', default_value=1)
+            params['stream_upload'] = self.get_bool_option('image_stream_upload')
+            params['stream_cache'] = self.get_bool_option('image_stream_cache', default_value=True)
+            params['decompressor'] = self.get_option('image_decompressor', default_value=ghelper.DECOMPRESS_PYTHON)
+            params['token_cache'] = khelper.TokenCache()
             ghelper.UploadService(**params).install(self._get_image_urls())
 
 
@@ -17,6 +17,7 @@
 
 from anvil import colorizer
 from anvil import exceptions as excp
+from anvil import importer
 from anvil import log
 from anvil import utils
 
@@ -126,3 +127,24 @@ def fetch_dbdsn(dbtype, user, host, port, pw, dbname, **kwargs):
         dsn += "/"
     LOG.debug("For database %r fetched dsn %r" % (dbname, dsn))
     return dsn
+
+
+def connect(dbtype, user, host, port, pw, dbname, **kwargs):
+    """
+    Returns a (DB-API) connection to the given database and the parameter
+    style (as named by the DB-API) that its queries use.
+    """
+    # Done at a function level since the drivers may not exist until the
+    # components that need them have been installed...
+    if dbtype == 'mysql':
+        db_mod = importer.import_module('MySQLdb')
+        conn = db_mod.connect(host=host, port=int(port), user=user, passwd=pw or '',
+                              db=dbname, charset=kwargs.get('charset', 'utf8'))
+    elif dbtype in ['postgres', 'postgresql']:
+        db_mod = importer.import_module('psycopg2')
+        conn = db_mod.connect(host=host, port=int(port), user=user, password=pw or '',
+                              database=dbname)
+    else:
+        msg = BASE_ERROR % ('connect', dbtype)
+        raise NotImplementedError(msg)
+    return (conn, db_mod.paramstyle)
@@ -18,15 +18,24 @@ import contextlib
 import hashlib
 import os
 import re
+import signal
+import subprocess
+import sys
 import tarfile
+import tempfile
+import threading
 import urlparse
 
+from anvil import cache
 from anvil import colorizer
 from anvil import downloader as down
 from anvil import importer
 from anvil import log
 from anvil import shell as sh
 from anvil import utils
+from anvil import workers
+
+from anvil.components.helpers import keystone as khelper
 
 LOG = log.getLogger(__name__)
 
@@ -71,29 +80,138 @@ SKIP_CHECKS = [
     re.compile(r"^[.]", re.I),
 ]
 
+# The disk and container formats of each image piece (of an archive or directory)
+IMAGE_FORMATS = {
+    'kernel': {
+        'disk_format': 'aki',
+        'container_format': 'aki',
+    },
+    'ramdisk': {
+        'disk_format': 'ari',
+        'container_format': 'ari',
+    },
+    'root': {
+        'disk_format': 'ami',
+        'container_format': 'ami',
+    },
+}
+
 # File extensions we will skip over (typically of content hashes)
 BAD_EXTENSIONS = ['md5', 'sha', 'sfv']
 
+# External multi-core decompressors that can be used (instead of
+# decompressing in-process) for files that start with the given magic; single
+# core ones are not used since they are typically no faster than in-process.
+DECOMPRESSORS = [
+    ('\x1f\x8b', [['pigz', '-dc']]),
+    ('BZh', [['pbzip2', '-dc'], ['lbzip2', '-dc']]),
+]
+
+# How decompression of archives may be done
+DECOMPRESS_AUTO = 'auto'
+DECOMPRESS_PYTHON = 'python'
+DECOMPRESS_TYPES = [DECOMPRESS_AUTO, DECOMPRESS_PYTHON]
+
+
+def _restore_sigpipe():
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+class ChecksumReader(object):
+    """
+    File like object that computes the size and md5 checksum (what glance
+    computes) of what is read through it and optionally writes what is read
+    (sparsely) to another file (tee).
+    """
 
-def _hash_it(content, hash_algo='md5'):
-    hasher = hashlib.new(hash_algo)
-    hasher.update(content)
-    digest = hasher.hexdigest()
-    return digest
+    def __init__(self, fh, tee_fh=None):
+        self.fh = fh
+        self.tee = None
+        if tee_fh is not None:
+            self.tee = sh.SparseWriter(tee_fh)
+        self.size = 0
+        self._hasher = hashlib.md5()
+
+    def read(self, amount=None):
+        if amount is None or amount < 0:
+            data = self.fh.read()
+        else:
+            data = self.fh.read(amount)
+        if data:
+            self.size += len(data)
+            self._hasher.update(data)
+            if self.tee is not None:
+                self.tee.write(data)
+        return data
+
+    def finish(self):
+        if self.tee is not None:
+            self.tee.finish()
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
 
 
 class Unpacker(object):
 
-    def _get_tar_file_members(self, arc_fn):
-        LOG.info("Finding what exists in %s.", colorizer.quote(arc_fn))
-        files = []
-        with contextlib.closing(tarfile.open(arc_fn, 'r')) as tfh:
-            for tmemb in tfh.getmembers():
-                if not tmemb.isfile():
-                    continue
-                fn = tmemb.name
-                files.append(fn)
-        return files
+    def __init__(self, decompressor=DECOMPRESS_PYTHON):
+        if decompressor not in DECOMPRESS_TYPES:
+            raise ValueError("Unknown decompressor %r (expected one of %s)" % (decompressor, DECOMPRESS_TYPES))
+        self.decompressor = decompressor
+
+    def _find_decompressor(self, file_location):
+        # Returns the command that can decompress the file (or none if it is
+        # not compressed or there is nothing available to decompress it)
+        if self.decompressor != DECOMPRESS_AUTO:
+            return None
+        with open(file_location, 'rb') as fh:
+            magic = fh.read(4)
+        for (look_for, candidates) in DECOMPRESSORS:
+            if not magic.startswith(look_for):
+                continue
+            for cmd in candidates:
+                program = sh.which(cmd[0])
+                if program:
+                    return [program] + cmd[1:]
+        return None
+
+    @contextlib.contextmanager
+    def _open_tar(self, file_location):
+        cmd = self._find_decompressor(file_location)
+        if not cmd:
+            with contextlib.closing(tarfile.open(file_location, 'r|*')) as tfh:
+                yield tfh
+            return
+        cmd = cmd + [file_location]
+        LOG.debug("Decompressing %r using %s", file_location, cmd)
+        with tempfile.TemporaryFile() as stderr_fh:
+            # When we stop reading early the decompressor should die from
+            # the closed pipe (python ignores SIGPIPE and children inherit that)
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_fh, close_fds=True,
+                                    preexec_fn=_restore_sigpipe)
+            finished = False
+            try:
+                with contextlib.closing(tarfile.open(fileobj=proc.stdout, mode='r|')) as tfh:
+                    yield tfh
+                # The tar reader may stop before the end of the stream (the
+                # padding after the end of archive marker) so drain it...
+                while proc.stdout.read(down.CHUNK_SIZE):
+                    pass
+                finished = True
+            finally:
+                proc.stdout.close()
+                proc.wait()
+                if proc.returncode > 0 and not finished:
+                    # A failing decompressor typically shows up as a broken
+                    # or empty archive so say why (without hiding that error)
+                    LOG.warn("%s", self._decompress_failure(file_location, cmd, proc, stderr_fh))
+            if proc.returncode > 0:
+                raise IOError(self._decompress_failure(file_location, cmd, proc, stderr_fh))
+
+    def _decompress_failure(self, file_location, cmd, proc, stderr_fh):
+        stderr_fh.seek(0)
+        return ("Decompressing %r using %s failed (exit code %s): %s"
+                % (file_location, cmd[0], proc.returncode, stderr_fh.read().strip()))
 
     def _pat_checker(self, fn, patterns):
         (_root_fn, fn_ext) = os.path.splitext(fn)
@@ -104,60 +222,54 @@ class Unpacker(object):
                 return True
         return False
 
+    def _classify(self, fn):
+        # Returns which image piece (if any) the file name looks like
+        if self._pat_checker(fn, KERNEL_CHECKS):
+            return 'kernel'
+        elif self._pat_checker(fn, RAMDISK_CHECKS):
+            return 'ramdisk'
+        elif self._pat_checker(fn, ROOT_CHECKS):
+            return 'root'
+        return None
+
     def _find_pieces(self, files, files_location):
         """
         Match files against the patterns in KERNEL_CHECKS,
         RAMDISK_CHECKS, and ROOT_CHECKS to determine which files
         contain which image parts.
         """
-        kernel_fn = None
-        ramdisk_fn = None
-        img_fn = None
+        pieces = {}
         utils.log_iterable(files, logger=LOG,
               header="Looking at %s files from %s to find the kernel/ramdisk/root images" % (len(files), colorizer.quote(files_location)))
 
         for fn in files:
-            if self._pat_checker(fn, KERNEL_CHECKS):
-                kernel_fn = fn
-                LOG.debug("Found kernel: %r" % (fn))
-            elif self._pat_checker(fn, RAMDISK_CHECKS):
-                ramdisk_fn = fn
-                LOG.debug("Found ram disk: %r" % (fn))
-            elif self._pat_checker(fn, ROOT_CHECKS):
-                img_fn = fn
-                LOG.debug("Found root image: %r" % (fn))
+            kind = self._classify(fn)
+            if kind:
+                pieces[kind] = fn
+                LOG.debug("Found %s image: %r" % (kind, fn))
             else:
                 LOG.debug("Unknown member %r - skipping" % (fn))
 
-        return (img_fn, ramdisk_fn, kernel_fn)
+        return (pieces.get('root'), pieces.get('ramdisk'), pieces.get('kernel'))
 
-    def _unpack_tar_member(self, tarhandle, member, output_location):
+    def _unpack_tar_member(self, member, mfh, output_location):
         LOG.info("Extracting %s to %s.", colorizer.quote(member.name), colorizer.quote(output_location))
-        with contextlib.closing(tarhandle.extractfile(member)) as mfh:
+        with contextlib.closing(mfh):
             with open(output_location, "wb") as ofh:
-                return sh.pipe_in_out(mfh, ofh)
+                # Raw images are mostly zeros, so keep them sparse
+                return sh.pipe_in_out(mfh, ofh, chunk_size=down.CHUNK_SIZE, sparse=True)
 
-    def _describe(self, root_fn, ramdisk_fn, kernel_fn):
+    def describe(self, root_fn, ramdisk_fn, kernel_fn):
         """
         Make an "info" dict that describes the path, disk format, and
         container format of each component of an image.
         """
-        info = dict()
-        if kernel_fn:
-            info['kernel'] = {
-                'file_name': kernel_fn,
-                'disk_format': 'aki',
-                'container_format': 'aki',
-            }
-        if ramdisk_fn:
-            info['ramdisk'] = {
-                'file_name': ramdisk_fn,
-                'disk_format': 'ari',
-                'container_format': 'ari',
-            }
+        info = dict(IMAGE_FORMATS['root'])
         info['file_name'] = root_fn
-        info['disk_format'] = 'ami'
-        info['container_format'] = 'ami'
+        for (kind, fn) in [('kernel', kernel_fn), ('ramdisk', ramdisk_fn)]:
+            if fn:
+                info[kind] = dict(IMAGE_FORMATS[kind])
+                info[kind]['file_name'] = fn
         return info
 
     def _filter_files(self, files):
@@ -169,30 +281,52 @@ class Unpacker(object):
                 filtered.append(fn)
         return filtered
 
+    def is_tar(self, file_name):
+        (_, fn_ext) = os.path.splitext(file_name)
+        return fn_ext.lower() in TAR_EXTS
+
+    def iter_tar(self, file_location):
+        """
+        Yields (kind, member, file object) for each member of the archive that
+        looks like a kernel, ramdisk or root image as the archive streams by
+        (so that compressed archives are only decompressed once). Each file
+        object must be consumed before moving on to the next member. Only the
+        first member of each kind is yielded (what was streamed somewhere can
+        not be taken back when a later member also matches).
+        """
+        LOG.info("Finding images in %s.", colorizer.quote(file_location))
+        found = {}
+        with self._open_tar(file_location) as tfh:
+            for m in tfh:
+                if not m.isfile() or self._pat_checker(sh.basename(m.name), SKIP_CHECKS):
+                    continue
+                kind = self._classify(m.name)
+                if not kind:
+                    LOG.debug("Unknown member %r - skipping" % (m.name))
+                    continue
+                if kind in found:
+                    LOG.warn("Skipping %s, %s was already found as the %s image.",
+                             colorizer.quote(m.name), colorizer.quote(found[kind]), kind)
+                    continue
+                LOG.debug("Found %s image: %r" % (kind, m.name))
+                found[kind] = m.name
+                yield (kind, m, tfh.extractfile(m))
+
     def _unpack_tar(self, file_name, file_location, tmp_dir):
         (root_name, _) = os.path.splitext(file_name)
-        tar_members = self._filter_files(self._get_tar_file_members(file_location))
-        (root_img_fn, ramdisk_fn, kernel_fn) = self._find_pieces(tar_members, file_location)
-        if not root_img_fn:
+        extract_dir = sh.mkdir(sh.joinpths(tmp_dir, root_name))
+        found = {}
+        extracted = {}
+        for (kind, m, mfh) in self.iter_tar(file_location):
+            real_fn = sh.joinpths(extract_dir, sh.basename(m.name))
+            self._unpack_tar_member(m, mfh, real_fn)
+            found[kind] = m.name
+            extracted[kind] = real_fn
+        if 'root' not in found:
             msg = "Tar file %r has no root image member" % (file_name)
             raise IOError(msg)
-        kernel_real_fn = None
-        root_real_fn = None
-        ramdisk_real_fn = None
-        self._log_pieces_found('archive', root_img_fn, ramdisk_fn, kernel_fn)
-        extract_dir = sh.mkdir(sh.joinpths(tmp_dir, root_name))
-        with contextlib.closing(tarfile.open(file_location, 'r')) as tfh:
-            for m in tfh.getmembers():
-                if m.name == root_img_fn:
-                    root_real_fn = sh.joinpths(extract_dir, sh.basename(root_img_fn))
-                    self._unpack_tar_member(tfh, m, root_real_fn)
-                elif ramdisk_fn and m.name == ramdisk_fn:
-                    ramdisk_real_fn = sh.joinpths(extract_dir, sh.basename(ramdisk_fn))
-                    self._unpack_tar_member(tfh, m, ramdisk_real_fn)
-                elif kernel_fn and m.name == kernel_fn:
-                    kernel_real_fn = sh.joinpths(extract_dir, sh.basename(kernel_fn))
-                    self._unpack_tar_member(tfh, m, kernel_real_fn)
-        return self._describe(root_real_fn, ramdisk_real_fn, kernel_real_fn)
+        self._log_pieces_found('archive', found.get('root'), found.get('ramdisk'), found.get('kernel'))
+        return self.describe(extracted.get('root'), extracted.get('ramdisk'), extracted.get('kernel'))
 
     def _log_pieces_found(self, src_type, root_fn, ramdisk_fn, kernel_fn):
         pieces = []
@@ -221,7 +355,7 @@ class Unpacker(object):
             msg = "Directory %r has no root image member" % (dir_path)
             raise IOError(msg)
         self._log_pieces_found('directory', root_fn, ramdisk_fn, kernel_fn)
-        return self._describe(root_fn, ramdisk_fn, kernel_fn)
+        return self.describe(root_fn, ramdisk_fn, kernel_fn)
 
     def unpack(self, file_name, file_location, tmp_dir):
         if sh.isdir(file_location):
@@ -229,7 +363,7 @@ class Unpacker(object):
         elif sh.isfile(file_location):
             (_, fn_ext) = os.path.splitext(file_name)
             fn_ext = fn_ext.lower()
-            if fn_ext in TAR_EXTS:
+            if self.is_tar(file_name):
                 return self._unpack_tar(file_name, file_location, tmp_dir)
             elif fn_ext in ['.img', '.qcow2']:
                 info = dict()
@@ -245,82 +379,176 @@ class Unpacker(object):
 
 
 class Registry(object):
+    """
+    Index of the images glance already has (by name and by checksum) which
+    is built once (listing all images can be slow on a shared glance) and
+    then kept up to date as images are created. Names are reserved before
+    being uploaded so that concurrent uploads can not both claim one.
+    """
 
     def __init__(self, client):
         self.client = client
-
-    def _extract_names(self):
+        self._names = None
+        self._checksums = None
+        self._reserved = set()
+        self._lock = threading.RLock()
+
+    def _build(self):
+        if self._names is not None:
+            return
         names = dict()
-        images = self.client.images.list()
-        for image in images:
-            name = image.name
-            names[name] = image.id
-        return names
+        checksums = dict()
+        for image in self.client.images.list():
+            names[image.name] = image.id
+            checksum = getattr(image, 'checksum', None)
+            if checksum:
+                checksums[checksum] = image.id
+        LOG.debug("Indexed %s existing glance images.", len(names))
+        (self._names, self._checksums) = (names, checksums)
+
+    def load(self):
+        with self._lock:
+            self._build()
+
+    def add(self, image):
+        # Records a (newly created) image so that later checks see it
+        with self._lock:
+            self._build()
+            self._reserved.discard(image.name)
+            self._names[image.name] = image.id
+            checksum = getattr(image, 'checksum', None)
+            if checksum:
+                self._checksums[checksum] = image.id
+
+    def reserve(self, name):
+        # Claims the name for an upload about to happen, release it if that
+        # upload does not end up adding an image with it
+        with self._lock:
+            self._build()
+            if name in self._names or name in self._reserved:
+                raise IOError("Image named %s already exists." % (name))
+            self._reserved.add(name)
+
+    def release(self, name):
+        with self._lock:
+            self._reserved.discard(name)
+
+    def find_checksum(self, checksum):
+        with self._lock:
+            self._build()
+            return self._checksums.get(checksum)
+
+    def reset(self):
+        with self._lock:
+            self._names = None
+            self._checksums = None
 
     def __contains__(self, name):
-        names = self._extract_names()
-        if name in names:
-            return True
-        else:
-            return False
+        with self._lock:
+            self._build()
+            return name in self._names or name in self._reserved
 
 
 class Image(object):
 
-    def __init__(self, client, url, is_public, cache_dir):
+    def __init__(self, client, url, is_public, cache, download_segments=1, registry=None,
+                 parallel=False, stream_upload=False, stream_cache=True,
+                 decompressor=DECOMPRESS_PYTHON):
         self.client = client
-        self.registry = Registry(client)
+        if registry is None:
+            registry = Registry(client)
+        self.registry = registry
         self.url = url
         self.parsed_url = urlparse.urlparse(url)
         self.is_public = is_public
-        self.cache_dir = cache_dir
-
-    def _check_name(self, name):
-        LOG.info("Checking if image %s already exists already in glance.", colorizer.quote(name))
-        if name in self.registry:
-            raise IOError("Image named %s already exists." % (name))
+        self.cache = cache
+        self.download_segments = download_segments
+        self.parallel = parallel
+        # Upload archive members as they are decompressed (instead of
+        # extracting them to disk and then uploading them from there)
+        self.stream_upload = stream_upload
+        self.stream_cache = stream_cache
+        self.decompressor = decompressor
+
+    def _reserve_names(self, names):
+        # Reserves all the names (or none of them)
+        reserved = []
+        try:
+            for name in names:
+                LOG.info("Checking if image %s already exists already in glance.", colorizer.quote(name))
+                self.registry.reserve(name)
+                reserved.append(name)
+        except Exception:
+            self._release_names(reserved)
+            raise
+
+    def _release_names(self, names):
+        for name in names:
+            self.registry.release(name)
+
+    def _create(self, file_name, **kwargs):
+        with open(file_name, 'r') as fh:
+            resource = self.client.images.create(data=fh, **kwargs)
+        self.registry.add(resource)
+        return resource.id
+
+    def _upload_part(self, kind, image_name, part):
+        # Many images share the same kernel (or ramdisk) so one that glance
+        # already has (with the same contents) is used instead of another copy
+        checksum = cache.hash_file(part['file_name'], hash_algo='md5')
+        existing_id = self.registry.find_checksum(checksum)
+        if existing_id:
+            LOG.info('Using existing %s %s (the same as %s) instead of adding it to glance.', kind,
+                     colorizer.quote(existing_id), colorizer.quote(image_name))
+            return existing_id
+        LOG.info('Adding %s %s to glance.', kind, colorizer.quote(image_name))
+        LOG.info("Please wait installing...")
+        args = {
+            'container_format': part['container_format'],
+            'disk_format': part['disk_format'],
+            'name': image_name,
+            'is_public': self.is_public,
+        }
+        return self._create(part['file_name'], **args)
 
     def _register(self, image_name, location):
-
-        # Upload the kernel, if we have one
         kernel = location.pop('kernel', None)
-        kernel_id = ''
-        if kernel:
-            kernel_image_name = "%s-vmlinuz" % (image_name)
-            self._check_name(kernel_image_name)
-            LOG.info('Adding kernel %s to glance.', colorizer.quote(kernel_image_name))
-            LOG.info("Please wait installing...")
-            args = {
-                'container_format': kernel['container_format'],
-                'disk_format': kernel['disk_format'],
-                'name': kernel_image_name,
-                'is_public': self.is_public,
-            }
-            with open(kernel['file_name'], 'r') as fh:
-                resource = self.client.images.create(data=fh, **args)
-                kernel_id = resource.id
-
-        # Upload the ramdisk, if we have one
         initrd = location.pop('ramdisk', None)
-        initrd_id = ''
+
+        # Reserve all the names before uploading anything so that we do not
+        # leave a kernel or ramdisk behind when the root can not be added
+        parts = []
+        if kernel:
+            parts.append(('kernel', "%s-vmlinuz" % (image_name), kernel))
         if initrd:
-            ram_image_name = "%s-initrd" % (image_name)
-            self._check_name(ram_image_name)
-            LOG.info('Adding ramdisk %s to glance.', colorizer.quote(ram_image_name))
-            LOG.info("Please wait installing...")
-            args = {
-                'container_format': initrd['container_format'],
-                'disk_format': initrd['disk_format'],
-                'name': ram_image_name,
-                'is_public': self.is_public,
-            }
-            with open(initrd['file_name'], 'r') as fh:
-                resource = self.client.images.create(data=fh, **args)
-                initrd_id = resource.id
+            parts.append(('ramdisk', "%s-initrd" % (image_name), initrd))
+        names = [part_name for (_kind, part_name, _part) in parts]
+        names.append(image_name)
+        self._reserve_names(names)
+        try:
+            return self._register_parts(image_name, location, parts)
+        finally:
+            # Whatever was not added (because uploading it failed) can be
+            # claimed again
+            self._release_names(names)
+
+    def _register_parts(self, image_name, location, parts):
+        # Upload the kernel and ramdisk (if we have them), these do not
+        # depend on each other so they can go at the same time...
+        part_ids = {}
+        if self.parallel and len(parts) > 1:
+            with workers.WorkerPool(len(parts), name='image-part') as pool:
+                jobs = []
+                for (kind, part_name, part) in parts:
+                    jobs.append(pool.submit(self._upload_part, kind, part_name, part))
+                for ((kind, _part_name, _part), part_id) in zip(parts, workers.wait_all(jobs)):
+                    part_ids[kind] = part_id
+        else:
+            for (kind, part_name, part) in parts:
+                part_ids[kind] = self._upload_part(kind, part_name, part)
 
         # Upload the root, we must have one...
         LOG.info('Adding image %s to glance.', colorizer.quote(image_name))
-        self._check_name(image_name)
         args = {
             'name': image_name,
             'container_format': location['container_format'],
@@ -328,17 +556,98 @@ class Image(object):
             'is_public': self.is_public,
             'properties': {},
         }
-        if kernel_id or initrd_id:
-            if kernel_id:
-                args['properties']['kernel_id'] = kernel_id
-            if initrd_id:
-                args['properties']['ramdisk_id'] = initrd_id
+        if part_ids.get('kernel'):
+            args['properties']['kernel_id'] = part_ids['kernel']
+        if part_ids.get('ramdisk'):
+            args['properties']['ramdisk_id'] = part_ids['ramdisk']
         LOG.info("Please wait installing...")
-        with open(location['file_name'], 'r') as fh:
-            resource = self.client.images.create(data=fh, **args)
-            img_id = resource.id
+        return self._create(location['file_name'], **args)
 
-        return img_id
+    def _upload_stream(self, kind, image_name, member, mfh, tee_fn, **kwargs):
+        LOG.info('Streaming %s %s to glance from %s.', kind, colorizer.quote(image_name),
+                 colorizer.quote(member.name))
+        LOG.info("Please wait installing...")
+        tee_fh = None
+        if tee_fn:
+            tee_fh = open(tee_fn, 'wb')
+        try:
+            reader = ChecksumReader(mfh, tee_fh)
+            # The size is given so that glance does not need to find it out
+            # (the member stream can not be seeked on to find it)
+            resource = self.client.images.create(data=reader, name=image_name,
+                                                 size=member.size, is_public=self.is_public,
+                                                 **kwargs)
+            reader.finish()
+        finally:
+            mfh.close()
+            if tee_fh is not None:
+                tee_fh.close()
+        checksum = getattr(resource, 'checksum', None)
+        if reader.size != member.size or (checksum and checksum != reader.hexdigest()):
+            self.client.images.delete(resource.id)
+            raise IOError("Uploaded %s (%s bytes with checksum %s) does not match %s (%s bytes with checksum %s)"
+                          % (image_name, reader.size, reader.hexdigest(), member.name, member.size, checksum))
+        self.registry.add(resource)
+        return resource.id
+
+    def _stream_register(self, image_name, url_fn, fetched_fn, extract_dir):
+        # Uploads the pieces of the archive as they stream by, the kernel and
+        # ramdisk may come after the root so its properties are updated (once
+        # there ids are known) when that happens.
+        unpacker = Unpacker(self.decompressor)
+        self._reserve_names([image_name])
+        reserved = [image_name]
+        names = {
+            'kernel': "%s-vmlinuz" % (image_name),
+            'ramdisk': "%s-initrd" % (image_name),
+            'root': image_name,
+        }
+        ids = {}
+        extracted = {}
+        try:
+            for (kind, m, mfh) in unpacker.iter_tar(fetched_fn):
+                if kind != 'root':
+                    self._reserve_names([names[kind]])
+                    reserved.append(names[kind])
+                args = dict(IMAGE_FORMATS[kind])
+                if kind == 'root':
+                    properties = {}
+                    if 'kernel' in ids:
+                        properties['kernel_id'] = ids['kernel']
+                    if 'ramdisk' in ids:
+                        properties['ramdisk_id'] = ids['ramdisk']
+                    args['properties'] = properties
+                tee_fn = None
+                if extract_dir:
+                    tee_fn = sh.joinpths(extract_dir, sh.basename(m.name))
+                ids[kind] = self._upload_stream(kind, names[kind], m, mfh, tee_fn, **args)
+                if tee_fn:
+                    extracted[kind] = tee_fn
+            if 'root' not in ids:
+                raise IOError("Tar file %r has no root image member" % (url_fn))
+        except Exception:
+            exc_info = sys.exc_info()
+            for (kind, image_id) in ids.items():
+                LOG.warn("Removing partially uploaded %s image %s.", kind, colorizer.quote(image_id))
+                try:
+                    self.client.images.delete(image_id)
+                except Exception as e:
+                    LOG.warn("Failed removing %s due to: %s", colorizer.quote(image_id), e)
+            self._release_names(reserved)
+            self.registry.reset()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        properties = {}
+        for (kind, prop_name) in [('kernel', 'kernel_id'), ('ramdisk', 'ramdisk_id')]:
+            if kind in ids:
+                properties[prop_name] = ids[kind]
+        if properties:
+            # Does nothing new if these were already known when the root went up
+            self.client.images.update(ids['root'], properties=properties, purge_props=False)
+        unpack_info = None
+        if extract_dir:
+            unpack_info = unpacker.describe(extracted.get('root'), extracted.get('ramdisk'),
+                                            extracted.get('kernel'))
+        return (ids['root'], unpack_info)
 
     def _generate_img_name(self, url_fn):
         name = url_fn
@@ -352,16 +661,32 @@ class Image(object):
     def _is_url_local(self):
         return (sh.exists(self.url) or (self.parsed_url.scheme == '' and self.parsed_url.netloc == ''))
 
-    def _cached_paths(self):
-        digest = _hash_it(self.url)
-        path = sh.joinpths(self.cache_dir, digest)
-        details_path = sh.joinpths(self.cache_dir, digest + ".details")
-        return (path, details_path)
-
-    def _validate_cache(self, cache_path, details_path):
-        for path in [cache_path, details_path]:
-            if not sh.exists(path):
-                return False
+    def _fetch(self, url_fn):
+        # Returns the digest and location of the (cached) artifact for this
+        # url, which stays pinned (not evicted) until unpinned
+        if sh.isdir(self.url):
+            return (None, self.url)
+        if self._is_url_local():
+            st = os.stat(self.url)
+            stamp = "%s:%s" % (st.st_size, st.st_mtime)
+            (digest, path) = self.cache.get(self.url, stamp=stamp, pin=True)
+            if not digest:
+                (digest, path) = self.cache.add(self.url, self.url, name=url_fn, stamp=stamp, pin=True)
+            return (digest, path)
+
+        def fetcher(target):
+            # Many progress bars at once would just garble each other
+            (fetched_fn, bytes_down) = down.UrlLibDownloader(self.url, target,
+                                                             segments=self.download_segments,
+                                                             quiet=self.parallel,
+                                                             sparse=True).download()
+            LOG.debug("For url %s we downloaded %s bytes to %s", self.url, bytes_down, fetched_fn)
+
+        return self.cache.fetch(self.url, fetcher, name=url_fn, pin=True)
+
+    def _validate_unpacked(self, details_path):
+        if not sh.isfile(details_path):
+            return False
         check_files = []
         try:
             unpack_info = utils.load_yaml_text(sh.load_file(details_path))
@@ -381,42 +706,107 @@ class Image(object):
         url_fn = self._extract_url_fn()
         if not url_fn:
             raise IOError("Can not determine file name from url: %r" % (self.url))
-        (cache_path, details_path) = self._cached_paths()
-        use_cached = self._validate_cache(cache_path, details_path)
-        if use_cached:
-            LOG.info("Found valid cached image + metadata at: %s", colorizer.quote(cache_path))
-            unpack_info = utils.load_yaml_text(sh.load_file(details_path))
-        else:
-            sh.mkdir(cache_path)
-            if not self._is_url_local():
-                (fetched_fn, bytes_down) = down.UrlLibDownloader(self.url,
-                                                                 sh.joinpths(cache_path, url_fn)).download()
-                LOG.debug("For url %s we downloaded %s bytes to %s", self.url, bytes_down, fetched_fn)
+        (digest, fetched_fn) = self._fetch(url_fn)
+        if not digest:
+            # Directories are used as is (there is nothing to cache)
+            tgt_image_name = self._generate_img_name(url_fn)
+            unpack_info = Unpacker(self.decompressor).unpack(url_fn, fetched_fn, None)
+            img_id = self._register(tgt_image_name, unpack_info)
+            return (tgt_image_name, img_id)
+        try:
+            tgt_image_name = self._generate_img_name(url_fn)
+            return self._install_cached(url_fn, digest, fetched_fn, tgt_image_name)
+        finally:
+            self.cache.unpin(digest)
+
+    def _install_cached(self, url_fn, digest, fetched_fn, tgt_image_name):
+        # Urls with the same contents share the same extras, so only one of
+        # them at a time may check (or make) those extras
+        with self.cache.extras_locked(digest) as extras_path:
+            details_path = sh.joinpths(extras_path, 'details.yaml')
+            if self._validate_unpacked(details_path):
+                LOG.info("Found valid cached image + metadata at: %s", colorizer.quote(extras_path))
+                unpack_info = utils.load_yaml_text(sh.load_file(details_path))
+            elif self.stream_upload and Unpacker().is_tar(url_fn):
+                extract_dir = None
+                if self.stream_cache:
+                    (root_name, _) = os.path.splitext(url_fn)
+                    extract_dir = sh.mkdir(sh.joinpths(extras_path, root_name))
+                try:
+                    (img_id, unpack_info) = self._stream_register(tgt_image_name, url_fn,
+                                                                  fetched_fn, extract_dir)
+                except Exception:
+                    # Do not leave partially written pieces in the cache
+                    if extract_dir:
+                        sh.deldir(extract_dir)
+                    raise
+                if unpack_info:
+                    sh.write_file(details_path, utils.prettify_yaml(unpack_info))
+                    self.cache.refresh(digest)
+                return (tgt_image_name, img_id)
             else:
-                fetched_fn = self.url
-            unpack_info = Unpacker().unpack(url_fn, fetched_fn, cache_path)
-            sh.write_file(details_path, utils.prettify_yaml(unpack_info))
-        tgt_image_name = self._generate_img_name(url_fn)
+                sh.mkdir(extras_path)
+                unpack_info = Unpacker(self.decompressor).unpack(url_fn, fetched_fn, extras_path)
+                sh.write_file(details_path, utils.prettify_yaml(unpack_info))
+                self.cache.refresh(digest)
         img_id = self._register(tgt_image_name, unpack_info)
         return (tgt_image_name, img_id)
 
 
 class UploadService(object):
 
-    def __init__(self, glance, keystone, cache_dir='/usr/share/anvil/glance/cache', is_public=True):
+    def __init__(self, glance, keystone, cache_dir='/usr/share/anvil/cache', is_public=True,
+                 download_segments=1, cache_size=0, parallel=1, stream_upload=False,
+                 stream_cache=True, decompressor=DECOMPRESS_PYTHON, token_cache=None):
         self.glance_params = glance
         self.keystone_params = keystone
-        self.cache_dir = cache_dir
+        self.token_cache = token_cache
+        self.cache = cache.ArtifactCache(cache_dir, max_size=cache_size)
         self.is_public = is_public
+        self.download_segments = download_segments
+        # How many images may be downloaded+extracted+uploaded at once
+        self.parallel = max(1, int(parallel))
+        self.stream_upload = stream_upload
+        self.stream_cache = stream_cache
+        # Checked now (instead of when each image is unpacked) so that a bad
+        # value fails here instead of failing every image
+        if decompressor not in DECOMPRESS_TYPES:
+            raise ValueError("Unknown decompressor %r (expected one of %s)" % (decompressor, DECOMPRESS_TYPES))
+        self.decompressor = decompressor
 
     def _get_token(self, kclient_v2):
-        LOG.info("Getting your keystone token so that image uploads may proceed.")
         k_params = self.keystone_params
-        client = kclient_v2.Client(username=k_params['admin_user'],
-                                   password=k_params['admin_password'],
-                                   tenant_name=k_params['admin_tenant'],
-                                   auth_url=k_params['endpoints']['public']['uri'])
-        return client.auth_token
+        return khelper.get_token(kclient_v2,
+                                 auth_url=k_params['endpoints']['public']['uri'],
+                                 username=k_params['admin_user'],
+                                 password=k_params['admin_password'],
+                                 tenant_name=k_params['admin_tenant'],
+                                 cache=self.token_cache)
+
+    def _invalidate_token(self):
+        k_params = self.keystone_params
+        if self.token_cache:
+            self.token_cache.invalidate(k_params['endpoints']['public']['uri'],
+                                        k_params['admin_user'], k_params['admin_tenant'])
+
+    def _install_image(self, client, registry, url, install_errors):
+        # Returns how many images were installed (0 or 1)
+        try:
+            img_handle = Image(client, url,
+                               is_public=self.is_public,
+                               cache=self.cache,
+                               download_segments=self.download_segments,
+                               registry=registry,
+                               parallel=(self.parallel > 1),
+                               stream_upload=self.stream_upload,
+                               stream_cache=self.stream_cache,
+                               decompressor=self.decompressor)
+            (name, img_id) = img_handle.install()
+            LOG.info("Installed image named %s with image id %s.", colorizer.quote(name), colorizer.quote(img_id))
+            return 1
+        except install_errors as e:
+            LOG.exception('Installing %r failed due to: %s', url, e)
+            return 0
 
     def install(self, urls):
         am_installed = 0
@@ -438,25 +828,36 @@ class UploadService(object):
                 g_params = self.glance_params
                 client = gclient_v1.Client(endpoint=g_params['endpoints']['public']['uri'],
                                            token=self._get_token(kclient_v2))
+                registry = Registry(client)
+                try:
+                    registry.load()
+                except gexceptions.ClientException as e:
+                    if getattr(e, 'code', None) != 401:
+                        raise
+                    # A cached token may have been revoked, try a fresh one
+                    self._invalidate_token()
+                    client = gclient_v1.Client(endpoint=g_params['endpoints']['public']['uri'],
+                                               token=self._get_token(kclient_v2))
+                    registry = Registry(client)
             except (RuntimeError, gexceptions.ClientException,
                     kexceptions.ClientException, IOError) as e:
                 LOG.exception('Failed fetching needed clients for image calls due to: %s', e)
                 return am_installed
             utils.log_iterable(urls, logger=LOG,
                                 header="Attempting to download+extract+upload %s images" % len(urls))
-            for url in urls:
-                try:
-                    img_handle = Image(client, url,
-                                       is_public=self.is_public,
-                                       cache_dir=self.cache_dir)
-                    (name, img_id) = img_handle.install()
-                    LOG.info("Installed image named %s with image id %s.", colorizer.quote(name), colorizer.quote(img_id))
-                    am_installed += 1
-                except (IOError,
-                        tarfile.TarError,
-                        gexceptions.ClientException,
-                        kexceptions.ClientException) as e:
-                    LOG.exception('Installing %r failed due to: %s', url, e)
+            install_errors = (IOError,
+                              tarfile.TarError,
+                              gexceptions.ClientException,
+                              kexceptions.ClientException)
+            if self.parallel > 1 and len(urls) > 1:
+                with workers.WorkerPool(min(self.parallel, len(urls)), name='image') as pool:
+                    jobs = []
+                    for url in urls:
+                        jobs.append(pool.submit(self._install_image, client, registry, url, install_errors))
+                    am_installed += sum(workers.wait_all(jobs))
+            else:
+                for url in urls:
+                    am_installed += self._install_image(client, registry, url, install_errors)
         return am_installed
 
 
@@ -14,122 +14,633 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import calendar
+import crypt
+import functools
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import iso8601
+
 from anvil import colorizer
+from anvil import exceptions as excp
 from anvil import importer
 from anvil import log as logging
+from anvil import shell as sh
 from anvil import utils
+from anvil import workers
+
+from anvil.utils import OrderedDict
 
 LOG = logging.getLogger(__name__)
 
+# Where scoped tokens (and when they expire) are remembered across runs
+TOKEN_CACHE_FN = '/etc/anvil/tokens.json'
 
-class Initializer(object):
+# Tokens this close (in seconds) to expiring are not reused
+TOKEN_MIN_REMAINING = 300
 
-    def __init__(self, service_token, admin_uri):
-        # Late load since its using a client lib that is only avail after install...
-        self.client = importer.construct_entry_point("keystoneclient.v2_0.client:Client",
-                                                    token=service_token, endpoint=admin_uri)
+# Used when keystone does not tell us when a token expires
+TOKEN_DEFAULT_LIFETIME = 3600
 
-    def _create_tenants(self, tenants):
-        tenants_made = dict()
-        for entry in tenants:
-            name = entry['name']
-            if name in tenants_made:
-                LOG.warn("Already created tenant %s", colorizer.quote(name))
-            tenant = {
-                'tenant_name': name,
-                'description': entry['description'],
-                'enabled': True,
-            }
-            tenants_made[name] = self.client.tenants.create(**tenant)
-        return tenants_made
+# Keystones default (sha512 crypt) password hashing strength
+PASSWORD_HASH_ROUNDS = 40000
 
-    def _create_users(self, users, tenants):
-        created = dict()
-        for entry in users:
-            name = entry['name']
-            if name in created:
-                LOG.warn("Already created user %s", colorizer.quote(name))
-            password = entry['password']
-            email = entry['email']
-            user = {
-                'name': name,
-                'password': password,
-                'email': email,
+# The domain projects and users are placed in (by keystones that have domains)
+DEFAULT_DOMAIN_ID = 'default'
+
+# Clients (and there http connections) that are reused within a run, these
+# are per-thread since the clients http layer is not thread safe
+_CLIENTS = threading.local()
+
+
+def get_admin_client(service_token, admin_uri):
+    # Late load since its using a client lib that is only avail after install...
+    clients = getattr(_CLIENTS, 'clients', None)
+    if clients is None:
+        clients = _CLIENTS.clients = {}
+    key = (service_token, admin_uri)
+    if key not in clients:
+        clients[key] = importer.construct_entry_point("keystoneclient.v2_0.client:Client",
+                                                     token=service_token, endpoint=admin_uri)
+    return clients[key]
+
+
+class TokenCache(object):
+    """
+    Remembers scoped tokens (and when they expire) in a file that only its
+    owner can read so that repeated runs can skip authenticating.
+    """
+
+    def __init__(self, path=TOKEN_CACHE_FN, min_remaining=TOKEN_MIN_REMAINING):
+        self.path = path
+        self.min_remaining = min_remaining
+        self._lock = threading.Lock()
+
+    def _key(self, auth_url, username, tenant_name):
+        return "%s@%s/%s" % (username, auth_url, tenant_name)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as fh:
+                entries = json.loads(fh.read())
+            if isinstance(entries, dict):
+                return entries
+        except (IOError, ValueError):
+            pass
+        return {}
+
+    def _save(self, entries):
+        # Tokens are as good as passwords (while they last) so make sure
+        # the file is never readable by others (mkstemp creates it 0600)
+        base_dir = sh.dirname(self.path)
+        try:
+            if not sh.isdir(base_dir):
+                os.makedirs(base_dir, 0700)
+            (fd, tmp_fn) = tempfile.mkstemp(dir=base_dir, prefix='.tokens')
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(json.dumps(entries, indent=4, sort_keys=True))
+            os.rename(tmp_fn, self.path)
+        except (IOError, OSError) as e:
+            LOG.debug("Unable to save tokens to %r: %s", self.path, e)
+
+    def _prune(self, entries, now):
+        for (key, entry) in entries.items():
+            if entry.get('expires', 0) <= now:
+                entries.pop(key)
+        return entries
+
+    def get(self, auth_url, username, tenant_name):
+        with self._lock:
+            entry = self._load().get(self._key(auth_url, username, tenant_name))
+        if not entry:
+            return None
+        remaining = entry.get('expires', 0) - time.time()
+        if remaining <= self.min_remaining:
+            return None
+        return entry.get('token')
+
+    def put(self, auth_url, username, tenant_name, token, expires):
+        now = time.time()
+        with self._lock:
+            entries = self._prune(self._load(), now)
+            entries[self._key(auth_url, username, tenant_name)] = {
+                'token': token,
+                'expires': expires,
             }
-            created[name] = self.client.users.create(**user)
-        return created
-
-    def _create_roles(self, roles):
-        roles_made = dict()
-        for r in roles:
-            role = r
-            if role in roles_made:
-                LOG.warn("Already created role %s", colorizer.quote(role))
-            roles_made[role] = self.client.roles.create(role)
-        return roles_made
+            self._save(entries)
+
+    def invalidate(self, auth_url, username, tenant_name):
+        with self._lock:
+            entries = self._load()
+            if entries.pop(self._key(auth_url, username, tenant_name), None):
+                self._save(entries)
+
+
+def _token_expiry(client):
+    # Older clients do not expose when the token expires (so then assume)
+    try:
+        expires = client.service_catalog.get_token()['expires']
+        return calendar.timegm(iso8601.parse_date(expires).utctimetuple())
+    except Exception:
+        return time.time() + TOKEN_DEFAULT_LIFETIME
+
+
+def get_token(kclient_v2, auth_url, username, password, tenant_name, cache=None):
+    # The password may be a function that returns it, which is then only
+    # called when a new token is needed (so a cached token avoids asking)
+    if cache:
+        token = cache.get(auth_url, username, tenant_name)
+        if token:
+            LOG.info("Reusing the cached keystone token of %s.", colorizer.quote(username))
+            return token
+    if callable(password):
+        password = password()
+    LOG.info("Getting your keystone token so that requests may proceed.")
+    client = kclient_v2.Client(username=username,
+                               password=password,
+                               tenant_name=tenant_name,
+                               auth_url=auth_url)
+    token = client.auth_token
+    if cache:
+        cache.put(auth_url, username, tenant_name, token, _token_expiry(client))
+    return token
+
+
+class Initializer(object):
+    """
+    Creates (or updates) the keystone catalog; what keystone already has is
+    compared to what is wanted so that only what is missing (or different)
+    is made. Calls that do not depend on each other (for example creating
+    tenants and users) are made concurrently (when more than one worker is
+    allowed) level by level.
+    """
+
+    def __init__(self, service_token, admin_uri, max_workers=1):
+        self.service_token = service_token
+        self.admin_uri = admin_uri
+        self.max_workers = max(1, int(max_workers))
+
+    def _get_client(self):
+        return get_admin_client(self.service_token, self.admin_uri)
+
+    def _run_level(self, level, work):
+        # Runs the functors given (keyed by what they do) and returns what each made,
+        # all the failures (if any) are reported together once all the work
+        # in the level has finished.
+        if not work:
+            return {}
+        LOG.info("Making %s keystone %s calls.", len(work), colorizer.quote(level))
+        results = {}
+        failures = []
+        if self.max_workers > 1 and len(work) > 1:
+            with workers.WorkerPool(min(self.max_workers, len(work)), name='keystone') as pool:
+                jobs = []
+                for (what, functor) in work.items():
+                    jobs.append((what, pool.submit(functor)))
+                for (what, job) in jobs:
+                    try:
+                        results[what] = job.result()
+                    except Exception as e:
+                        failures.append((what, e))
+        else:
+            for (what, functor) in work.items():
+                try:
+                    results[what] = functor()
+                except Exception as e:
+                    failures.append((what, e))
+        if failures:
+            msgs = []
+            for ((kind, name), e) in failures:
+                msgs.append("%s %s: %s" % (kind, name, e))
+            utils.log_iterable(msgs, logger=LOG,
+                               header="Failed %s of %s keystone %s calls" % (len(failures), len(work), level))
+            raise excp.InitializeException("Failed %s of %s keystone %s calls: %s"
+                                           % (len(failures), len(work), level, "; ".join(msgs)),
+                                           failures)
+        return results
+
+    def _create_tenant(self, name, description):
+        return self._get_client().tenants.create(tenant_name=name, description=description, enabled=True)
+
+    def _create_user(self, name, password, email):
+        return self._get_client().users.create(name=name, password=password, email=email)
+
+    def _create_role(self, name):
+        return self._get_client().roles.create(name)
+
+    def _create_service(self, name, service_type, description):
+        return self._get_client().services.create(name=name, service_type=service_type,
+                                                   description=description)
+
+    def _add_user_role(self, user, role, tenant):
+        return self._get_client().roles.add_user_role(user=user, role=role, tenant=tenant)
+
+    def _create_endpoint(self, service, entry):
+        return self._get_client().endpoints.create(region=entry['region'],
+                                                   publicurl=entry['public_url'],
+                                                   adminurl=entry['admin_url'],
+                                                   internalurl=entry['internal_url'],
+                                                   service_id=service.id)
 
-    def _connect_roles(self, users, roles_made, tenants_made, users_made):
-        roles_attached = set()
+    def _add_work(self, work, kind, name, functor, *args):
+        what = (kind, name)
+        if what in work:
+            LOG.warn("Already created %s %s", kind, colorizer.quote(name))
+            return
+        work[what] = functools.partial(functor, *args)
+
+    def _user_roles(self, users, roles, tenants):
+        # Returns the (user, role, tenant) names of each role a user gets
+        user_roles = []
+        tenant_names = set([t['name'] for t in tenants])
         for info in users:
             name = info['name']
-            if name in roles_attached:
-                LOG.warn("Already attached roles to user %s", colorizer.quote(name))
-            roles_attached.add(name)
-            user = users_made[name]
             for role_entry in info['roles']:
                 # Role:Tenant
-                (r, _sep, t) = role_entry.partition(":")
-                role_name = r
-                tenant_name = t
+                (role_name, _sep, tenant_name) = role_entry.partition(":")
                 if not role_name or not tenant_name:
                     raise RuntimeError("Role or tenant name missing for user %s" % (name))
-                if not role_name in roles_made:
+                if role_name not in roles:
                     raise RuntimeError("Role %s not previously created for user %s" % (role_name, name))
-                if not tenant_name in tenants_made:
+                if tenant_name not in tenant_names:
                     raise RuntimeError("Tenant %s not previously created for user %s" % (tenant_name, name))
-                user_role = {
-                    'user': user,
-                    'role': roles_made[role_name],
-                    'tenant': tenants_made[tenant_name],
-                }
-                self.client.roles.add_user_role(**user_role)
-
-    def _create_services(self, services):
-        created_services = dict()
-        for info in services:
-            name = info['name']
-            if name in created_services:
-                LOG.warn("Already created service %s", colorizer.quote(name))
-            service = {
-                'name': name,
-                'service_type': info['type'],
-                'description': info.get('description') or ''
-            }
-            created_services[name] = self.client.services.create(**service)
-        return created_services
+                user_roles.append((name, role_name, tenant_name))
+        return user_roles
+
+    def _fetch_existing(self):
+        # Gets what keystone already has (by kind and name) so that only
+        # what is missing (or different) needs to be made
+        client = self._get_client()
+        existing = {}
+        for (kind, manager) in [('tenant', client.tenants), ('user', client.users),
+                                ('role', client.roles), ('service', client.services)]:
+            for entity in manager.list():
+                existing[(kind, entity.name)] = entity
+        endpoints = {}
+        for endpoint in client.endpoints.list():
+            endpoints[(endpoint.service_id, endpoint.region)] = endpoint
+        LOG.info("Found %s existing keystone entities and %s endpoints.", len(existing), len(endpoints))
+        return (existing, endpoints)
+
+    def _update_tenant(self, tenant, description):
+        self._get_client().tenants.update(tenant.id, description=description)
+        return tenant
+
+    def _update_user(self, user, email=None, password=None):
+        client = self._get_client()
+        if email is not None:
+            client.users.update(user, email=email)
+        if password is not None:
+            client.users.update_password(user, password)
+        return user
+
+    def _replace_service(self, service, name, service_type, description):
+        self._get_client().services.delete(service.id)
+        return self._create_service(name, service_type, description)
+
+    def _replace_endpoint(self, endpoint, service, entry):
+        self._get_client().endpoints.delete(endpoint.id)
+        return self._create_endpoint(service, entry)
+
+    def _roles_for_user(self, user, tenant):
+        return [r.name for r in self._get_client().roles.roles_for_user(user, tenant)]
+
+    def _applied_passwords(self, applied):
+        # Keystone can not tell us the passwords users have, so the ones
+        # from the catalog that was last applied are what is compared with
+        passwords = {}
+        if applied:
+            for entry in applied.get('users') or []:
+                passwords[entry['name']] = entry.get('password')
+        return passwords
 
-    def _create_endpoints(self, endpoints, services):
+    def initialize(self, users, tenants, roles, services, endpoints, applied=None):
+        # Check everything refers to things that will exist before making
+        # any calls so that bad input does not leave a half made catalog
+        user_roles = self._user_roles(users, roles, tenants)
+        applied_passwords = self._applied_passwords(applied)
+        service_names = set([s['name'] for s in services])
         for entry in endpoints:
-            name = entry['service']
-            if name not in services:
-                raise RuntimeError("Endpoint %s not attached to a previously created service" % (name))
-            service = services[name]
-            endpoint = {
-                'region': entry['region'],
-                'publicurl': entry['public_url'],
-                'adminurl': entry['admin_url'],
-                'internalurl': entry['internal_url'],
-                'service_id': service.id,
-            }
-            self.client.endpoints.create(**endpoint)
+            if entry['service'] not in service_names:
+                raise RuntimeError("Endpoint %s not attached to a previously created service" % (entry['service']))
+        (existing, existing_endpoints) = self._fetch_existing()
+
+        # Level 1: things that depend on nothing else
+        work = OrderedDict()
+        for entry in tenants:
+            tenant = existing.get(('tenant', entry['name']))
+            if not tenant:
+                self._add_work(work, 'tenant', entry['name'], self._create_tenant,
+                               entry['name'], entry['description'])
+            elif (getattr(tenant, 'description', None) or '') != (entry['description'] or ''):
+                self._add_work(work, 'tenant', entry['name'], self._update_tenant,
+                               tenant, entry['description'])
+        for entry in users:
+            user = existing.get(('user', entry['name']))
+            if not user:
+                self._add_work(work, 'user', entry['name'], self._create_user,
+                               entry['name'], entry['password'], entry['email'])
+            else:
+                email = None
+                password = None
+                if getattr(user, 'email', None) != entry['email']:
+                    email = entry['email']
+                if entry['name'] not in applied_passwords:
+                    LOG.debug("Not changing the password of existing user %s (its current password is not known).",
+                              colorizer.quote(entry['name']))
+                elif applied_passwords[entry['name']] != entry['password']:
+                    password = entry['password']
+                if email is not None or password is not None:
+                    self._add_work(work, 'user', entry['name'], self._update_user,
+                                   user, email, password)
+        for role in roles:
+            if ('role', role) not in existing:
+                self._add_work(work, 'role', role, self._create_role, role)
+        replaced_services = set()
+        for entry in services:
+            service = existing.get(('service', entry['name']))
+            description = entry.get('description') or ''
+            if not service:
+                self._add_work(work, 'service', entry['name'], self._create_service,
+                               entry['name'], entry['type'], description)
+            elif (getattr(service, 'type', None) != entry['type'] or
+                  (getattr(service, 'description', None) or '') != description):
+                # Services can not be updated (only replaced)
+                replaced_services.add(entry['name'])
+                self._add_work(work, 'service', entry['name'], self._replace_service,
+                               service, entry['name'], entry['type'], description)
+        made = dict(existing)
+        made.update(self._run_level('tenant, user, role and service', work))
+
+        # Find out what roles existing users already have (for the tenants
+        # they are to be bound to) so that those bindings can be skipped
+        work = OrderedDict()
+        for (user_name, _role_name, tenant_name) in user_roles:
+            user_tenant = (user_name, tenant_name)
+            if ('user', user_name) in existing and ('tenant', tenant_name) in existing:
+                if ('roles', user_tenant) not in work:
+                    work[('roles', user_tenant)] = functools.partial(self._roles_for_user,
+                                                                     made[('user', user_name)],
+                                                                     made[('tenant', tenant_name)])
+        has_roles = {}
+        for ((_kind, user_tenant), role_names) in self._run_level('role lookup', work).items():
+            has_roles[user_tenant] = set(role_names)
+
+        # Level 2: things that connect what was made in level 1
+        work = OrderedDict()
+        for (user_name, role_name, tenant_name) in user_roles:
+            if role_name in has_roles.get((user_name, tenant_name), []):
+                continue
+            self._add_work(work, 'user role', "%s:%s:%s" % (user_name, role_name, tenant_name),
+                           self._add_user_role, made[('user', user_name)],
+                           made[('role', role_name)], made[('tenant', tenant_name)])
+        for entry in endpoints:
+            name = "%s:%s" % (entry['service'], entry['region'])
+            service = made[('service', entry['service'])]
+            endpoint = None
+            if entry['service'] not in replaced_services:
+                endpoint = existing_endpoints.get((service.id, entry['region']))
+            if not endpoint:
+                self._add_work(work, 'endpoint', name, self._create_endpoint, service, entry)
+            elif (endpoint.publicurl != entry['public_url'] or endpoint.adminurl != entry['admin_url'] or
+                  endpoint.internalurl != entry['internal_url']):
+                # Endpoints can not be updated (only replaced)
+                self._add_work(work, 'endpoint', name, self._replace_endpoint, endpoint, service, entry)
+        self._run_level('user role and endpoint', work)
+
+
+def hash_password(password, rounds=PASSWORD_HASH_ROUNDS):
+    # Produces what keystone stores (and can verify), a sha512 crypt(3) hash
+    salt_chars = string.ascii_letters + string.digits + './'
+    salt = "".join([random.SystemRandom().choice(salt_chars) for _i in range(0, 16)])
+    hashed = crypt.crypt(password, "$6$rounds=%s$%s$" % (rounds, salt))
+    if not hashed or not hashed.startswith("$6$"):
+        raise RuntimeError("The system crypt(3) does not support sha512 hashing")
+    return hashed
+
+
+class SqlInitializer(object):
+    """
+    Loads the keystone catalog straight into keystones (freshly synced and
+    still empty) database in a single transaction instead of making calls
+    to a running keystone.
+
+    The tables differ between keystone versions so the columns of each are
+    looked up first; values that do not have a column of there own are
+    placed in the tables json 'extra' column (which is what keystone does).
+    """
+
+    def __init__(self, connection, paramstyle='format', quote_char='"',
+                 hash_rounds=PASSWORD_HASH_ROUNDS):
+        self.connection = connection
+        # Some of the table names (user for example) are reserved words
+        self.quote_char = quote_char
+        if paramstyle == 'qmark':
+            self.marker = '?'
+        elif paramstyle in ['format', 'pyformat']:
+            self.marker = '%s'
+        else:
+            raise ValueError("Unsupported parameter style %r" % (paramstyle))
+        self.hash_rounds = hash_rounds
+        self._column_cache = {}
+
+    def _quote(self, name):
+        return "%s%s%s" % (self.quote_char, name, self.quote_char)
+
+    def _columns(self, table):
+        # Returns the column names of the table (or none if it does not exist)
+        if table not in self._column_cache:
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute("SELECT * FROM %s WHERE 1 = 0" % (self._quote(table)))
+                self._column_cache[table] = set([d[0] for d in cursor.description])
+            except Exception:
+                self.connection.rollback()
+                self._column_cache[table] = None
+            finally:
+                cursor.close()
+        return self._column_cache[table]
+
+    def _pick_table(self, *tables):
+        for table in tables:
+            if self._columns(table) is not None:
+                return table
+        raise RuntimeError("None of the keystone tables %s exist (has the database been synced?)"
+                           % (", ".join(tables)))
+
+    def _row(self, table, values):
+        columns = self._columns(table)
+        row = {}
+        extra = {}
+        for (k, v) in values.items():
+            if k in columns:
+                row[k] = v
+            else:
+                extra[k] = v
+        if 'extra' in columns:
+            row['extra'] = json.dumps(extra)
+        elif extra:
+            LOG.debug("Dropping %s values that table %s has no columns for.", extra.keys(), table)
+        return (table, row)
+
+    def _new_id(self):
+        return uuid.uuid4().hex
+
+    def _in_domain(self, table, values):
+        # Newer keystones place projects and users in a domain (the column
+        # can not be left empty), what they make is placed in the default one
+        if 'domain_id' in self._columns(table):
+            values['domain_id'] = DEFAULT_DOMAIN_ID
+        return values
+
+    def render(self, users, tenants, roles, services, endpoints):
+        """
+        Returns the (table, row) inserts that make up the catalog.
+        """
+        rows = []
+        tenant_table = self._pick_table('project', 'tenant')
+        ids = {}
+        for entry in tenants:
+            if ('tenant', entry['name']) in ids:
+                LOG.warn("Already created tenant %s", colorizer.quote(entry['name']))
+                continue
+            tenant_id = ids[('tenant', entry['name'])] = self._new_id()
+            rows.append(self._row(tenant_table, self._in_domain(tenant_table, {
+                'id': tenant_id,
+                'name': entry['name'],
+                'description': entry['description'],
+                'enabled': True,
+            })))
+        for role in roles:
+            if ('role', role) in ids:
+                LOG.warn("Already created role %s", colorizer.quote(role))
+                continue
+            role_id = ids[('role', role)] = self._new_id()
+            rows.append(self._row('role', {
+                'id': role_id,
+                'name': role,
+            }))
+        user_roles = {}
+        for entry in users:
+            if ('user', entry['name']) in ids:
+                LOG.warn("Already created user %s", colorizer.quote(entry['name']))
+                continue
+            user_id = ids[('user', entry['name'])] = self._new_id()
+            rows.append(self._row('user', self._in_domain('user', {
+                'id': user_id,
+                'name': entry['name'],
+                'password': hash_password(entry['password'], self.hash_rounds),
+                'email': entry['email'],
+                'enabled': True,
+            })))
+            for role_entry in entry['roles']:
+                # Role:Tenant
+                (role_name, _sep, tenant_name) = role_entry.partition(":")
+                if ('role', role_name) not in ids:
+                    raise RuntimeError("Role %s not previously created for user %s" % (role_name, entry['name']))
+                if ('tenant', tenant_name) not in ids:
+                    raise RuntimeError("Tenant %s not previously created for user %s" % (tenant_name, entry['name']))
+                role_ids = user_roles.setdefault((user_id, ids[('tenant', tenant_name)]), [])
+                if ids[('role', role_name)] not in role_ids:
+                    role_ids.append(ids[('role', role_name)])
+        # Role bindings are stored as json metadata (and in older versions
+        # also as a membership) for each user and tenant pair
+        meta_table = self._pick_table('user_project_metadata', 'metadata')
+        member_table = None
+        for table in ['user_project_membership', 'user_tenant_membership']:
+            if self._columns(table) is not None:
+                member_table = table
+                break
+        for ((user_id, tenant_id), role_ids) in sorted(user_roles.items()):
+            for table in [meta_table, member_table]:
+                if not table:
+                    continue
+                values = {'user_id': user_id}
+                if 'project_id' in self._columns(table):
+                    values['project_id'] = tenant_id
+                else:
+                    values['tenant_id'] = tenant_id
+                if table == meta_table:
+                    values['data'] = json.dumps({'roles': role_ids})
+                rows.append(self._row(table, values))
+        for entry in services:
+            if ('service', entry['name']) in ids:
+                LOG.warn("Already created service %s", colorizer.quote(entry['name']))
+                continue
+            service_id = ids[('service', entry['name'])] = self._new_id()
+            rows.append(self._row('service', {
+                'id': service_id,
+                'type': entry['type'],
+                'name': entry['name'],
+                'description': entry.get('description') or '',
+            }))
+        per_interface = 'interface' in (self._columns('endpoint') or [])
+        for entry in endpoints:
+            if ('service', entry['service']) not in ids:
+                raise RuntimeError("Endpoint %s not attached to a previously created service" % (entry['service']))
+            service_id = ids[('service', entry['service'])]
+            legacy_id = self._new_id()
+            if not per_interface:
+                rows.append(self._row('endpoint', {
+                    'id': legacy_id,
+                    'region': entry['region'],
+                    'service_id': service_id,
+                    'publicurl': entry['public_url'],
+                    'adminurl': entry['admin_url'],
+                    'internalurl': entry['internal_url'],
+                }))
+                continue
+            # Newer versions have an endpoint per interface
+            for interface in ['public', 'admin', 'internal']:
+                rows.append(self._row('endpoint', {
+                    'id': self._new_id(),
+                    'legacy_endpoint_id': legacy_id,
+                    'interface': interface,
+                    'region': entry['region'],
+                    'service_id': service_id,
+                    'url': entry['%s_url' % (interface)],
+                }))
+        return rows
+
+    def _count(self, table):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("SELECT COUNT(*) FROM %s" % (self._quote(table)))
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
 
     def initialize(self, users, tenants, roles, services, endpoints):
-        created_tenants = self._create_tenants(tenants)
-        created_users = self._create_users(users, created_tenants)
-        created_roles = self._create_roles(roles)
-        self._connect_roles(users, created_roles, created_tenants, created_users)
-        services_made = self._create_services(services)
-        self._create_endpoints(endpoints, services_made)
+        tenant_table = self._pick_table('project', 'tenant')
+        if self._count(tenant_table):
+            raise excp.InitializeException("Keystone database already has a catalog, "
+                                           "sql initialization only works on fresh databases")
+        rows = self.render(users, tenants, roles, services, endpoints)
+        LOG.info("Loading %s keystone catalog rows in one transaction.", len(rows))
+        cursor = self.connection.cursor()
+        try:
+            for (table, row) in rows:
+                columns = sorted(row.keys())
+                sql = "INSERT INTO %s (%s) VALUES (%s)" % (self._quote(table),
+                                                          ", ".join([self._quote(c) for c in columns]),
+                                                          ", ".join([self.marker] * len(columns)))
+                cursor.execute(sql, [row[c] for c in columns])
+            self.connection.commit()
+        except Exception:
+            exc_info = sys.exc_info()
+            self.connection.rollback()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            cursor.close()
+        return len(rows)
 
 
 def get_shared_passwords(component):
@@ -14,13 +14,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import psutil
 import re
 import weakref
 
 from anvil import cfg
 from anvil import exceptions
 from anvil import log as logging
+from anvil import process_table
 from anvil import shell as sh
 from anvil import utils
 
@@ -139,16 +139,14 @@ class NetworkCleaner(object):
         #
         # TODO(harlowja) file a bug to get that fixed...
         to_kill = []
-        for proc in psutil.process_iter():
+        # Taken as root so that the working directories can be looked at
+        with sh.Rooted(True):
+            snapshot = process_table.get_snapshot(max_age=0)
+        for proc in snapshot.processes():
             if proc.name.find("dnsmasq") == -1:
                 continue
-            cwd = ''
-            cmdline = ''
-            with sh.Rooted(True):
-                cwd = proc.getcwd()
-                cmdline = proc.cmdline
             to_try = False
-            for t in [cwd, cmdline]:
+            for t in [proc.cwd or '', " ".join(proc.cmdline)]:
                 if t.lower().find("nova") != -1:
                     to_try = True
             if to_try:
@@ -206,7 +206,7 @@ class HorizonRuntime(comp.ProgramRuntime):
         else:
             return 0
 
-    def status(self):
+    def status(self, details_max=comp.STATUS_DETAILS_MAX):
         status_cmd = self.distro.get_command('apache', 'status')
         (sysout, stderr) = sh.execute(*status_cmd, run_as_root=True, check_exit_code=False)
         combined = (sysout + stderr).lower()
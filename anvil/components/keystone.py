@@ -20,6 +20,7 @@ from anvil import cfg
 from anvil import colorizer
 from anvil import components as comp
 from anvil import log as logging
+from anvil import probes
 from anvil import shell as sh
 from anvil import utils
 
@@ -59,6 +60,38 @@ PKI_FILES = {
     'certfile': 'ssl/certs/signing_cert.pem',
 }
 
+# How keystone gets initialized (through its api or directly in its database)
+INIT_MODE_REST = 'rest'
+INIT_MODE_SQL = 'sql'
+INIT_MODES = [INIT_MODE_REST, INIT_MODE_SQL]
+
+
+def _filter_init(init_what):
+    endpoints = init_what['endpoints']
+    adjusted_endpoints = []
+    # TODO(harlowja) make this better and based off of config...
+    for endpoint in endpoints:
+        if endpoint['service'] in ['swift', 'network']:
+            continue
+        else:
+            adjusted_endpoints.append(endpoint)
+    init_what['endpoints'] = adjusted_endpoints
+    return init_what
+
+
+def _get_init_what(component):
+    # Shared by the installer (for sql initialization) and the runtime
+    (fn, contents) = utils.load_template(component.name, INIT_WHAT_FN)
+    LOG.debug("Initializing with contents of %s", fn)
+    params = {}
+    params['keystone'] = khelper.get_shared_params(**utils.merge_dicts(component.options,
+                                                                       khelper.get_shared_passwords(component)))
+    params['glance'] = ghelper.get_shared_params(ip=component.get_option('ip'), **component.get_option('glance'))
+    params['nova'] = nhelper.get_shared_params(ip=component.get_option('ip'), **component.get_option('nova'))
+    init_what = utils.load_yaml_text(contents)
+    init_what = utils.expand_template_deep(_filter_init(init_what), params)
+    return (params, init_what)
+
 
 class KeystoneUninstaller(comp.PythonUninstallComponent):
     def __init__(self, *args, **kargs):
@@ -80,6 +113,8 @@ class KeystoneInstaller(comp.PythonInstallComponent):
         if self.get_bool_option('db-sync'):
             self._setup_db()
             self._sync_db()
+            if self.get_bool_option('do-init') and self._get_init_mode() == INIT_MODE_SQL:
+                self._init_sql()
         if self.get_bool_option('enable-pki'):
             self._setup_pki()
 
@@ -89,6 +124,35 @@ class KeystoneInstaller(comp.PythonInstallComponent):
         cmds = [{'cmd': sync_cmd, 'run_as_root': True}]
         utils.execute_template(*cmds, cwd=self.bin_dir, params=self.config_params(None))
 
+    def _get_init_mode(self):
+        init_mode = self.get_option('init_mode', default_value=INIT_MODE_REST)
+        if init_mode not in INIT_MODES:
+            raise ValueError("Unknown keystone initialization mode %r (expected one of %s)"
+                             % (init_mode, ", ".join(INIT_MODES)))
+        return init_mode
+
+    def _init_sql(self):
+        # Loads the catalog into the freshly synced database so that the
+        # runtime does not have to make calls to keystone once it starts
+        (_params, init_what) = _get_init_what(self)
+        LOG.info("Initializing keystone directly in database: %s", colorizer.quote(DB_NAME))
+        dbtype = self.get_option('db', 'type')
+        (conn, paramstyle) = dbhelper.connect(dbtype=dbtype,
+                                              dbname=DB_NAME,
+                                              **utils.merge_dicts(self.get_option('db'),
+                                                                  dbhelper.get_shared_passwords(self)))
+        try:
+            quote_char = '"'
+            if dbtype == 'mysql':
+                quote_char = '`'
+            initializer = khelper.SqlInitializer(conn, paramstyle, quote_char=quote_char)
+            initializer.initialize(**init_what)
+        finally:
+            conn.close()
+        # The runtime will now see that initialization already happened
+        init_fn = sh.joinpths(self.get_option('trace_dir'), INIT_WHAT_HAPPENED)
+        sh.write_file(init_fn, utils.prettify_yaml(init_what))
+
     @property
     def env_exports(self):
         params = khelper.get_shared_params(**utils.merge_dicts(self.options,
@@ -209,41 +273,28 @@ class KeystoneRuntime(comp.PythonRuntime):
         self.bin_dir = sh.joinpths(self.get_option('app_dir'), 'bin')
         self.init_fn = sh.joinpths(self.get_option('trace_dir'), INIT_WHAT_HAPPENED)
 
-    def _filter_init(self, init_what):
-        endpoints = init_what['endpoints']
-        adjusted_endpoints = []
-        # TODO(harlowja) make this better and based off of config...
-        for endpoint in endpoints:
-            if endpoint['service'] in ['swift', 'network']:
-                continue
-            else:
-                adjusted_endpoints.append(endpoint)
-        init_what['endpoints'] = adjusted_endpoints
-        return init_what
-
     def post_start(self):
-        if not sh.isfile(self.init_fn) and self.get_bool_option('do-init'):
-            self.wait_active()
-            LOG.info("Running commands to initialize keystone.")
-            (fn, contents) = utils.load_template(self.name, INIT_WHAT_FN)
-            LOG.debug("Initializing with contents of %s", fn)
-            params = {}
-            params['keystone'] = khelper.get_shared_params(**utils.merge_dicts(self.options, khelper.get_shared_passwords(self)))
-            params['glance'] = ghelper.get_shared_params(ip=self.get_option('ip'), **self.get_option('glance'))
-            params['nova'] = nhelper.get_shared_params(ip=self.get_option('ip'), **self.get_option('nova'))
-            wait_urls = [
-                params['keystone']['endpoints']['admin']['uri'],
-                params['keystone']['endpoints']['public']['uri'],
-            ]
-            for url in wait_urls:
-                utils.wait_for_url(url)
-            init_what = utils.load_yaml_text(contents)
-            init_what = utils.expand_template_deep(self._filter_init(init_what), params)
-            khelper.Initializer(params['keystone']['service_token'],
-                                params['keystone']['endpoints']['admin']['uri']).initialize(**init_what)
-            # Writing this makes sure that we don't init again
-            sh.write_file(self.init_fn, utils.prettify_yaml(init_what))
-            LOG.info("If you wish to re-run initialization, delete %s", colorizer.quote(self.init_fn))
+        if not self.get_bool_option('do-init'):
+            return
+        (params, init_what) = _get_init_what(self)
+        applied = None
+        if sh.isfile(self.init_fn):
+            applied = utils.load_yaml(self.init_fn)
+            if applied == init_what:
+                LOG.info("Keystone was already initialized with the same catalog (see %s).", colorizer.quote(self.init_fn))
+                return
+            LOG.info("Keystone catalog has changed since it was last initialized, updating it.")
+        self.wait_active()
+        LOG.info("Running commands to initialize keystone.")
+        initializer = khelper.Initializer(params['keystone']['service_token'],
+                                          params['keystone']['endpoints']['admin']['uri'],
+                                          max_workers=self.get_int_option('init_workers', default_value=1))
+        # What was applied before is given so that changed passwords are found
+        initializer.initialize(applied=applied, **init_what)
+        # Writing this makes sure that we don't init again (unless the catalog changes)
+        sh.write_file(self.init_fn, utils.prettify_yaml(init_what))
+        LOG.info("Keystone will only be initialized again if its catalog changes (or %s is deleted).",
+                 colorizer.quote(self.init_fn))
 
     @property
     def apps_to_start(self):
@@ -258,6 +309,15 @@ class KeystoneRuntime(comp.PythonRuntime):
                 })
         return apps
 
+    def app_probes(self, app_name):
+        app_probes = comp.PythonRuntime.app_probes(self, app_name)
+        if app_name == 'keystone-all':
+            params = khelper.get_shared_params(**utils.merge_dicts(self.options,
+                                                                   khelper.get_shared_passwords(self)))
+            for endpoint in ['admin', 'public']:
+                app_probes.append(probes.HttpProbe(params['endpoints'][endpoint]['uri']))
+        return app_probes
+
     def app_options(self, app):
         return [
             '--config-file=%s' % (sh.joinpths('$CONFIG_DIR', ROOT_CONF)),
@@ -26,6 +26,7 @@ from anvil import colorizer
 from anvil import components as comp
 from anvil import exceptions as excp
 from anvil import log as logging
+from anvil import probes
 from anvil import shell as sh
 from anvil import utils
 
@@ -47,6 +48,7 @@ POLICY_CONF = 'policy.json'
 LOGGING_CONF = "logging.conf"
 CONFIGS = [PASTE_CONF, POLICY_CONF, LOGGING_CONF, API_CONF]
 ADJUST_CONFIGS = [PASTE_CONF]
+API_ONLY_CONFIGS = [PASTE_CONF, POLICY_CONF]
 
 # This is a special marker file that when it exists, signifies that nova net was inited
 NET_INITED_FN = 'nova.network.inited.yaml'
@@ -251,6 +253,13 @@ class NovaRuntime(comp.PythonRuntime):
         self.bin_dir = sh.joinpths(self.get_option('app_dir'), BIN_DIR)
         self.net_init_fn = sh.joinpths(self.get_option('trace_dir'), NET_INITED_FN)
 
+    def config_inputs(self, app_name=None):
+        inputs = comp.PythonRuntime.config_inputs(self, app_name)
+        if app_name and not app_name.startswith('nova-api'):
+            # Only the apis use the paste configuration (and its policy)
+            inputs = [fn for fn in inputs if sh.basename(fn) not in API_ONLY_CONFIGS]
+        return inputs
+
     def _do_network_init(self):
         ran_fn = self.net_init_fn
         if not sh.isfile(ran_fn) and self.get_bool_option('do-network-init'):
@@ -294,9 +303,14 @@ class NovaRuntime(comp.PythonRuntime):
             real_name = "nova-%s" % (name)
             app_pth = sh.joinpths(self.bin_dir, real_name)
             if sh.is_executable(app_pth):
+                # The apis are started (and become ready) before the rest
+                start_group = 1
+                if name.startswith('api'):
+                    start_group = 0
                 apps.append({
                     'name': real_name,
                     'path': app_pth,
+                    'start_group': start_group,
                 })
         return apps
 
@@ -322,6 +336,14 @@ class NovaRuntime(comp.PythonRuntime):
         params['CFG_FILE'] = self.config_path
         return params
 
+    def app_probes(self, app_name):
+        app_probes = comp.PythonRuntime.app_probes(self, app_name)
+        if app_name == 'nova-api-os-compute':
+            app_probes.append(probes.TcpProbe(self.get_option('api_host'), self.get_option('api_port')))
+        elif app_name == 'nova-api-ec2':
+            app_probes.append(probes.TcpProbe(self.get_option('ec2_host'), self.get_option('ec2_port')))
+        return app_probes
+
     def app_options(self, app):
         return ['--config-file', '$CFG_FILE']
 
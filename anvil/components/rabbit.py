@@ -91,7 +91,7 @@ class RabbitRuntime(comp.ProgramRuntime):
     def apps_to_start(self):
         return ['rabbit-mq']
 
-    def status(self):
+    def status(self, details_max=comp.STATUS_DETAILS_MAX):
         # This has got to be the worst status output.
         #
         # I have ever seen (its like a weird mix json+crap)
@@ -184,8 +184,8 @@ class YumPackagerWithRelinks(yum.YumPackager):
             if sh.islink(entry['target']):
                 sh.unlink(entry['target'])
 
-    def _install(self, pkg):
-        yum.YumPackager._install(self, pkg)
+    def _installed(self, pkg):
+        yum.YumPackager._installed(self, pkg)
         options = pkg.get('packager_options') or {}
         links = options.get('links') or []
         for entry in links:
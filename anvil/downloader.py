@@ -17,18 +17,28 @@
 import abc
 import contextlib
 import functools
-import urllib2
+import httplib
+import threading
 
 from urlparse import parse_qs
 
 import progressbar
 
 from anvil import colorizer
+from anvil import exceptions as excp
+from anvil import http_pool
 from anvil import log as logging
 from anvil import shell as sh
+from anvil import workers
 
 LOG = logging.getLogger(__name__)
 
+# How much is read (and written) at once when fetching
+CHUNK_SIZE = 64 * 1024
+
+# Segmented downloads will not split into pieces smaller than this
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
 
 class Downloader(object):
     __metaclass__ = abc.ABCMeta
@@ -94,6 +104,15 @@ class UrlLibDownloader(Downloader):
         Downloader.__init__(self, uri, store_where)
         self.quiet = kargs.get('quiet', False)
         self.timeout = kargs.get('timeout', 5)
+        if 'timeout' in kargs:
+            self.pool = http_pool.ConnectionPool(timeout=self.timeout)
+        else:
+            self.pool = http_pool.get_pool()
+        # Opt-in to fetching byte ranges over multiple connections
+        self.segments = max(1, int(kargs.get('segments', 1)))
+        self.min_segment_size = max(1, int(kargs.get('min_segment_size', MIN_SEGMENT_SIZE)))
+        # Leave holes (instead of writing) where the content is all zeros
+        self.sparse = kargs.get('sparse', False)
 
     def _make_bar(self, size):
         widgets = [
@@ -104,8 +123,89 @@ class UrlLibDownloader(Downloader):
         ]
         return progressbar.ProgressBar(widgets=widgets, maxval=size)
 
-    def download(self):
-        LOG.info('Downloading using urllib2: %s to %s.', colorizer.quote(self.uri), colorizer.quote(self.store_where))
+    def _start_bar(self, size):
+        if self.quiet or size is None:
+            return None
+        p_bar = self._make_bar(size)
+        p_bar.start()
+        return p_bar
+
+    def _probe(self):
+        # Find out how big the target is and if it can be fetched in pieces
+        with contextlib.closing(self.pool.request('HEAD', self.uri)) as conn:
+            conn.read()
+            if conn.getcode() != 200:
+                return (None, False)
+            c_len = conn.headers.get('content-length')
+            ranges = conn.headers.get('accept-ranges') or ''
+        try:
+            c_len = int(c_len)
+        except (TypeError, ValueError):
+            c_len = None
+        return (c_len, ranges.strip().lower() == 'bytes')
+
+    def _split(self, size):
+        # Byte ranges (inclusive) that each connection will fetch
+        segments = min(self.segments, max(1, size // self.min_segment_size))
+        seg_size = size // segments
+        ranges = []
+        for i in range(0, segments):
+            start = i * seg_size
+            if i == segments - 1:
+                end = size - 1
+            else:
+                end = start + seg_size - 1
+            ranges.append((start, end))
+        return ranges
+
+    def _fetch_segment(self, start, end, chunk_cb):
+        headers = {
+            'Range': 'bytes=%s-%s' % (start, end),
+        }
+        with contextlib.closing(self.pool.request('GET', self.uri, headers=headers)) as conn:
+            if conn.getcode() != 206:
+                raise excp.DownloadException("Server did not honor range request %s-%s for %s (code %s)"
+                                             % (start, end, self.uri, conn.getcode()))
+            with open(self.store_where, 'r+b') as ofh:
+                ofh.seek(start)
+                wanted = end - start + 1
+                got = sh.pipe_in_out(conn, ofh, chunk_size=CHUNK_SIZE, chunk_cb=chunk_cb,
+                                     sparse=self.sparse)
+                if got != wanted:
+                    raise excp.DownloadException("Range %s-%s of %s was %s bytes instead of %s bytes"
+                                                 % (start, end, self.uri, got, wanted))
+                return got
+
+    def _download_segmented(self, size):
+        ranges = self._split(size)
+        LOG.info('Downloading using %s connections: %s to %s.', len(ranges),
+                 colorizer.quote(self.uri), colorizer.quote(self.store_where))
+        # Preallocate so that each connection can write into its own slice
+        with open(self.store_where, 'wb') as ofh:
+            ofh.truncate(size)
+        p_bar = self._start_bar(size)
+        progress = {}
+        p_lock = threading.Lock()
+
+        def update_bar(start, bytes_down):
+            with p_lock:
+                progress[start] = bytes_down
+                if p_bar:
+                    p_bar.update(sum(progress.values()))
+
+        try:
+            with workers.WorkerPool(len(ranges), name='download') as pool:
+                jobs = []
+                for (start, end) in ranges:
+                    jobs.append(pool.submit(self._fetch_segment, start, end,
+                                            functools.partial(update_bar, start)))
+                return (self.store_where, sum(workers.wait_all(jobs)))
+        finally:
+            if p_bar:
+                p_bar.finish()
+
+    def _download_single(self):
+        LOG.info('Downloading using http: %s to %s.', colorizer.quote(self.uri), colorizer.quote(self.store_where))
         p_bar = None
 
         def update_bar(progress_bar, bytes_down):
@@ -113,17 +213,38 @@ class UrlLibDownloader(Downloader):
                 progress_bar.update(bytes_down)
 
         try:
-            with contextlib.closing(urllib2.urlopen(self.uri, timeout=self.timeout)) as conn:
+            with contextlib.closing(self.pool.request('GET', self.uri)) as conn:
+                if conn.getcode() != 200:
+                    raise IOError("Fetching %s failed with code %s" % (self.uri, conn.getcode()))
                 c_len = conn.headers.get('content-length')
                 if c_len is not None:
                     try:
-                        p_bar = self._make_bar(int(c_len))
-                        p_bar.start()
+                        p_bar = self._start_bar(int(c_len))
                     except ValueError:
                         pass
                 with open(self.store_where, 'wb') as ofh:
-                    return (self.store_where, sh.pipe_in_out(conn, ofh,
-                                                             chunk_cb=functools.partial(update_bar, p_bar)))
+                    return (self.store_where, sh.pipe_in_out(conn, ofh, chunk_size=CHUNK_SIZE,
+                                                             chunk_cb=functools.partial(update_bar, p_bar),
+                                                             sparse=self.sparse))
         finally:
             if p_bar:
                 p_bar.finish()
+
+    def download(self):
+        if self.segments > 1:
+            try:
+                (size, ranged) = self._probe()
+            except (IOError, httplib.HTTPException) as e:
+                LOG.debug("Probing %s for range support failed: %s", self.uri, e)
+                (size, ranged) = (None, False)
+            if not ranged or not size:
+                LOG.debug("Url %s does not support range requests, using a single connection.", self.uri)
+            elif size < (2 * self.min_segment_size):
+                LOG.debug("Url %s is too small (%s bytes) to be worth segmenting.", self.uri, size)
+            else:
+                try:
+                    return self._download_segmented(size)
+                except (excp.DownloadException, IOError, httplib.HTTPException) as e:
+                    LOG.warn("Segmented download of %s failed, retrying with a single connection: %s",
+                             colorizer.quote(self.uri), e)
+        return self._download_single()
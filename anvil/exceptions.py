@@ -83,6 +83,13 @@ class DependencyException(AnvilException):
     pass
 
 
+class InitializeException(AnvilException):
+    def __init__(self, message, failures=None):
+        AnvilException.__init__(self, message)
+        # List of (what, exception) that caused this
+        self.failures = list(failures or [])
+
+
 class ProcessExecutionError(IOError):
     def __init__(self, stdout=None, stderr=None,
                  exit_code=None, cmd=None,
@@ -0,0 +1,218 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import httplib
+import socket
+import threading
+import urllib
+import urlparse
+
+from anvil import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# Codes that we will follow to a new location
+REDIRECT_CODES = [301, 302, 303, 307]
+
+# Servers that do not do HEAD requests respond with these
+NO_HEAD_CODES = [405, 501]
+
+
+class PooledResponse(object):
+    """
+    Wraps a httplib response so that its connection is returned to the pool
+    (for reuse) once the response body has been completely read.
+    """
+
+    def __init__(self, pool, key, pooled, response, url):
+        self.pool = pool
+        self.key = key
+        self.pooled = pooled
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = dict(response.getheaders())
+
+    def getcode(self):
+        return self.status
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amount=None):
+        if self.pooled is None:
+            return ''
+        try:
+            if amount is None:
+                data = self.response.read()
+            else:
+                data = self.response.read(amount)
+        except (socket.error, httplib.HTTPException):
+            self._release(reuse=False)
+            raise
+        if amount is None or not data:
+            self._release(reuse=True)
+        return data
+
+    def _release(self, reuse):
+        if self.pooled is None:
+            return
+        (pooled, self.pooled) = (self.pooled, None)
+        if reuse and self.response.isclosed() and not self.response.will_close:
+            self.pool.put(self.key, pooled)
+        else:
+            pooled[0].close()
+
+    def close(self):
+        # Closing before reading everything means the connection can not
+        # be reused (since it still has response data pending on it)
+        self._release(reuse=self.response.isclosed())
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle keep-alive connections around (per scheme, host and port) so
+    that repeated requests to the same services do not pay for new
+    connections each time.
+    """
+
+    def __init__(self, timeout=5, max_idle=4, max_redirects=5):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_redirects = max_redirects
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _key(self, url):
+        parsed = urlparse.urlparse(url)
+        scheme = (parsed.scheme or 'http').lower()
+        if scheme not in ['http', 'https']:
+            raise IOError("Unsupported url scheme %r in %s" % (scheme, url))
+        port = parsed.port
+        if port is None:
+            if scheme == 'https':
+                port = httplib.HTTPS_PORT
+            else:
+                port = httplib.HTTP_PORT
+        return (scheme, parsed.hostname, port)
+
+    def _make_conn(self, key):
+        (scheme, host, port) = key
+        proxy = None
+        if not urllib.proxy_bypass(host):
+            proxy = urllib.getproxies().get(scheme)
+        if scheme == 'https':
+            conn_cls = httplib.HTTPSConnection
+        else:
+            conn_cls = httplib.HTTPConnection
+        if not proxy:
+            return (conn_cls(host, port, timeout=self.timeout), False)
+        p_parsed = urlparse.urlparse(proxy)
+        conn = conn_cls(p_parsed.hostname, p_parsed.port, timeout=self.timeout)
+        if scheme == 'https':
+            conn.set_tunnel(host, port)
+            return (conn, False)
+        # Plain http proxies want the absolute url in the request line
+        return (conn, True)
+
+    def _take(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return None
+
+    def put(self, key, pooled):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(pooled)
+                return
+        pooled[0].close()
+
+    def clear(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for (conn, _absolute) in idle:
+                    conn.close()
+            self._idle.clear()
+
+    def _send(self, method, url, headers):
+        key = self._key(url)
+        parsed = urlparse.urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += "?" + parsed.query
+        pooled = self._take(key)
+        reused = pooled is not None
+        if not reused:
+            pooled = self._make_conn(key)
+        while True:
+            (conn, absolute) = pooled
+            try:
+                if absolute:
+                    conn.request(method, url, headers=headers)
+                else:
+                    conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                return PooledResponse(self, key, pooled, response, url)
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                # A reused connection may have been closed by the server
+                # while it was sitting idle, so retry using a new one...
+                pooled = self._make_conn(key)
+                reused = False
+
+    def request(self, method, url, headers=None):
+        # Returns a response (following redirects) which must be read
+        # completely or closed by the caller.
+        for _i in range(0, self.max_redirects + 1):
+            response = self._send(method, url, dict(headers or {}))
+            if response.status not in REDIRECT_CODES:
+                return response
+            location = response.getheader('location')
+            response.read()
+            if not location:
+                return response
+            new_url = urlparse.urljoin(url, location)
+            LOG.debug("Following %s redirect from %s to %s", response.status, url, new_url)
+            url = new_url
+        raise IOError("Too many redirects (%s) fetching %s" % (self.max_redirects, url))
+
+    def probe(self, url):
+        # Sees if a url is responding (returning the status code) without
+        # fetching its whole body, using a HEAD request if possible and
+        # otherwise a GET request where only the first byte is read.
+        response = self.request('HEAD', url)
+        response.read()
+        if response.status not in NO_HEAD_CODES:
+            return response.status
+        response = self.request('GET', url)
+        try:
+            response.read(1)
+        finally:
+            response.close()
+        return response.status
+
+
+# Shared by the various users of http so that connections get reused
+_POOL = ConnectionPool()
+
+
+def get_pool():
+    return _POOL
@@ -0,0 +1,204 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import abc
+import csv
+import json
+import os
+
+from anvil import log as logging
+from anvil import process_table
+
+LOG = logging.getLogger(__name__)
+
+# What each sample contains (in the order written out)
+FIELDS = ['time', 'component', 'app', 'pid', 'processes',
+          'cpu_percent', 'rss', 'fds', 'threads']
+
+# Table columns (heading, field, width)
+COLUMNS = [
+    ('COMPONENT', 'component', 12),
+    ('APP', 'app', 22),
+    ('PID', 'pid', 7),
+    ('PROCS', 'processes', 5),
+    ('CPU%', 'cpu_percent', 6),
+    ('RSS', 'rss', 8),
+    ('FDS', 'fds', 5),
+    ('THREADS', 'threads', 7),
+]
+
+
+class Sampler(object):
+    """
+    Samples the resource usage of apps (and the processes they have
+    created) from a single (stat only) scan of the process table each time
+    it is asked to, cpu usage is computed from the cpu time used since the
+    previous sample (or since the process started on the first sample).
+    """
+
+    def __init__(self, proc_dir=process_table.PROC_DIR):
+        self.proc_dir = proc_dir
+        self._cpu_times = {}
+
+    def _tree(self, snapshot, pid, children):
+        info = snapshot.get(pid)
+        if info is None or info.is_zombie:
+            return []
+        tree = [info]
+        pending = [info.pid]
+        while pending:
+            for child in children.get(pending.pop(), []):
+                if not child.is_zombie:
+                    tree.append(child)
+                    pending.append(child.pid)
+        return tree
+
+    def _cpu_percent(self, info, now, cpu_times):
+        key = (info.pid, info.start_time)
+        cpu_times[key] = (info.cpu_time, now)
+        (prior_cpu_time, prior_when) = self._cpu_times.get(key, (0.0, info.start_time))
+        elapsed = now - prior_when
+        if elapsed <= 0:
+            return 0.0
+        return max(0.0, 100.0 * (info.cpu_time - prior_cpu_time) / elapsed)
+
+    def snapshot(self):
+        # The (stat only) scan that a sample is taken from, which can also
+        # be used to find the targets of that sample (without scanning again)
+        return process_table.Snapshot(self.proc_dir, details=False).refresh()
+
+    def sample(self, targets, snapshot=None):
+        # Given (component, app, pid) tuples returns a sample (dictionary
+        # with the above fields) for each, apps that are not running have
+        # there usage fields left empty
+        if snapshot is None:
+            snapshot = self.snapshot()
+        now = snapshot.taken
+        children = {}
+        for info in snapshot.processes():
+            children.setdefault(info.ppid, []).append(info)
+        cpu_times = {}
+        samples = []
+        for (component, app, pid) in targets:
+            sample = dict((f, None) for f in FIELDS)
+            sample.update({
+                'time': now,
+                'component': component,
+                'app': app,
+                'pid': pid,
+            })
+            tree = []
+            if pid:
+                tree = self._tree(snapshot, pid, children)
+            if tree:
+                sample['processes'] = len(tree)
+                sample['cpu_percent'] = round(sum([self._cpu_percent(info, now, cpu_times) for info in tree]), 1)
+                sample['rss'] = sum([info.rss for info in tree])
+                sample['threads'] = sum([info.num_threads for info in tree])
+                fds = [snapshot.open_fds(info.pid) for info in tree]
+                fds = [f for f in fds if f is not None]
+                if fds:
+                    sample['fds'] = sum(fds)
+            samples.append(sample)
+        # Only what was just seen needs to be remembered
+        self._cpu_times = cpu_times
+        return samples
+
+
+def _format_size(size):
+    for (suffix, amount) in [('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024)]:
+        if size >= amount:
+            return "%.1f%s" % (float(size) / amount, suffix)
+    return "%sB" % (size)
+
+
+def _format_value(field, value):
+    if value is None:
+        return '-'
+    if field == 'rss':
+        return _format_size(value)
+    return str(value)
+
+
+def format_table(samples):
+    # Returns the lines of a compact (fixed width) table of the samples
+    lines = []
+    heading = []
+    for (title, _field, width) in COLUMNS:
+        heading.append(title.ljust(width))
+    lines.append(" ".join(heading).rstrip())
+    for sample in samples:
+        row = []
+        for (_title, field, width) in COLUMNS:
+            value = _format_value(field, sample.get(field))
+            if len(value) > width:
+                value = value[0:width - 1] + "~"
+            row.append(value.ljust(width))
+        lines.append(" ".join(row).rstrip())
+    return lines
+
+
+class SampleWriter(object):
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fh = None
+
+    def _open(self):
+        if self._fh is None:
+            self._fh = open(self.filename, 'ab')
+        return self._fh
+
+    @abc.abstractmethod
+    def _write(self, fh, samples):
+        raise NotImplementedError()
+
+    def write(self, samples):
+        fh = self._open()
+        self._write(fh, samples)
+        # Flushed each time so that the samples can be looked at (or
+        # followed) while they are being taken
+        fh.flush()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class CsvSampleWriter(SampleWriter):
+    def _write(self, fh, samples):
+        writer = csv.DictWriter(fh, FIELDS)
+        if os.fstat(fh.fileno()).st_size == 0:
+            writer.writerow(dict((f, f) for f in FIELDS))
+        for sample in samples:
+            writer.writerow(sample)
+
+
+class JsonSampleWriter(SampleWriter):
+    def _write(self, fh, samples):
+        for sample in samples:
+            fh.write(json.dumps(sample, sort_keys=True))
+            fh.write("\n")
+
+
+def make_writer(filename):
+    # Samples are written as csv into files ending with '.csv' and as json
+    # lines (one sample per line) into anything else
+    if filename.lower().endswith('.csv'):
+        return CsvSampleWriter(filename)
+    return JsonSampleWriter(filename)
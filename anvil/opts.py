@@ -97,6 +97,12 @@ def parse(previous_settings=None):
                           dest="dir",
                           metavar="DIR",
                           help=("empty root DIR or DIR with existing components"))
+    base_group.add_option("-b", "--background",
+                          action="store_true",
+                          dest="background",
+                          default=False,
+                          help=("run build steps (compiles, installs and packaging) at the lowest"
+                                " cpu and io priority so that they do not slow down running programs"))
     parser.add_option_group(base_group)
 
     suffixes = ("Known suffixes 'K' (kilobyte, 1024),"
@@ -110,6 +116,28 @@ def parse(previous_settings=None):
                             metavar="SIZE",
                             callback=_size_cb,
                             help="show SIZE 'details' when showing component status. " + suffixes)
+    status_group.add_option("--watch",
+                            action="store",
+                            type="float",
+                            dest="watch_interval",
+                            default=0,
+                            metavar="SECONDS",
+                            help=("show the cpu, memory, open files and threads used by the"
+                                  " started programs every SECONDS (until interrupted)"))
+    status_group.add_option("--watch-count",
+                            action="store",
+                            type="int",
+                            dest="watch_count",
+                            default=0,
+                            metavar="COUNT",
+                            help="stop watching after COUNT samples (default: %default, meaning never)")
+    status_group.add_option("--watch-file",
+                            action="store",
+                            type="string",
+                            dest="watch_file",
+                            metavar="FILE",
+                            help=("append the samples taken while watching to FILE (as csv"
+                                  " when FILE ends with '.csv' and as json lines otherwise)"))
     parser.add_option_group(status_group)
 
     pkg_group = OptionGroup(parser, "Packaging specific options")
@@ -155,9 +183,13 @@ def parse(previous_settings=None):
     values['only_configure'] = options.only_configure
     values['prompt_for_passwords'] = options.prompt_for_passwords
     values['show_amount'] = max(0, options.show_amount)
+    values['watch_interval'] = max(0, options.watch_interval)
+    values['watch_count'] = max(0, options.watch_count)
+    values['watch_file'] = options.watch_file
     values['store_passwords'] = options.store_passwords
     values['match_installed'] = options.match_installed
     values['purge_packages'] = options.purge_packages
+    values['background'] = options.background
     values['keyring_path'] = options.keyring_path
     values['keyring_encrypted'] = options.keyring_encrypted
     return values
@@ -43,6 +43,12 @@ class Packager(object):
         else:
             LOG.debug("Skipping install of %r since %s is already there.", pkg['name'], installed_already)
 
+    def install_batch(self, pkgs):
+        # Packagers that can install many packages at once (in one
+        # transaction) should override this to do so
+        for pkg in pkgs:
+            self.install(pkg)
+
     def remove(self, pkg):
         should_remove = self.remove_default
         if 'removable' in pkg:
@@ -14,6 +14,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import fnmatch
+
 from anvil import shell as sh
 
 # See http://yum.baseurl.org/api/yum-3.2.26/yum-module.html
@@ -21,6 +23,27 @@ from yum import YumBase
 
 from yum.packages import PackageObject
 
+# Characters that make a name a (shell style) pattern
+GLOB_CHARS = '*?['
+
+
+def _name_forms(pkg):
+    # The forms of a packages name (besides the name itself) that yum
+    # matches what it is given against
+    return [
+        "%s.%s" % (pkg.name, pkg.arch),
+        "%s-%s" % (pkg.name, pkg.version),
+        "%s-%s-%s" % (pkg.name, pkg.version, pkg.release),
+        "%s-%s-%s.%s" % (pkg.name, pkg.version, pkg.release, pkg.arch),
+    ]
+
+
+def _matches(pkg, pattern):
+    for form in [pkg.name] + _name_forms(pkg):
+        if fnmatch.fnmatchcase(form.lower(), pattern):
+            return True
+    return False
+
 
 class Requirement(object):
     def __init__(self, name, version):
@@ -49,6 +72,8 @@ class Requirement(object):
 class Helper(object):
     # Cache of yumbase object
     _yum_base = None
+    # Cache of whats installed (lowercased name -> installed packages)
+    _installed_cache = None
 
     @staticmethod
     def _get_yum_base():
@@ -61,23 +86,60 @@ class Helper(object):
             Helper._yum_base = _yum_base
         return Helper._yum_base
 
-    def is_installed(self, name):
-        if len(self.get_installed(name)):
-            return True
-        else:
-            return False
-
-    def get_installed(self, name):
+    def _list_installed(self):
         base = Helper._get_yum_base()
         # This 'root' seems needed...
         # otherwise 'cannot open Packages database in /var/lib/rpm' starts to happen
         # even though we are just doing a read-only operation, which
         # is pretty odd...
         with sh.Rooted(True):
-            pkgs = base.doPackageLists(pkgnarrow='installed',
-                                       ignore_case=True, patterns=[name])
+            pkgs = base.doPackageLists(pkgnarrow='installed')
             if pkgs.installed:
                 whats_installed = list(pkgs.installed)
             else:
                 whats_installed = []
-        return whats_installed
+        installed = {}
+        for p in whats_installed:
+            installed.setdefault(p.name.lower(), []).append(p)
+        return installed
+
+    def uncache(self):
+        # Called after yum has changed what is installed, the rpm database
+        # yum has open is also closed so that it gets reread (instead of
+        # yum answering from what it read before)
+        Helper._installed_cache = None
+        if Helper._yum_base is not None:
+            Helper._yum_base.closeRpmDB()
+
+    def whats_installed(self):
+        # The whole rpm database is read once (instead of querying it for
+        # each package) and then looked up by name until it changes
+        if Helper._installed_cache is None:
+            Helper._installed_cache = self._list_installed()
+        return Helper._installed_cache
+
+    def is_installed(self, name):
+        if len(self.get_installed(name)):
+            return True
+        else:
+            return False
+
+    def get_installed(self, name):
+        # Plain names are looked up directly, anything else is matched like
+        # yum would (as a glob or a 'name.arch', 'name-version'... form) but
+        # not against the forms that start with an epoch
+        name = str(name).lower()
+        installed = self.whats_installed()
+        if name in installed:
+            return list(installed[name])
+        if [c for c in GLOB_CHARS if c in name]:
+            candidates = []
+            for pkgs in installed.values():
+                candidates.extend(pkgs)
+        else:
+            # The other forms all start with the name of the package
+            candidates = []
+            for (i, c) in enumerate(name):
+                if c in '.-':
+                    candidates.extend(installed.get(name[0:i], []))
+        return [p for p in candidates if _matches(p, name)]
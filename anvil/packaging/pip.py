@@ -76,7 +76,8 @@ class Packager(pack.Packager):
             pip_cmd = [pip_cmd]
         pip_cmd = pip_cmd + cmd
         try:
-            sh.execute(*pip_cmd, run_as_root=True)
+            sh.execute(*pip_cmd, run_as_root=True,
+                       scheduling=sh.get_build_scheduling())
         finally:
             # The known packages installed is probably
             # not consistent anymore so uncache it
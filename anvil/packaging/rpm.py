@@ -315,4 +315,4 @@ class PythonPackager(DependencyPackager):
 
 def tar_it(to_where, what, wkdir):
     tar_cmd = ['tar', '-cvzf', to_where, what]
-    return sh.execute(*tar_cmd, cwd=wkdir)
+    return sh.execute(*tar_cmd, cwd=wkdir, scheduling=sh.get_build_scheduling())
@@ -14,6 +14,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from anvil import colorizer
 from anvil import log as logging
 from anvil import packager as pack
 from anvil import shell as sh
@@ -64,8 +65,12 @@ class YumPackager(pack.Packager):
 
     def _execute_yum(self, cmd, **kargs):
         yum_cmd = YUM_CMD + cmd
-        return sh.execute(*yum_cmd, run_as_root=True,
-                          check_exit_code=True, **kargs)
+        try:
+            return sh.execute(*yum_cmd, run_as_root=True,
+                              check_exit_code=True, **kargs)
+        finally:
+            # Even a failed run may have changed what is installed
+            self.helper.uncache()
 
     def _remove_special(self, name, info):
         return False
@@ -73,6 +78,10 @@ class YumPackager(pack.Packager):
     def _install_special(self, name, info):
         return False
 
+    def _installed(self, pkg):
+        # Called after yum has installed the package (alone or in a batch)
+        pass
+
     def _install(self, pkg):
         req = extract_requirement(pkg)
         if self._install_special(req.name, pkg):
@@ -80,6 +89,32 @@ class YumPackager(pack.Packager):
         else:
             cmd = YUM_INSTALL + [str(req)]
             self._execute_yum(cmd)
+            self._installed(pkg)
+
+    def install_batch(self, pkgs):
+        # Each yum run reads the rpm database and repository metadata and
+        # resolves dependencies, so this is done once for all the packages
+        # which are not already installed (instead of once per package)
+        to_install = []
+        reqs = []
+        for pkg in pkgs:
+            installed_already = self._anything_there(pkg)
+            if installed_already:
+                LOG.debug("Skipping install of %r since %s is already there.", pkg['name'], installed_already)
+                continue
+            req = extract_requirement(pkg)
+            if self._install_special(req.name, pkg):
+                continue
+            to_install.append(pkg)
+            if str(req) not in reqs:
+                reqs.append(str(req))
+        if not reqs:
+            return
+        LOG.info("Installing %s packages in one yum transaction.", colorizer.quote(len(reqs)))
+        self._execute_yum(YUM_INSTALL + reqs)
+        for pkg in to_install:
+            self._installed(pkg)
+            LOG.debug("Installed %s", pkg)
 
     def _remove(self, pkg):
         req = extract_requirement(pkg)
@@ -0,0 +1,194 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import abc
+import httplib
+import os
+import re
+import socket
+import time
+
+from anvil import colorizer
+from anvil import http_pool
+from anvil import log as logging
+from anvil import shell as sh
+from anvil import utils
+
+LOG = logging.getLogger(__name__)
+
+# Http codes that mean something is at least responding
+HTTP_ACTIVE_CODES = list(xrange(200, 499)) + [501]
+
+# How much of a log is read at once when looking for a line
+LOG_CHUNK_SIZE = 64 * 1024
+
+
+class Probe(object):
+    """
+    Something that can be checked (repeatedly) to see if a program is ready
+    to be used, checking returns a (ready, reason not ready) tuple.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, name):
+        self.name = name
+
+    @abc.abstractmethod
+    def check(self):
+        raise NotImplementedError()
+
+    def __str__(self):
+        return self.name
+
+
+class CallableProbe(Probe):
+    def __init__(self, name, functor):
+        Probe.__init__(self, name)
+        self.functor = functor
+
+    def check(self):
+        return self.functor()
+
+
+class TcpProbe(Probe):
+    def __init__(self, host, port, timeout=1.0):
+        Probe.__init__(self, "tcp://%s:%s" % (host, port))
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+
+    def check(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            sock.close()
+            return (True, None)
+        except socket.error as e:
+            return (False, str(e))
+
+
+class HttpProbe(Probe):
+    def __init__(self, url):
+        Probe.__init__(self, url)
+        self.url = url
+
+    def check(self):
+        try:
+            code = http_pool.get_pool().probe(self.url)
+        except (IOError, httplib.HTTPException) as e:
+            return (False, str(e))
+        if code in HTTP_ACTIVE_CODES:
+            return (True, None)
+        return (False, "responded with code %s" % (code))
+
+
+class LogProbe(Probe):
+    """
+    Looks for a line matching a regex in (growing) log files, only reading
+    what was added to those files since they were last checked. What the
+    files already have when the probe is made is skipped (it is typically
+    left over from a previous run) unless the probe is rewound.
+    """
+
+    def __init__(self, paths, pattern):
+        Probe.__init__(self, "%s in %s" % (pattern, ", ".join(paths)))
+        self.paths = list(paths)
+        self.regex = re.compile(pattern)
+        # Kept by inode (not path) so that reading a rotated file (which is
+        # renamed) carries on from where it was when it had the older name
+        self._offsets = {}
+        self._partials = {}
+        self._matched = False
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            self._offsets[st.st_ino] = st.st_size
+
+    def rewind(self):
+        # Look at what the files already have as well
+        self._offsets = {}
+        self._partials = {}
+
+    def _read_new(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return ('', None)
+        inode = st.st_ino
+        offset = self._offsets.get(inode, 0)
+        if st.st_size < offset:
+            # Truncated so start over...
+            offset = 0
+            self._partials.pop(inode, None)
+        if st.st_size == offset:
+            self._offsets[inode] = offset
+            return ('', inode)
+        with open(path, 'rb') as fh:
+            fh.seek(offset)
+            data = fh.read(min(LOG_CHUNK_SIZE, st.st_size - offset))
+        self._offsets[inode] = offset + len(data)
+        return (data, inode)
+
+    def check(self):
+        # Once found it stays found (the files may be rotated later)
+        if self._matched:
+            return (True, None)
+        for path in self.paths:
+            # Read a chunk at a time until caught up with what was written
+            while True:
+                (data, inode) = self._read_new(path)
+                if not data:
+                    break
+                lines = (self._partials.pop(inode, '') + data).split("\n")
+                # The last piece may be the start of a line not yet fully
+                # written (only so much of it is kept)
+                self._partials[inode] = lines.pop()[-LOG_CHUNK_SIZE:]
+                for line in lines:
+                    if self.regex.search(line):
+                        self._matched = True
+                        return (True, None)
+        return (False, "no matching line found")
+
+
+def wait_for(probes, timeout, initial_wait=0.05, max_wait=1.0):
+    """
+    Checks the given probes (at increasing intervals) until they have all
+    passed or the timeout has been reached, returning the (probe, reason)
+    of the probes that did not pass (which is empty on success).
+    """
+    if sh.is_dry_run():
+        return []
+    pending = list(probes)
+    reasons = {}
+    start_time = time.time()
+    for delay in utils.backoff_delays(initial_wait, max_wait):
+        not_ready = []
+        for probe in pending:
+            (ready, reason) = probe.check()
+            if ready:
+                LOG.debug("Probe %s passed after %.03f seconds.", colorizer.quote(probe.name),
+                          time.time() - start_time)
+            else:
+                reasons[probe] = reason
+                not_ready.append(probe)
+        pending = not_ready
+        if not pending:
+            return []
+        remaining = timeout - (time.time() - start_time)
+        if remaining <= 0:
+            return [(probe, reasons[probe]) for probe in pending]
+        sh.sleep(min(delay, remaining))
@@ -0,0 +1,239 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import threading
+import time
+
+from anvil import log as logging
+
+LOG = logging.getLogger(__name__)
+
+PROC_DIR = '/proc'
+
+# How old (in seconds) the shared snapshot may get before it is retaken
+MAX_AGE = 1.0
+
+
+def _clock_ticks():
+    try:
+        return os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+    except (KeyError, ValueError, OSError):
+        return 100
+
+
+def _page_size():
+    try:
+        return os.sysconf(os.sysconf_names['SC_PAGE_SIZE'])
+    except (KeyError, ValueError, OSError):
+        return 4096
+
+
+class ProcessInfo(object):
+    def __init__(self, pid, ppid, pgid, name, state, cmdline, cwd, start_time, rss, cpu_time,
+                 num_threads=1, start_ticks=None):
+        self.pid = pid
+        self.ppid = ppid
+        self.pgid = pgid
+        self.name = name
+        self.state = state
+        self.cmdline = cmdline
+        self.cwd = cwd
+        self.start_time = start_time
+        self.rss = rss
+        self.cpu_time = cpu_time
+        self.num_threads = num_threads
+        # When the process started (in clock ticks since boot), unlike the
+        # start time this is not affected by the clock being changed
+        self.start_ticks = start_ticks
+
+    @property
+    def is_zombie(self):
+        return self.state in ['Z', 'X']
+
+    def __str__(self):
+        return "%s (%s)" % (self.pid, self.name)
+
+
+class Snapshot(object):
+    """
+    The process table as read (in one pass) from /proc at some point in
+    time, so that many processes can be looked up without each lookup
+    scanning /proc (or making its own psutil process objects).
+
+    Without details only each processes stat file is read (the command line
+    and working directory are left empty) which makes repeated snapshots
+    cheaper.
+    """
+
+    def __init__(self, proc_dir=PROC_DIR, details=True):
+        self.proc_dir = proc_dir
+        self.details = details
+        self.taken = None
+        self._procs = {}
+        self._lock = threading.RLock()
+        self._ticks = _clock_ticks()
+        self._page_size = _page_size()
+        self._boot_time = None
+
+    def _read(self, *pieces):
+        with open(os.path.join(self.proc_dir, *pieces), 'rb') as fh:
+            return fh.read()
+
+    def _get_boot_time(self):
+        if self._boot_time is None:
+            self._boot_time = 0.0
+            try:
+                for line in self._read('stat').splitlines():
+                    if line.startswith('btime'):
+                        self._boot_time = float(line.split()[1])
+                        break
+            except (IOError, ValueError, IndexError):
+                pass
+        return self._boot_time
+
+    def _read_process(self, pid):
+        try:
+            stat = self._read(str(pid), 'stat')
+            cmdline = ''
+            if self.details:
+                cmdline = self._read(str(pid), 'cmdline')
+        except (IOError, OSError):
+            # Gone (or never was)
+            return None
+        # The name is in parenthesis (and may contain spaces itself)
+        (head, _sep, tail) = stat.rpartition(')')
+        name = head.partition('(')[2]
+        fields = tail.split()
+        try:
+            # See proc(5), the fields here start at the 'state' field (3)
+            state = fields[0]
+            ppid = int(fields[1])
+            pgid = int(fields[2])
+            cpu_time = (int(fields[11]) + int(fields[12])) / float(self._ticks)
+            num_threads = int(fields[17])
+            start_ticks = int(fields[19])
+            start_time = self._get_boot_time() + start_ticks / float(self._ticks)
+            rss = int(fields[21]) * self._page_size
+        except (IndexError, ValueError):
+            return None
+        cwd = None
+        if self.details:
+            try:
+                cwd = os.readlink(os.path.join(self.proc_dir, str(pid), 'cwd'))
+            except OSError:
+                # Not allowed to look (or gone)
+                pass
+        return ProcessInfo(pid=pid, ppid=ppid, pgid=pgid, name=name, state=state,
+                           cmdline=[c for c in cmdline.split("\0") if c],
+                           cwd=cwd, start_time=start_time, rss=rss,
+                           cpu_time=cpu_time, num_threads=num_threads,
+                           start_ticks=start_ticks)
+
+    def refresh(self):
+        procs = {}
+        try:
+            entries = os.listdir(self.proc_dir)
+        except OSError as e:
+            LOG.warn("Unable to list the processes in %s: %s", self.proc_dir, e)
+            entries = []
+        for entry in entries:
+            if not entry.isdigit():
+                continue
+            info = self._read_process(int(entry))
+            if info is not None:
+                procs[info.pid] = info
+        with self._lock:
+            self._procs = procs
+            self.taken = time.time()
+        return self
+
+    @property
+    def age(self):
+        if self.taken is None:
+            return None
+        return time.time() - self.taken
+
+    def get(self, pid):
+        try:
+            pid = int(pid)
+        except (TypeError, ValueError):
+            return None
+        with self._lock:
+            info = self._procs.get(pid)
+            if info is None and self.taken is not None:
+                # Started after the snapshot was taken, this is cheap
+                # enough for one process (compared to rescanning)...
+                info = self._read_process(pid)
+                if info is not None:
+                    self._procs[pid] = info
+            return info
+
+    def open_fds(self, pid):
+        # Not kept in the snapshot (since listing every processes file
+        # descriptors is costly) so this looks at the process as it is now
+        try:
+            return len(os.listdir(os.path.join(self.proc_dir, str(pid), 'fd')))
+        except OSError:
+            # Not allowed to look (or gone)
+            return None
+
+    def processes(self):
+        with self._lock:
+            return list(self._procs.values())
+
+    def is_running(self, pid, start_ticks=None):
+        # A pid that now belongs to a process that did not start when the
+        # one wanted did (when that is known) is not running
+        info = self.get(pid)
+        if info is None or info.is_zombie:
+            return False
+        if self.is_reused(pid, start_ticks):
+            return False
+        return True
+
+    def is_reused(self, pid, start_ticks):
+        # Whether the pid now belongs to some other (running) process than
+        # the one that started at the given clock tick
+        if start_ticks is None:
+            return False
+        info = self.get(pid)
+        if info is None or info.is_zombie:
+            return False
+        if info.start_ticks != start_ticks:
+            LOG.debug("Process id %s was reused by %s (started at tick %s instead of %s).",
+                      pid, info, info.start_ticks, start_ticks)
+            return True
+        return False
+
+
+def read_process(pid, proc_dir=PROC_DIR):
+    # Reads a single process (as it is right now) without taking a snapshot
+    return Snapshot(proc_dir)._read_process(int(pid))
+
+
+_SNAPSHOT = Snapshot()
+_SNAPSHOT_LOCK = threading.Lock()
+
+
+def get_snapshot(max_age=MAX_AGE):
+    # Returns the shared snapshot, retaking it first if it has gotten
+    # older than the given max age (in seconds)
+    with _SNAPSHOT_LOCK:
+        age = _SNAPSHOT.age
+        if age is None or age > max_age:
+            _SNAPSHOT.refresh()
+        return _SNAPSHOT
@@ -17,7 +17,7 @@
 import abc
 import weakref
 
-from anvil.components import STATUS_UNKNOWN
+from anvil.components import (STATUS_DETAILS_MAX, STATUS_UNKNOWN)
 
 
 class Runner(object):
@@ -34,6 +34,22 @@ class Runner(object):
         # Stops the given app
         pass
 
-    def status(self, app_name):
-        # Attempt to give the status of a app + details
+    def restart(self, app_name):
+        # Restarts the given app (returning false if this is not supported)
+        return False
+
+    def status(self, app_name, details_max=STATUS_DETAILS_MAX):
+        # Attempt to give the status of a app + details (at most details_max
+        # bytes of them)
         return (STATUS_UNKNOWN, '')
+
+    def pid(self, app_name, snapshot=None):
+        # The process id the given app was last known to be running as (if
+        # known), it may no longer be running but should never be one that
+        # now belongs to some other process (as seen in the given process
+        # table snapshot, when given one)
+        return None
+
+    def log_files(self, app_name):
+        # Files that the output of the given app goes to (if known)
+        return []
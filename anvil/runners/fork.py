@@ -16,13 +16,16 @@
 
 import json
 
+from anvil import colorizer
 from anvil import exceptions as excp
 from anvil import log as logging
+from anvil import process_table
 from anvil import runners as base
 from anvil import shell as sh
 from anvil import trace as tr
+from anvil import utils
 
-from anvil.components import (STATUS_STARTED, STATUS_UNKNOWN)
+from anvil.components import (STATUS_DETAILS_MAX, STATUS_STARTED, STATUS_UNKNOWN)
 
 LOG = logging.getLogger(__name__)
 
@@ -49,16 +52,30 @@ class ForkRunner(base.Runner):
             if not pid:
                 msg = "Could not extract a valid pid from %s" % (pid_file)
                 raise excp.StopException(msg)
-            (killed, attempts) = sh.kill(pid)
+            start_fn = self._start_file_name(fn_name)
+            start_ticks = self._extract_start_ticks(start_fn)
+            snapshot = process_table.get_snapshot()
+            if snapshot.is_reused(pid, start_ticks):
+                # Nothing of ours to kill, but the files are left alone (so
+                # that what happened can be looked into)
+                LOG.warn("Process id %s of %s now belongs to another process, not killing it (leaving %s).",
+                         pid, colorizer.quote(app_name), colorizer.quote(pid_file))
+                return
+            if snapshot.is_running(pid, start_ticks):
+                (killed, attempts) = sh.kill(pid, group=self.runtime.get_bool_option('stop_process_group'))
+            else:
+                LOG.debug("Process id %s of %r is not running, not killing it." % (pid, app_name))
+                (killed, attempts) = (True, 0)
             # Trash the files if it worked
             if killed:
                 LOG.debug("Killed pid %s after %s attempts." % (pid, attempts))
                 LOG.debug("Removing pid file %s" % (pid_file))
                 sh.unlink(pid_file)
-                LOG.debug("Removing stderr file %r" % (stderr_fn))
-                sh.unlink(stderr_fn)
-                LOG.debug("Removing stdout file %r" % (stdout_fn))
-                sh.unlink(stdout_fn)
+                if sh.isfile(start_fn):
+                    sh.unlink(start_fn)
+                for fn in self._output_files(stderr_fn) + self._output_files(stdout_fn):
+                    LOG.debug("Removing output file %r" % (fn))
+                    sh.unlink(fn)
                 trace_fn = tr.trace_filename(trace_dir, fn_name)
                 if sh.isfile(trace_fn):
                     LOG.debug("Removing %r trace file %r" % (app_name, trace_fn))
@@ -67,7 +84,25 @@ class ForkRunner(base.Runner):
                 msg = "Could not stop %r after %s attempts" % (app_name, attempts)
                 raise excp.StopException(msg)
 
+    def _is_running(self, pid, start_fn):
+        if sh.is_dry_run():
+            return True
+        # The clock tick the program started at is written when it is forked
+        # so a process (with that pid) that did not start at that tick is
+        # not the program (its pid has been reused)
+        start_ticks = self._extract_start_ticks(start_fn)
+        return process_table.get_snapshot().is_running(pid, start_ticks=start_ticks)
+
+    def _start_file_name(self, file_name):
+        return sh.joinpths(self.runtime.get_option('trace_dir'), file_name + ".start")
+
     def _extract_pid(self, filename):
+        return self._extract_number(filename)
+
+    def _extract_start_ticks(self, filename):
+        return self._extract_number(filename)
+
+    def _extract_number(self, filename):
         if sh.isfile(filename):
             try:
                 return int(sh.load_file(filename).strip())
@@ -76,27 +111,64 @@ class ForkRunner(base.Runner):
         else:
             return None
 
-    def status(self, app_name):
+    def status(self, app_name, details_max=STATUS_DETAILS_MAX):
         trace_dir = self.runtime.get_option('trace_dir')
         if not sh.isdir(trace_dir):
             return (STATUS_UNKNOWN, '')
-        (pid_file, stderr_fn, stdout_fn) = self._form_file_names(FORK_TEMPL % (app_name))
+        fn_name = FORK_TEMPL % (app_name)
+        (pid_file, stderr_fn, stdout_fn) = self._form_file_names(fn_name)
         pid = self._extract_pid(pid_file)
-        stderr = ''
-        try:
-            stderr = sh.load_file(stderr_fn)
-        except IOError:
-            pass
-        stdout = ''
-        try:
-            stdout = sh.load_file(stdout_fn)
-        except IOError:
-            pass
-        if pid and sh.is_running(pid):
+        # Only the end of the output is read since these files (and their
+        # rotated copies) can grow large when programs run for a long time
+        stderr = self._tail_output(stderr_fn, details_max)
+        stdout = self._tail_output(stdout_fn, details_max)
+        if pid and self._is_running(pid, self._start_file_name(fn_name)):
             return (STATUS_STARTED, (stdout + stderr).strip())
         else:
             return (STATUS_UNKNOWN, (stdout + stderr).strip())
 
+    def _tail_output(self, fn, max_bytes):
+        # The end of the output, carrying on into the rotated copies (newest
+        # first) when the current file does not have enough of it
+        pieces = []
+        for output_fn in self._output_files(fn):
+            if max_bytes <= 0:
+                break
+            try:
+                data = sh.tail_file(output_fn, max_bytes)
+            except IOError:
+                continue
+            pieces.append(data)
+            max_bytes -= len(data)
+        pieces.reverse()
+        return "".join(pieces)
+
+    def _output_files(self, fn):
+        # The output file and any older rotated copies of it
+        fns = [fn]
+        i = 1
+        while sh.isfile("%s.%s" % (fn, i)):
+            fns.append("%s.%s" % (fn, i))
+            i += 1
+        return fns
+
+    def pid(self, app_name, snapshot=None):
+        fn_name = FORK_TEMPL % (app_name)
+        (pid_file, _stderr_fn, _stdout_fn) = self._form_file_names(fn_name)
+        pid = self._extract_pid(pid_file)
+        if pid:
+            start_ticks = self._extract_start_ticks(self._start_file_name(fn_name))
+            if snapshot is None:
+                snapshot = process_table.get_snapshot()
+            if snapshot.is_reused(pid, start_ticks):
+                # Now some other process (which is not to be looked at)
+                return None
+        return pid
+
+    def log_files(self, app_name):
+        (_pid_file, stderr_fn, stdout_fn) = self._form_file_names(FORK_TEMPL % (app_name))
+        return self._output_files(stdout_fn) + self._output_files(stderr_fn)
+
     def _form_file_names(self, file_name):
         trace_dir = self.runtime.get_option('trace_dir')
         return (sh.joinpths(trace_dir, file_name + ".pid"),
@@ -120,8 +192,17 @@ class ForkRunner(base.Runner):
         trace_info[ARGS] = json.dumps(args)
         trace_fn = self._do_trace(fn_name, trace_info)
         LOG.debug("Forking %r by running command %r with args (%s)" % (app_name, app_pth, " ".join(args)))
+        # Output is rotated (instead of growing forever) when a maximum size is set
+        output_max_size = utils.to_bytes(str(self.runtime.get_option('output_max_size', default_value=0)))
+        output_backups = self.runtime.get_int_option('output_backups', default_value=sh.OUTPUT_BACKUPS)
         with sh.Rooted(True):
-            sh.fork(app_pth, app_wkdir, pid_fn, stdout_fn, stderr_fn, *args)
+            # Left over from a previous run, a new one is written once forked
+            start_fn = self._start_file_name(fn_name)
+            if sh.isfile(start_fn):
+                sh.unlink(start_fn)
+            sh.fork(app_pth, app_wkdir, pid_fn, stdout_fn, stderr_fn, *args,
+                    output_max_size=output_max_size, output_backups=output_backups,
+                    scheduling=self.runtime.app_scheduling(app_name), start_fn=start_fn)
         return trace_fn
 
     def start(self, app_name, app_pth, app_dir, opts):
@@ -0,0 +1,590 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import fcntl
+import json
+import optparse
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+from anvil import exceptions as excp
+from anvil import log as logging
+from anvil import runners as base
+from anvil import shell as sh
+from anvil import trace as tr
+from anvil import utils
+
+from anvil.components import (STATUS_DETAILS_MAX, STATUS_STARTED,
+                              STATUS_STOPPED, STATUS_UNKNOWN)
+
+LOG = logging.getLogger(__name__)
+
+# Files (in the root directory) that the supervisor uses
+SOCKET_FN = "supervisor.sock"
+PID_FN = "supervisor.pid"
+STDOUT_FN = "supervisor.stdout"
+STDERR_FN = "supervisor.stderr"
+
+# Trace constants
+SOCKET = "SOCKET"
+STDOUT = "STDOUT_FN"
+STDERR = "STDERR_FN"
+ARGS = "ARGS"
+SUPERVISED_TEMPL = "%s.supervised"
+
+# App states (as tracked by the supervisor)
+RUNNING = 'running'
+STOPPING = 'stopping'
+RESTARTING = 'restarting'
+BACKOFF = 'backoff'
+
+# Crashed apps are restarted after waiting (initially) this many seconds,
+# doubling for each crash up to the maximum; apps that ran for at least the
+# stable time before crashing start again from the initial wait
+RESTART_INITIAL_WAIT = 1.0
+RESTART_MAX_WAIT = 60.0
+STABLE_TIME = 30.0
+
+# How long apps have to exit (after being interrupted) before being killed
+STOP_TIMEOUT = 4.0
+
+# How long (in seconds) the supervisor has to start answering requests
+STARTUP_TIMEOUT = 10.0
+
+# How long (in seconds) to wait on a answer to a request (stopping waits
+# on top of this for the app to exit)
+REQUEST_TIMEOUT = 10.0
+
+
+def request(socket_path, message, timeout=REQUEST_TIMEOUT):
+    # Sends a request (a json object on a line) to the supervisor and
+    # returns its answer, raising IOError when it can not be reached
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(message) + "\n")
+            data = ''
+            while not data.endswith("\n"):
+                piece = sock.recv(4096)
+                if not piece:
+                    break
+                data += piece
+        except socket.error as e:
+            raise IOError("Supervisor at %s could not be reached: %s" % (socket_path, e))
+    finally:
+        sock.close()
+    try:
+        return json.loads(data)
+    except ValueError:
+        raise IOError("Supervisor at %s gave a bad answer: %r" % (socket_path, data))
+
+
+class SupervisedApp(object):
+    def __init__(self, name, program, args, app_dir, stdout_fn, stderr_fn):
+        self.name = name
+        self.program = program
+        self.args = args
+        self.app_dir = app_dir
+        self.stdout_fn = stdout_fn
+        self.stderr_fn = stderr_fn
+        self.pid = None
+        self.state = None
+        self.crashes = 0
+        self.restarts = 0
+        self.started_at = None
+        self.restart_at = None
+        self.kill_at = None
+        self.waiters = []
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'pid': self.pid,
+            'restarts': self.restarts,
+            'started_at': self.started_at,
+            'restart_at': self.restart_at,
+        }
+
+
+class Supervisor(object):
+    """
+    Runs apps as its children (so that there exits are known right away
+    through waitpid) restarting them (with backoff) when they crash, and
+    answers start, stop, restart and status requests on a unix socket.
+
+    It exits once the last of its apps has been stopped.
+    """
+
+    def __init__(self, socket_path, restart_initial_wait=RESTART_INITIAL_WAIT,
+                 restart_max_wait=RESTART_MAX_WAIT, stable_time=STABLE_TIME,
+                 stop_timeout=STOP_TIMEOUT):
+        self.socket_path = socket_path
+        self.restart_initial_wait = restart_initial_wait
+        self.restart_max_wait = restart_max_wait
+        self.stable_time = stable_time
+        self.stop_timeout = stop_timeout
+        self.apps = {}
+        self.running = False
+        self._clients = {}
+        self._wakeup = None
+
+    def _spawn(self, app):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # Each app gets its own process group (so that its children
+                # can be stopped with it)
+                os.setsid()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                if app.app_dir:
+                    os.chdir(app.app_dir)
+                fd = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(fd, 0)
+                for (fn, std_fd) in [(app.stdout_fn, 1), (app.stderr_fn, 2)]:
+                    fd = os.open(fn or os.devnull, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+                    os.dup2(fd, std_fd)
+                os.closerange(3, 4096)
+                os.execvp(app.program, [sh.basename(app.program)] + list(app.args))
+            finally:
+                os._exit(127)
+        app.pid = pid
+        app.state = RUNNING
+        app.started_at = time.time()
+        app.restart_at = None
+        app.kill_at = None
+        LOG.info("Started %s as process %s.", app.name, pid)
+
+    def _signal(self, app, signal_type):
+        if not app.pid:
+            return
+        try:
+            os.killpg(app.pid, signal_type)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+            os.kill(app.pid, signal_type)
+
+    def _reply(self, client, answer):
+        try:
+            client.sendall(json.dumps(answer) + "\n")
+        except socket.error:
+            pass
+        client.close()
+
+    def _finish_waiters(self, app, answer):
+        waiters = app.waiters
+        app.waiters = []
+        for client in waiters:
+            self._reply(client, answer)
+
+    def _exited(self, app, status):
+        app.pid = None
+        now = time.time()
+        if app.state == STOPPING:
+            LOG.info("Stopped %s.", app.name)
+            self.apps.pop(app.name, None)
+            self._finish_waiters(app, {'ok': True, 'state': None})
+            if not self.apps:
+                self.running = False
+        elif app.state == RESTARTING:
+            app.crashes = 0
+            app.restarts += 1
+            self._spawn(app)
+            self._finish_waiters(app, {'ok': True, 'pid': app.pid, 'state': app.state})
+        else:
+            if app.started_at is not None and (now - app.started_at) >= self.stable_time:
+                app.crashes = 0
+            delay = min(self.restart_max_wait, self.restart_initial_wait * (2 ** app.crashes))
+            app.crashes += 1
+            app.restarts += 1
+            app.state = BACKOFF
+            app.restart_at = now + delay
+            LOG.warn("App %s exited unexpectedly (status %s), restarting it in %.02f seconds.",
+                     app.name, status, delay)
+
+    def _reap(self):
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            for app in self.apps.values():
+                if app.pid == pid:
+                    self._exited(app, status)
+                    break
+
+    def _run_timers(self):
+        now = time.time()
+        for app in list(self.apps.values()):
+            if app.state == BACKOFF and app.restart_at <= now:
+                try:
+                    self._spawn(app)
+                except OSError as e:
+                    LOG.warn("Failed restarting %s: %s", app.name, e)
+                    app.restart_at = now + self.restart_max_wait
+            elif app.state in [STOPPING, RESTARTING] and app.kill_at is not None and app.kill_at <= now:
+                LOG.warn("App %s did not exit after %s seconds, killing it.", app.name, self.stop_timeout)
+                app.kill_at = None
+                self._signal(app, signal.SIGKILL)
+
+    def _next_timeout(self):
+        wakeups = []
+        for app in self.apps.values():
+            if app.state == BACKOFF:
+                wakeups.append(app.restart_at)
+            elif app.kill_at is not None:
+                wakeups.append(app.kill_at)
+        if not wakeups:
+            return None
+        return max(0, min(wakeups) - time.time())
+
+    def _do_start(self, client, message):
+        name = message['name']
+        app = self.apps.get(name)
+        if app is not None and app.state in [RUNNING, RESTARTING]:
+            return {'ok': True, 'pid': app.pid, 'state': app.state}
+        if app is not None and app.state == STOPPING:
+            return {'ok': False, 'error': "App %s is being stopped" % (name)}
+        app = SupervisedApp(name, message['program'], message.get('args') or [],
+                            message.get('app_dir'), message.get('stdout'), message.get('stderr'))
+        self._spawn(app)
+        self.apps[name] = app
+        return {'ok': True, 'pid': app.pid, 'state': app.state}
+
+    def _do_stop(self, client, message):
+        app = self.apps.get(message['name'])
+        if app is None:
+            return {'ok': True, 'state': None}
+        if app.pid is None:
+            # Waiting to be restarted, so just forget about it
+            self.apps.pop(app.name)
+            if not self.apps:
+                self.running = False
+            return {'ok': True, 'state': None}
+        if app.state != STOPPING:
+            app.state = STOPPING
+            app.kill_at = time.time() + self.stop_timeout
+            self._signal(app, signal.SIGINT)
+        app.waiters.append(client)
+        return None
+
+    def _do_restart(self, client, message):
+        app = self.apps.get(message['name'])
+        if app is None:
+            return {'ok': False, 'error': "App %s is not known" % (message['name'])}
+        if app.state == STOPPING:
+            return {'ok': False, 'error': "App %s is being stopped" % (app.name)}
+        if app.pid is None:
+            app.crashes = 0
+            self._spawn(app)
+            return {'ok': True, 'pid': app.pid, 'state': app.state}
+        if app.state != RESTARTING:
+            app.state = RESTARTING
+            app.kill_at = time.time() + self.stop_timeout
+            self._signal(app, signal.SIGINT)
+        app.waiters.append(client)
+        return None
+
+    def _do_status(self, client, message):
+        apps = {}
+        for (name, app) in self.apps.items():
+            if message.get('name') in [None, name]:
+                apps[name] = app.to_dict()
+        return {'ok': True, 'apps': apps}
+
+    def _handle(self, client, message):
+        action = message.get('action')
+        functor = getattr(self, '_do_%s' % (action), None)
+        if not functor or not callable(functor):
+            return {'ok': False, 'error': "Unknown action %r" % (action)}
+        try:
+            return functor(client, message)
+        except (KeyError, TypeError, OSError) as e:
+            return {'ok': False, 'error': "Failed %s: %s" % (action, e)}
+
+    def _read_client(self, client):
+        try:
+            piece = client.recv(4096)
+        except socket.error:
+            piece = ''
+        if not piece:
+            self._clients.pop(client, None)
+            client.close()
+            return
+        data = self._clients[client] + piece
+        if not data.endswith("\n"):
+            self._clients[client] = data
+            return
+        # One request per connection (the answer may come later)
+        self._clients.pop(client, None)
+        try:
+            message = json.loads(data)
+            if not isinstance(message, dict):
+                raise ValueError("Requests must be objects")
+        except ValueError as e:
+            self._reply(client, {'ok': False, 'error': str(e)})
+            return
+        answer = self._handle(client, message)
+        if answer is not None:
+            self._reply(client, answer)
+
+    def _on_signal(self, signum, frame):
+        try:
+            os.write(self._wakeup[1], 'x')
+        except OSError:
+            pass
+
+    def _shutdown(self, signum, frame):
+        # Stops everything (and then exits once all the apps have exited)
+        for app in self.apps.values():
+            if app.pid is None:
+                self.apps.pop(app.name)
+            elif app.state != STOPPING:
+                app.state = STOPPING
+                app.kill_at = time.time() + self.stop_timeout
+                self._signal(app, signal.SIGINT)
+        if not self.apps:
+            self.running = False
+        self._on_signal(signum, frame)
+
+    def serve(self):
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # Set before the signals are handled (and the socket is there for
+        # clients to find) so that shutting down can not be undone by it
+        self.running = True
+        signal.signal(signal.SIGCHLD, self._on_signal)
+        signal.signal(signal.SIGTERM, self._shutdown)
+        signal.signal(signal.SIGINT, self._shutdown)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0600)
+        listener.listen(64)
+        LOG.info("Supervisor listening on %s.", self.socket_path)
+        try:
+            while self.running or self.apps:
+                watching = [listener, self._wakeup[0]] + list(self._clients.keys())
+                try:
+                    (readable, _writeable, _errored) = select.select(watching, [], [], self._next_timeout())
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        readable = []
+                    else:
+                        raise
+                for r in readable:
+                    if r is listener:
+                        (client, _address) = listener.accept()
+                        client.settimeout(REQUEST_TIMEOUT)
+                        self._clients[client] = ''
+                    elif r is self._wakeup[0]:
+                        try:
+                            os.read(self._wakeup[0], 4096)
+                        except OSError:
+                            pass
+                    else:
+                        self._read_client(r)
+                self._reap()
+                self._run_timers()
+        finally:
+            listener.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            LOG.info("Supervisor exiting.")
+
+
+# Only one thread (per process) should be starting the supervisor at once
+_START_LOCK = threading.Lock()
+
+
+class SupervisorRunner(base.Runner):
+    """
+    Runs apps under a supervisor process (one per root directory) instead
+    of forking them and forgetting about them.
+    """
+
+    def _root_file(self, fn):
+        return sh.joinpths(self.runtime.get_option('root_dir'), fn)
+
+    @property
+    def socket_path(self):
+        return self._root_file(SOCKET_FN)
+
+    def _request(self, message, timeout=REQUEST_TIMEOUT):
+        # Done as root since the socket is only accessible to root
+        with sh.Rooted(True):
+            return request(self.socket_path, message, timeout=timeout)
+
+    def _ensure_supervisor(self):
+        with _START_LOCK:
+            try:
+                return self._request({'action': 'status'})
+            except IOError:
+                pass
+            LOG.info("Starting a supervisor (which will listen on %s).", self.socket_path)
+            # Ran as a module from the directory that contains anvil
+            anvil_dir = sh.dirname(sh.dirname(sh.dirname(os.path.abspath(__file__))))
+            with sh.Rooted(True):
+                sh.fork(sys.executable, anvil_dir, self._root_file(PID_FN),
+                        self._root_file(STDOUT_FN), self._root_file(STDERR_FN),
+                        '-m', 'anvil.runners.supervisor', self.socket_path)
+            start_time = time.time()
+            for delay in utils.backoff_delays(0.05, 1.0):
+                try:
+                    return self._request({'action': 'status'})
+                except IOError as e:
+                    if time.time() - start_time > STARTUP_TIMEOUT:
+                        raise excp.StartException("Supervisor did not start answering requests after %s seconds: %s"
+                                                  % (STARTUP_TIMEOUT, e))
+                sh.sleep(delay)
+
+    def _form_file_names(self, app_name):
+        trace_dir = self.runtime.get_option('trace_dir')
+        file_name = SUPERVISED_TEMPL % (app_name)
+        return (sh.joinpths(trace_dir, file_name + ".stderr"),
+                sh.joinpths(trace_dir, file_name + ".stdout"))
+
+    def log_files(self, app_name):
+        (stderr_fn, stdout_fn) = self._form_file_names(app_name)
+        return [stdout_fn, stderr_fn]
+
+    def start(self, app_name, app_pth, app_dir, opts):
+        trace_dir = self.runtime.get_option('trace_dir')
+        (stderr_fn, stdout_fn) = self._form_file_names(app_name)
+        run_trace = tr.TraceWriter(tr.trace_filename(trace_dir, SUPERVISED_TEMPL % (app_name)))
+        run_trace.trace(SOCKET, self.socket_path)
+        run_trace.trace(STDOUT, stdout_fn)
+        run_trace.trace(STDERR, stderr_fn)
+        run_trace.trace(ARGS, json.dumps(opts))
+        if sh.is_dry_run():
+            return run_trace.filename()
+        # Output files are appended to (by each restart) so start fresh
+        for fn in [stdout_fn, stderr_fn]:
+            sh.write_file(fn, '', quiet=True)
+        self._ensure_supervisor()
+        LOG.debug("Asking the supervisor to run %r by running command %r with args (%s)"
+                  % (app_name, app_pth, " ".join(opts)))
+        (program, args) = (app_pth, list(opts))
+        # Ran with the wanted scheduling by exec'ing through a prefix
+        prefix = sh.scheduling_prefix(self.runtime.app_scheduling(app_name))
+        if prefix:
+            (program, args) = (prefix[0], prefix[1:] + [app_pth] + args)
+        answer = self._request({
+            'action': 'start',
+            'name': app_name,
+            'program': program,
+            'args': args,
+            'app_dir': app_dir,
+            'stdout': stdout_fn,
+            'stderr': stderr_fn,
+        })
+        if not answer.get('ok'):
+            raise excp.StartException("Supervisor could not start %r: %s" % (app_name, answer.get('error')))
+        return run_trace.filename()
+
+    def stop(self, app_name):
+        if not sh.is_dry_run():
+            try:
+                answer = self._request({'action': 'stop', 'name': app_name},
+                                       timeout=REQUEST_TIMEOUT + STOP_TIMEOUT)
+            except IOError as e:
+                # No supervisor means nothing it was running is still running
+                LOG.debug("Assuming %r is stopped: %s", app_name, e)
+                answer = {'ok': True}
+            if not answer.get('ok'):
+                raise excp.StopException("Supervisor could not stop %r: %s" % (app_name, answer.get('error')))
+        trace_dir = self.runtime.get_option('trace_dir')
+        for fn in self.log_files(app_name) + [tr.trace_filename(trace_dir, SUPERVISED_TEMPL % (app_name))]:
+            if sh.isfile(fn):
+                sh.unlink(fn)
+
+    def restart(self, app_name):
+        if sh.is_dry_run():
+            return True
+        answer = self._request({'action': 'restart', 'name': app_name},
+                               timeout=REQUEST_TIMEOUT + STOP_TIMEOUT)
+        if not answer.get('ok'):
+            raise excp.RestartException("Supervisor could not restart %r: %s" % (app_name, answer.get('error')))
+        return True
+
+    def pid(self, app_name, snapshot=None):
+        try:
+            answer = self._request({'action': 'status', 'name': app_name})
+        except IOError:
+            return None
+        app = (answer.get('apps') or {}).get(app_name) or {}
+        return app.get('pid')
+
+    def status(self, app_name, details_max=STATUS_DETAILS_MAX):
+        details = []
+        if details_max > 0:
+            for fn in self.log_files(app_name):
+                try:
+                    details.append(sh.tail_file(fn, details_max))
+                except IOError:
+                    pass
+        details = "".join(details).strip()
+        if sh.is_dry_run():
+            return (STATUS_STARTED, details)
+        try:
+            answer = self._request({'action': 'status', 'name': app_name})
+        except IOError:
+            return (STATUS_STOPPED, details)
+        app = (answer.get('apps') or {}).get(app_name)
+        if not app:
+            return (STATUS_STOPPED, details)
+        if app.get('state') == RUNNING:
+            return (STATUS_STARTED, details)
+        return (STATUS_UNKNOWN, details)
+
+
+def main(args):
+    parser = optparse.OptionParser(usage="%prog [options] socket_path")
+    parser.add_option("--restart-wait", type='float', default=RESTART_INITIAL_WAIT,
+                      help="initial seconds to wait before restarting crashed apps (default: %default)")
+    parser.add_option("--stable-time", type='float', default=STABLE_TIME,
+                      help="seconds after which a running app is considered stable (default: %default)")
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("A socket path is required")
+    logging.setupLogging(logging.INFO)
+    supervisor = Supervisor(args[0], restart_initial_wait=options.restart_wait,
+                            stable_time=options.stable_time)
+    supervisor.serve()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
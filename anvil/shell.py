@@ -14,16 +14,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
+import functools
 import getpass
 import grp
 import os
+import pipes
 import pwd
 import resource
+import select
 import shutil
 import signal
 import socket
 import subprocess
-import sys
+import threading
 import time
 
 import psutil  # http://code.google.com/p/psutil/wiki/Documentation
@@ -31,6 +35,7 @@ import psutil  # http://code.google.com/p/psutil/wiki/Documentation
 from anvil import env
 from anvil import exceptions as excp
 from anvil import log as logging
+from anvil import process_table
 from anvil import type_utils as tu
 
 LOG = logging.getLogger(__name__)
@@ -44,6 +49,58 @@ SHELL_QUOTE_REPLACERS = {
 }
 ROOT_PATH = os.sep
 
+# Not exposed by the os module (in python 2.x) but understood by lseek on
+# linux 3.1+ for finding where the data (and holes) of sparse files are
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# Runs of zeros this big (and aligned) are turned into holes in sparse files
+SPARSE_BLOCK_SIZE = 4096
+
+# How many older (rotated) output files forked programs keep by default
+OUTPUT_BACKUPS = 3
+
+# How much program output is read at once when capturing it
+CAPTURE_CHUNK_SIZE = 64 * 1024
+
+# How long (in seconds) killing a process may take (half of which is spent
+# waiting for it to exit nicely before it is forcefully killed)
+KILL_TIMEOUT = 4.0
+
+# How often (in seconds) killed processes are checked for exiting, starting
+# with the initial wait and backing off to the maximum wait
+KILL_INITIAL_WAIT = 0.01
+KILL_MAX_WAIT = 0.5
+
+# What forked programs output is redirected into
+STDOUT_FD = 1
+STDERR_FD = 2
+
+# Io scheduling classes understood by ionice(1)
+IONICE_CLASSES = {
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+
+# Scheduling that stays out of the way of everything else running
+BACKGROUND_SCHEDULING = {
+    'nice': 19,
+    'ionice_class': 'idle',
+}
+
+# Scheduling that build steps (compiles, installs, packaging) are ran with
+_BUILD_SCHEDULING = {}
+
+# Privileges are switched for the whole process (all of its threads) so they
+# are only dropped when the last of the (possibly concurrent) holders of them
+# is done with them
+_ROOTED_LOCK = threading.Lock()
+_ROOTED = {
+    'holders': 0,
+    'engaged': False,
+}
+
 # Locally stash these so that they can not be changed
 # by others after this is first fetched...
 SUDO_UID = env.get_key('SUDO_UID')
@@ -55,23 +112,131 @@ class Process(psutil.Process):
         return "%s (%s)" % (self.pid, self.name)
 
 
+class SparseWriter(object):
+    """
+    Wraps a (seekable) file object so that blocks of zeros that are written
+    to it are seeked over (leaving holes in the file) instead of being
+    written; finish() must be called once all writing has been done.
+    """
+
+    def __init__(self, fh, block_size=SPARSE_BLOCK_SIZE):
+        self.fh = fh
+        self.block_size = block_size
+        self._zeros = '\0' * block_size
+        self._seeked = False
+
+    def _skip(self, amount):
+        self.fh.seek(amount, os.SEEK_CUR)
+        self._seeked = True
+
+    def write(self, data):
+        if not data.strip('\0'):
+            self._skip(len(data))
+            return
+        bs = self.block_size
+        (pending_start, offset) = (0, 0)
+        while offset < len(data):
+            block = data[offset:offset + bs]
+            if block == self._zeros[0:len(block)]:
+                if offset > pending_start:
+                    self.fh.write(data[pending_start:offset])
+                self._skip(len(block))
+                pending_start = offset + len(block)
+            offset += bs
+        if pending_start < len(data):
+            self.fh.write(data[pending_start:])
+
+    def finish(self):
+        # Seeking past the end does not extend a file so when it ends in a
+        # hole the file has to be extended to its real size
+        if self._seeked:
+            pos = self.fh.tell()
+            if pos > os.fstat(self.fh.fileno()).st_size:
+                self.fh.truncate(pos)
+        self.fh.flush()
+
+
 class Rooted(object):
     def __init__(self, run_as_root):
         self.root_mode = run_as_root
         self.engaged = False
 
     def __enter__(self):
-        if self.root_mode and not got_root():
-            root_mode()
-            self.engaged = True
+        if self.root_mode:
+            with _ROOTED_LOCK:
+                if not _ROOTED['holders'] and not got_root():
+                    root_mode()
+                    _ROOTED['engaged'] = True
+                _ROOTED['holders'] += 1
+                self.engaged = True
         return self.engaged
 
     def __exit__(self, type, value, traceback):
         if self.root_mode and self.engaged:
-            user_mode()
+            with _ROOTED_LOCK:
+                _ROOTED['holders'] -= 1
+                if not _ROOTED['holders'] and _ROOTED['engaged']:
+                    user_mode()
+                    _ROOTED['engaged'] = False
             self.engaged = False
 
 
+def set_build_scheduling(scheduling):
+    # Validated now (instead of when first used)
+    scheduling_prefix(scheduling)
+    _BUILD_SCHEDULING.clear()
+    _BUILD_SCHEDULING.update(scheduling or {})
+
+
+def get_build_scheduling():
+    return dict(_BUILD_SCHEDULING)
+
+
+def scheduling_prefix(scheduling):
+    """
+    Returns the command that when placed before a command runs it with the
+    given scheduling (a dictionary with optional 'nice', 'ionice_class',
+    'ionice_level' and 'cpu_affinity' keys); each command in it execs the
+    next so the command keeps the process id the prefix is started as.
+    """
+    if not scheduling:
+        return []
+    prefix = []
+    cpus = scheduling.get('cpu_affinity')
+    if cpus is not None and cpus != '':
+        if isinstance(cpus, (list, tuple, set)):
+            cpus = ",".join([str(int(c)) for c in cpus])
+        cpus = str(cpus).replace(" ", "")
+        if not cpus or cpus.strip("0123456789,-"):
+            raise ValueError("Invalid cpu affinity list %r" % (scheduling.get('cpu_affinity')))
+        prefix.extend(['taskset', '-c', cpus])
+    io_class = scheduling.get('ionice_class')
+    if io_class is not None and io_class != '':
+        io_class = IONICE_CLASSES.get(str(io_class).lower(), io_class)
+        try:
+            io_class = int(io_class)
+        except (TypeError, ValueError):
+            io_class = 0
+        if io_class not in IONICE_CLASSES.values():
+            raise ValueError("Invalid io scheduling class %r" % (scheduling.get('ionice_class')))
+        prefix.extend(['ionice', '-c', str(io_class)])
+        io_level = scheduling.get('ionice_level')
+        # The idle class has no levels
+        if io_level is not None and io_class != IONICE_CLASSES['idle']:
+            io_level = int(io_level)
+            if io_level < 0 or io_level > 7:
+                raise ValueError("Invalid io scheduling level %r" % (io_level))
+            prefix.extend(['-n', str(io_level)])
+    nice = scheduling.get('nice')
+    if nice is not None and nice != '':
+        nice = int(nice)
+        if nice < -20 or nice > 19:
+            raise ValueError("Invalid nice value %r" % (nice))
+        if nice:
+            prefix.extend(['nice', '-n', str(nice)])
+    return prefix
+
+
 def is_dry_run():
     # Not stashed locally since the main entrypoint
     # actually adjusts this value depending on a command
@@ -96,6 +261,7 @@ def execute(*cmd, **kwargs):
 
     run_as_root = kwargs.pop('run_as_root', False)
     shell = kwargs.pop('shell', False)
+    prefix = scheduling_prefix(kwargs.pop('scheduling', None))
 
     # Ensure all string args (ie for those that send ints and such...)
     execute_cmd = [str(c) for c in cmd]
@@ -105,6 +271,11 @@ def execute(*cmd, **kwargs):
     str_cmd = " ".join(execute_cmd)
     if shell:
         execute_cmd = str_cmd.strip()
+        if prefix:
+            # The whole shell command (not just its first command) gets it
+            execute_cmd = " ".join(prefix + ['sh', '-c', pipes.quote(execute_cmd)])
+    else:
+        execute_cmd = prefix + execute_cmd
 
     stdin_fh = subprocess.PIPE
     stdout_fh = subprocess.PIPE
@@ -224,22 +395,72 @@ def isuseable(path, options=os.W_OK | os.R_OK | os.X_OK):
 # Useful for doing progress bars that get told the current progress
 # for the transfer ever chunk via the chunk callback function that
 # will be called after each chunk has been written...
-def pipe_in_out(in_fh, out_fh, chunk_size=1024, chunk_cb=None):
+def pipe_in_out(in_fh, out_fh, chunk_size=1024, chunk_cb=None, sparse=False):
     bytes_piped = 0
     LOG.debug("Transferring the contents of %s to %s in chunks of size %s.", in_fh, out_fh, chunk_size)
+    writer = out_fh
+    if sparse:
+        writer = SparseWriter(out_fh)
     while True:
         data = in_fh.read(chunk_size)
         if data == '':
             # EOF
             break
         else:
-            out_fh.write(data)
+            writer.write(data)
             bytes_piped += len(data)
             if chunk_cb:
                 chunk_cb(bytes_piped)
+    if sparse:
+        writer.finish()
     return bytes_piped
 
 
+def data_extents(fd, size):
+    # Yields the (offset, length) of each region of the file that has data
+    # (skipping its holes), or the whole file if holes can not be found.
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+            end = os.lseek(fd, start, SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Nothing but a hole from offset till the end
+                return
+            if offset == 0 and e.errno == errno.EINVAL:
+                # Not supported by this kernel (or filesystem)
+                yield (0, size)
+                return
+            raise
+        yield (start, min(end, size) - start)
+        offset = end
+
+
+def copy_sparse(src, dst, chunk_size=1024 * 1024):
+    # Copies only the data regions of the source (keeping it sparse) and
+    # makes holes for any runs of zeros that the source has allocated
+    LOG.debug("Sparsely copying %r to %r", src, dst)
+    if is_dry_run():
+        return dst
+    with open(src, 'rb') as in_fh:
+        size = os.fstat(in_fh.fileno()).st_size
+        with open(dst, 'wb') as out_fh:
+            out_fh.truncate(size)
+            writer = SparseWriter(out_fh)
+            for (offset, length) in data_extents(in_fh.fileno(), size):
+                in_fh.seek(offset)
+                out_fh.seek(offset)
+                while length > 0:
+                    data = in_fh.read(min(chunk_size, length))
+                    if not data:
+                        break
+                    writer.write(data)
+                    length -= len(data)
+            writer.finish()
+    return dst
+
+
 def shellquote(text):
     # TODO(harlowja) find a better way - since there doesn't seem to be a standard lib that actually works
     do_adjust = False
@@ -285,6 +506,10 @@ def isfile(fn):
     return os.path.isfile(fn)
 
 
+def getmtime(fn):
+    return os.path.getmtime(fn)
+
+
 def isdir(path):
     return os.path.isdir(path)
 
@@ -355,46 +580,208 @@ def explode_path(path):
     return _explode_path(path)[0]
 
 
-def _attempt_kill(proc, signal_type, max_try, wait_time):
-    killed = False
-    attempts = 0
-    for _i in range(0, max_try):
-        if not proc.is_running():
-            killed = True
-            break
-        try:
-            LOG.debug("Attempting to kill process %s" % (proc))
-            attempts += 1
-            proc.send_signal(signal_type)
-            LOG.debug("Sleeping for %s seconds before next attempt to kill process %s" % (wait_time, proc))
-            sleep(wait_time)
-        except psutil.error.NoSuchProcess:
-            killed = True
-            break
-        except Exception as e:
-            LOG.debug("Failed killing %s due to: %s", proc, e)
-            LOG.debug("Sleeping for %s seconds before next attempt to kill process %s" % (wait_time, proc))
-            sleep(wait_time)
-    return (killed, attempts)
+def _is_gone(pid):
+    # Processes that have exited but have not been reaped (by there parent)
+    # yet are zombies, which are as good as gone...
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return True
+    info = process_table.read_process(pid)
+    return info is None or info.is_zombie
+
+
+def _is_group_gone(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return True
+    # Only the group (and state) of each process is needed, which is in its
+    # stat file (so the rest of the details are not read)
+    for info in process_table.Snapshot(details=False).refresh().processes():
+        if info.pgid == pgid and not info.is_zombie:
+            return False
+    return True
 
 
-def kill(pid, max_try=4, wait_time=1):
-    if not is_running(pid) or is_dry_run():
+def _wait_gone(is_gone, timeout):
+    # Polls (often at first and then less often) until the process is gone
+    # or the timeout has passed, returning how many polls were done
+    delay = KILL_INITIAL_WAIT
+    start_time = time.time()
+    polls = 0
+    while True:
+        polls += 1
+        if is_gone():
+            return (True, polls)
+        remaining = timeout - (time.time() - start_time)
+        if remaining <= 0:
+            return (False, polls)
+        time.sleep(min(delay, remaining))
+        delay = min(KILL_MAX_WAIT, delay * 2)
+
+
+def _send_signal(pid, pgid, signal_type):
+    if pgid is not None:
+        LOG.debug("Sending signal %s to process group %s (of process %s)", signal_type, pgid, pid)
+        os.killpg(pgid, signal_type)
+    else:
+        LOG.debug("Sending signal %s to process %s", signal_type, pid)
+        os.kill(pid, signal_type)
+
+
+def kill(pid, timeout=KILL_TIMEOUT, group=False):
+    # Tries the nicer sig-int first (and if the process has not exited after
+    # half of the timeout) gets agressive and tries sig-kill, optionally the
+    # whole process group (programs children for example) is signaled and
+    # waited on.
+    if is_dry_run() or _is_gone(pid):
         return (True, 0)
-    proc = Process(pid)
-    # Try the nicer sig-int first...
-    (killed, i_attempts) = _attempt_kill(proc, signal.SIGINT, int(max_try / 2), wait_time)
-    if killed:
-        return (True, i_attempts)
-    # Get agressive and try sig-kill....
-    (killed, k_attempts) = _attempt_kill(proc, signal.SIGKILL, int(max_try / 2), wait_time)
-    if killed:
-        return (True, i_attempts + k_attempts)
+    pgid = None
+    if group:
+        try:
+            pgid = os.getpgid(pid)
+        except OSError:
+            return (True, 0)
+        if pgid == os.getpgid(0):
+            # Never signal the group that we are in (which would include us)
+            LOG.warn("Not killing the process group of %s, it is the same as ours.", pid)
+            pgid = None
+    if pgid is not None:
+        is_gone = functools.partial(_is_group_gone, pgid)
     else:
-        return (False, i_attempts + k_attempts)
+        is_gone = functools.partial(_is_gone, pid)
+    attempts = 0
+    for signal_type in [signal.SIGINT, signal.SIGKILL]:
+        try:
+            _send_signal(pid, pgid, signal_type)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return (True, attempts)
+            LOG.debug("Failed sending signal %s to %s due to: %s", signal_type, pid, e)
+        (gone, polls) = _wait_gone(is_gone, timeout / 2.0)
+        attempts += polls
+        if gone:
+            return (True, attempts)
+    return (False, attempts)
+
+
+class RotatingWriter(object):
+    """
+    Writes to a file that is rotated (to file.1, file.1 to file.2 and so on,
+    keeping at most the given number of older files) instead of growing
+    past a maximum size, rotating at the end of a line when possible.
+
+    Note: this is used in forked processes and so must not log.
+    """
+
+    def __init__(self, path, max_size, backups=OUTPUT_BACKUPS):
+        self.path = path
+        self.max_size = max(1, int(max_size))
+        self.backups = max(0, int(backups))
+        self.fh = open(path, 'wb')
+        self.size = 0
+
+    def _rotate(self):
+        self.fh.close()
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                older = "%s.%s" % (self.path, i)
+                if os.path.exists(older):
+                    os.rename(older, "%s.%s" % (self.path, i + 1))
+            os.rename(self.path, "%s.1" % (self.path))
+        self.fh = open(self.path, 'wb')
+        self.size = 0
+
+    def _write(self, data):
+        self.fh.write(data)
+        self.fh.flush()
+        self.size += len(data)
+
+    def write(self, data):
+        while data:
+            room = self.max_size - self.size
+            if len(data) <= room:
+                self._write(data)
+                break
+            cut = data.rfind("\n", 0, room) + 1
+            if cut <= 0:
+                if self.size:
+                    self._rotate()
+                    continue
+                # A line longer than the whole file, split it...
+                cut = room
+            self._write(data[:cut])
+            data = data[cut:]
+            self._rotate()
+
+    def close(self):
+        self.fh.close()
+
+
+def _capture_rotating(sources, max_size, backups):
+    # Copies what is read from the given (fd, path) sources into rotated
+    # files until all the sources have been closed (by the writing side)
+    writers = {}
+    for (fd, path) in sources:
+        writers[fd] = RotatingWriter(path, max_size, backups)
+    while writers:
+        try:
+            (readable, _writeable, _errored) = select.select(list(writers.keys()), [], [])
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in readable:
+            try:
+                data = os.read(fd, CAPTURE_CHUNK_SIZE)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                data = ''
+            if not data:
+                writers.pop(fd).close()
+                os.close(fd)
+                continue
+            try:
+                writers[fd].write(data)
+            except (IOError, OSError):
+                # Disk full (or similar), the program should keep on
+                # running regardless so just drop what it output...
+                pass
+
+
+def _close_fds(keep=()):
+    # Close other fds (or try)
+    (_soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    mkfd = hard
+    if mkfd == resource.RLIM_INFINITY:
+        mkfd = 2048  # Is this defined anywhere??
+    for fd in range(0, mkfd):
+        if fd in keep:
+            continue
+        try:
+            os.close(fd)
+        except OSError:
+            # Not open, thats ok
+            pass
 
 
-def fork(program, app_dir, pid_fn, stdout_fn, stderr_fn, *args):
+def fork(program, app_dir, pid_fn, stdout_fn, stderr_fn, *args, **kwargs):
+    # When given a maximum output size the programs output goes through
+    # pipes to a separate process that writes it into files that are rotated
+    # when they get to that size (keeping the given number of older files)
+    #
+    # When given a start file the clock tick (since boot) the program started
+    # at is written to it, a process with the programs pid that did not start
+    # at that tick is not the program (its pid was reused)
+    start_fn = kwargs.get('start_fn')
+    output_max_size = kwargs.get('output_max_size', 0)
+    output_backups = kwargs.get('output_backups', OUTPUT_BACKUPS)
+    # Ran with the given scheduling (if any) by exec'ing through a prefix
+    prefix = scheduling_prefix(kwargs.get('scheduling'))
     if is_dry_run():
         return
     # First child, not the real program
@@ -405,38 +792,64 @@ def fork(program, app_dir, pid_fn, stdout_fn, stderr_fn, *args):
         # shall be the process group leader of a new process group,
         # and shall have no controlling terminal.
         os.setsid()
+        outputs = {}
+        if output_max_size > 0:
+            for fn in [stdout_fn, stderr_fn]:
+                if fn:
+                    outputs[fn] = os.pipe()
         pid = os.fork()
         # Fork to get daemon out - this time under init control
         # and now fully detached (no shell possible)
         if pid == 0:
-            # Move to where application should be
-            if app_dir:
-                os.chdir(app_dir)
-            # Close other fds (or try)
-            (_soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
-            mkfd = hard
-            if mkfd == resource.RLIM_INFINITY:
-                mkfd = 2048  # Is this defined anywhere??
-            for fd in range(0, mkfd):
-                try:
-                    os.close(fd)
-                except OSError:
-                    # Not open, thats ok
-                    pass
-            # Now adjust stderr and stdout
-            if stdout_fn:
-                stdoh = open(stdout_fn, "w")
-                os.dup2(stdoh.fileno(), sys.stdout.fileno())
-            if stderr_fn:
-                stdeh = open(stderr_fn, "w")
-                os.dup2(stdeh.fileno(), sys.stderr.fileno())
-            # Now exec...
-            # Note: The arguments to the child process should
-            # start with the name of the command being run
-            prog_little = basename(program)
-            actualargs = [prog_little] + list(args)
-            os.execlp(program, *actualargs)
+            try:
+                # Move to where application should be
+                if app_dir:
+                    os.chdir(app_dir)
+                # Now adjust stderr and stdout
+                keep = []
+                for (fn, std_fd) in [(stdout_fn, STDOUT_FD), (stderr_fn, STDERR_FD)]:
+                    if not fn:
+                        continue
+                    if fn in outputs:
+                        os.dup2(outputs[fn][1], std_fd)
+                    else:
+                        fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+                        os.dup2(fd, std_fd)
+                    keep.append(std_fd)
+                _close_fds(keep)
+                # Now exec...
+                # Note: The arguments to the child process should
+                # start with the name of the command being run
+                prog_little = basename(program)
+                actualargs = [prog_little] + list(args)
+                if prefix:
+                    actualargs = prefix + [program] + list(args)
+                    program = prefix[0]
+                os.execlp(program, *actualargs)
+            finally:
+                # Only gets here if the exec failed, never return to the
+                # callers code (which would then be running twice)
+                os._exit(127)
         else:
+            if outputs:
+                # The output capturer (also under init control)
+                if os.fork() == 0:
+                    # Keeps on capturing (until the output is closed) even
+                    # when the process group is interrupted
+                    signal.signal(signal.SIGINT, signal.SIG_IGN)
+                    sources = [(r, fn) for (fn, (r, _w)) in outputs.items()]
+                    _close_fds([r for (r, _fn) in sources])
+                    try:
+                        _capture_rotating(sources, output_max_size, output_backups)
+                    finally:
+                        os._exit(0)
+                for (r, w) in outputs.values():
+                    os.close(r)
+                    os.close(w)
+            if start_fn:
+                info = process_table.read_process(pid)
+                if info is not None and info.start_ticks is not None:
+                    write_file(start_fn, "%s\n" % (info.start_ticks), quiet=True)
             # Write out the child pid
             contents = "%s\n" % (pid)
             write_file(pid_fn, contents, quiet=True)
@@ -515,6 +928,18 @@ def load_file(fn):
     return data
 
 
+def tail_file(fn, max_bytes):
+    # Reads (at most) the last max_bytes of a file without reading the rest
+    data = ""
+    if not is_dry_run() and max_bytes > 0:
+        with open(fn, "rb") as fh:
+            fh.seek(0, os.SEEK_END)
+            size = fh.tell()
+            fh.seek(max(0, size - max_bytes))
+            data = fh.read(max_bytes)
+    return data
+
+
 def mkdir(path, recurse=True, adjust_suids=False):
     if not isdir(path):
         if recurse:
@@ -738,6 +1163,17 @@ def is_executable(fn):
     return isfile(fn) and isuseable(fn, options=os.X_OK)
 
 
+def which(program, paths=None):
+    # Returns the full path of the given program (or none if not found)
+    if paths is None:
+        paths = os.environ.get('PATH', os.defpath).split(os.pathsep)
+    for path in paths:
+        full_path = joinpths(path, program)
+        if is_executable(full_path):
+            return full_path
+    return None
+
+
 def geteuid():
     return os.geteuid()
 
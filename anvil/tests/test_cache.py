@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from anvil import cache
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _writer(self, contents):
+
+        def fetcher(target):
+            with open(target, 'wb') as fh:
+                fh.write(contents)
+
+        return fetcher
+
+    def test_same_content_stored_once(self):
+        c = cache.ArtifactCache(self.cache_dir)
+        (d1, p1) = c.fetch('http://a/img', self._writer('blah' * 10))
+        (d2, p2) = c.fetch('http://b/img', self._writer('blah' * 10))
+        self.assertEquals(d1, d2)
+        self.assertEquals(p1, p2)
+        self.assertEquals(os.listdir(os.path.join(self.cache_dir, cache.BLOB_DIR)), [d1])
+
+    def test_fetch_uses_index(self):
+        c = cache.ArtifactCache(self.cache_dir)
+        (d1, _p1) = c.fetch('http://a/img', self._writer('blah'))
+
+        def fetcher(target):
+            raise AssertionError("Should not be fetched again")
+
+        (d2, _p2) = c.fetch('http://a/img', fetcher)
+        self.assertEquals(d1, d2)
+
+    def test_stamp_mismatch(self):
+        c = cache.ArtifactCache(self.cache_dir)
+        src = os.path.join(self.tmp_dir, 'local.img')
+        with open(src, 'wb') as fh:
+            fh.write('local')
+        c.add(src, src, stamp='1')
+        self.assertEquals(c.get(src, stamp='2'), (None, None))
+        self.assertNotEquals(c.get(src, stamp='1'), (None, None))
+        self.assertTrue(os.path.isfile(src))
+
+    def test_local_file_copied(self):
+        c = cache.ArtifactCache(self.cache_dir)
+        src = os.path.join(self.tmp_dir, 'local.img')
+        with open(src, 'wb') as fh:
+            fh.write('local')
+        (digest, path) = c.add(src, src)
+        self.assertNotEquals(os.stat(src).st_ino, os.stat(path).st_ino)
+        # Changing the original (in place) must not change what was cached
+        with open(src, 'r+b') as fh:
+            fh.write('LOCAL')
+        self.assertEquals(cache.hash_file(path), digest)
+        self.assertTrue(os.path.isfile(src))
+        self.assertEquals(os.listdir(os.path.join(self.cache_dir, cache.TMP_DIR)), [])
+
+    def test_lru_eviction(self):
+        c = cache.ArtifactCache(self.cache_dir, max_size=25)
+        (d1, _p1) = c.fetch('http://a/1', self._writer('1' * 10))
+        time.sleep(0.01)
+        (d2, _p2) = c.fetch('http://a/2', self._writer('2' * 10))
+        time.sleep(0.01)
+        # Using the first one makes the second the least recently used
+        c.get('http://a/1')
+        time.sleep(0.01)
+        (d3, _p3) = c.fetch('http://a/3', self._writer('3' * 10))
+        self.assertEquals(c.get('http://a/2'), (None, None))
+        self.assertEquals(c.get('http://a/1')[0], d1)
+        self.assertEquals(c.get('http://a/3')[0], d3)
+        self.assertFalse(os.path.exists(c.blob_path(d2)))
+
+    def test_extras_accounted(self):
+        c = cache.ArtifactCache(self.cache_dir, max_size=25)
+        (d1, _p1) = c.fetch('http://a/1', self._writer('1' * 10))
+        os.makedirs(c.extras_path(d1))
+        with open(os.path.join(c.extras_path(d1), 'unpacked'), 'wb') as fh:
+            fh.write('x' * 10)
+        c.refresh(d1)
+        time.sleep(0.01)
+        c.fetch('http://a/2', self._writer('2' * 10))
+        self.assertEquals(c.get('http://a/1'), (None, None))
+        self.assertFalse(os.path.exists(c.extras_path(d1)))
+
+    def test_pinned_not_evicted(self):
+        c = cache.ArtifactCache(self.cache_dir, max_size=25)
+        (d1, _p1) = c.fetch('http://a/1', self._writer('1' * 10), pin=True)
+        time.sleep(0.01)
+        (d2, _p2) = c.fetch('http://a/2', self._writer('2' * 10), pin=True)
+        time.sleep(0.01)
+        # Both are in use, so neither can make room for this one
+        (d3, _p3) = c.fetch('http://a/3', self._writer('3' * 10))
+        self.assertTrue(os.path.exists(c.blob_path(d1)))
+        self.assertTrue(os.path.exists(c.blob_path(d2)))
+        c.unpin(d1)
+        c.unpin(d2)
+        c.evict()
+        self.assertFalse(os.path.exists(c.blob_path(d1)))
+        self.assertTrue(os.path.exists(c.blob_path(d3)))
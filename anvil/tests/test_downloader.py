@@ -0,0 +1,127 @@
+import BaseHTTPServer
+import contextlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+
+from anvil import downloader as down
+
+# Big enough to be split into a few segments
+CONTENT = "".join([chr(i % 251) for i in xrange(0, 64 * 1024)])
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ranges = True
+    # Hang up on these kinds of requests without answering them
+    broken = []
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, code, length):
+        self.send_response(code)
+        self.send_header('Content-Length', str(length))
+        if self.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def _broken(self, kind):
+        if kind in self.broken:
+            self.close_connection = 1
+            return True
+        return False
+
+    def do_HEAD(self):
+        if self._broken('HEAD'):
+            return
+        self._headers(200, len(CONTENT))
+
+    def do_GET(self):
+        wanted = self.headers.get('Range')
+        self.requests.append(wanted)
+        if wanted and self._broken('RANGE'):
+            return
+        match = re.match(r"bytes=(\d+)-(\d+)$", wanted or '')
+        if self.ranges and match:
+            (start, end) = (int(match.group(1)), int(match.group(2)))
+            self._headers(206, end - start + 1)
+            self.wfile.write(CONTENT[start:end + 1])
+        else:
+            self._headers(200, len(CONTENT))
+            self.wfile.write(CONTENT)
+
+
+class TestUrlLibDownloader(unittest.TestCase):
+    def setUp(self):
+        StandInHandler.ranges = True
+        StandInHandler.broken = []
+        StandInHandler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%s/image.img" % (self.server.server_port)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmp_dir, 'image.img')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _read_target(self):
+        with contextlib.closing(open(self.target, 'rb')) as fh:
+            return fh.read()
+
+    def test_segmented(self):
+        fetcher = down.UrlLibDownloader(self.url, self.target, quiet=True,
+                                        segments=4, min_segment_size=1024)
+        (where, amount) = fetcher.download()
+        self.assertEquals(where, self.target)
+        self.assertEquals(amount, len(CONTENT))
+        self.assertEquals(self._read_target(), CONTENT)
+        self.assertEquals(len(StandInHandler.requests), 4)
+        self.assertTrue(all(StandInHandler.requests))
+
+    def test_no_ranges_fallback(self):
+        StandInHandler.ranges = False
+        fetcher = down.UrlLibDownloader(self.url, self.target, quiet=True,
+                                        segments=4, min_segment_size=1024)
+        (_where, amount) = fetcher.download()
+        self.assertEquals(amount, len(CONTENT))
+        self.assertEquals(self._read_target(), CONTENT)
+        self.assertEquals(StandInHandler.requests, [None])
+
+    def test_broken_probe_fallback(self):
+        StandInHandler.broken = ['HEAD']
+        fetcher = down.UrlLibDownloader(self.url, self.target, quiet=True,
+                                        segments=4, min_segment_size=1024)
+        (_where, amount) = fetcher.download()
+        self.assertEquals(amount, len(CONTENT))
+        self.assertEquals(self._read_target(), CONTENT)
+        self.assertEquals(StandInHandler.requests, [None])
+
+    def test_broken_segment_fallback(self):
+        StandInHandler.broken = ['RANGE']
+        fetcher = down.UrlLibDownloader(self.url, self.target, quiet=True,
+                                        segments=4, min_segment_size=1024)
+        (_where, amount) = fetcher.download()
+        self.assertEquals(amount, len(CONTENT))
+        self.assertEquals(self._read_target(), CONTENT)
+        self.assertEquals(StandInHandler.requests[-1], None)
+
+    def test_too_small(self):
+        fetcher = down.UrlLibDownloader(self.url, self.target, quiet=True,
+                                        segments=4, min_segment_size=len(CONTENT))
+        (_where, amount) = fetcher.download()
+        self.assertEquals(amount, len(CONTENT))
+        self.assertEquals(StandInHandler.requests, [None])
+
+    def test_split(self):
+        fetcher = down.UrlLibDownloader(self.url, self.target,
+                                        segments=3, min_segment_size=1)
+        self.assertEquals(fetcher._split(10), [(0, 2), (3, 5), (6, 9)])
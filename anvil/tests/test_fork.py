@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from anvil import components as comp
+from anvil import process_table
+from anvil import shell as sh
+
+from anvil.runners import fork
+
+
+class StandInRuntime(object):
+    def __init__(self, tmp_dir):
+        self.options = {
+            'trace_dir': tmp_dir,
+            'stop_process_group': False,
+        }
+
+    def get_option(self, name, default_value=None):
+        return self.options.get(name, default_value)
+
+    def get_int_option(self, name, default_value=0):
+        return int(self.options.get(name, default_value))
+
+    def get_bool_option(self, name, default_value=False):
+        return bool(self.options.get(name, default_value))
+
+    def app_scheduling(self, app_name):
+        return {}
+
+
+class TestForkRunner(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.runtime = StandInRuntime(self.tmp_dir)
+        self.runner = fork.ForkRunner(self.runtime)
+        self.pid_fn = os.path.join(self.tmp_dir, 'sleeper.fork.pid')
+        self.start_fn = os.path.join(self.tmp_dir, 'sleeper.fork.start')
+
+    def tearDown(self):
+        if os.path.isfile(self.pid_fn):
+            pid = int(sh.load_file(self.pid_fn))
+            if self._alive(pid):
+                sh.kill(pid)
+        shutil.rmtree(self.tmp_dir)
+
+    def _alive(self, pid):
+        # Killed programs may stay zombies until init gets around to them
+        info = process_table.read_process(pid)
+        return info is not None and not info.is_zombie
+
+    def _wait_for(self, fn):
+        # The files are written by the forked (detached) child
+        for _i in range(0, 50):
+            if os.path.isfile(fn) and sh.load_file(fn).strip():
+                return
+            time.sleep(0.1)
+        self.fail("Nothing was written to %s" % (fn))
+
+    def _start(self):
+        self.runner.start('sleeper', 'sleep', self.tmp_dir, ['30'])
+        self._wait_for(self.pid_fn)
+        self._wait_for(self.start_fn)
+        return self.runner.pid('sleeper')
+
+    def test_stop(self):
+        pid = self._start()
+        self.assertEquals(self.runner.status('sleeper')[0], comp.STATUS_STARTED)
+        self.runner.stop('sleeper')
+        self.assertFalse(self._alive(pid))
+        self.assertFalse(os.path.isfile(self.pid_fn))
+        self.assertFalse(os.path.isfile(self.start_fn))
+
+    def test_pid_reused(self):
+        pid = self._start()
+        start_ticks = sh.load_file(self.start_fn).strip()
+        # As if the program exited and something else got its pid
+        sh.write_file(self.start_fn, str(int(start_ticks) + 1))
+        self.assertEquals(self.runner.status('sleeper')[0], comp.STATUS_UNKNOWN)
+        self.assertEquals(self.runner.pid('sleeper'), None)
+        # Also when checked against a (stat only) snapshot that is given
+        snapshot = process_table.Snapshot(details=False).refresh()
+        self.assertEquals(self.runner.pid('sleeper', snapshot=snapshot), None)
+        self.runner.stop('sleeper')
+        # Not killed (it is not the program) and nothing was removed
+        self.assertTrue(self._alive(pid))
+        self.assertTrue(os.path.isfile(self.pid_fn))
+        self.assertTrue(os.path.isfile(self.start_fn))
+        sh.write_file(self.start_fn, start_ticks)
+        self.assertEquals(self.runner.pid('sleeper'), pid)
+        self.assertEquals(self.runner.pid('sleeper', snapshot=snapshot), pid)
+        self.runner.stop('sleeper')
+        self.assertFalse(self._alive(pid))
+        self.assertFalse(os.path.isfile(self.pid_fn))
+
+    def test_rotated_output(self):
+        stdout_fn = os.path.join(self.tmp_dir, 'sleeper.fork.stdout')
+        sh.write_file(stdout_fn + ".2", "oldest\n")
+        sh.write_file(stdout_fn + ".1", "older\n")
+        sh.write_file(stdout_fn, "newest\n")
+        self.assertEquals(self.runner.log_files('sleeper'),
+                          [stdout_fn, stdout_fn + ".1", stdout_fn + ".2",
+                           os.path.join(self.tmp_dir, 'sleeper.fork.stderr')])
+        (_status, details) = self.runner.status('sleeper', details_max=len("older\nnewest\n"))
+        self.assertEquals(details, "older\nnewest")
+        (_status, details) = self.runner.status('sleeper', details_max=len("est\nolder\nnewest\n"))
+        self.assertEquals(details, "est\nolder\nnewest")
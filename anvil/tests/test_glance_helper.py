@@ -0,0 +1,371 @@
+import contextlib
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+import nose
+
+from anvil import cache
+from anvil import shell as sh
+from anvil.components.helpers import glance
+
+
+class StandInImage(object):
+    def __init__(self, image_id, name, checksum=None):
+        self.id = image_id
+        self.name = name
+        self.checksum = checksum
+
+
+class StandInImages(object):
+    def __init__(self, existing):
+        # When set creating waits until this is set (or fails when it is false)
+        self.gate = None
+        self.gate_passes = True
+        self.existing = list(existing)
+        self.list_calls = 0
+        self.created = []
+        self.updated = []
+        self.deleted = []
+        self.contents = {}
+        self.lock = threading.Lock()
+
+    def list(self):
+        self.list_calls += 1
+        for image in self.existing:
+            yield image
+
+    def create(self, data, **kwargs):
+        if self.gate is not None:
+            self.gate.wait()
+            if not self.gate_passes:
+                raise IOError("Upload of %s failed" % (kwargs['name']))
+        contents = ''
+        while True:
+            piece = data.read(3)
+            if not piece:
+                break
+            contents += piece
+        with self.lock:
+            image = StandInImage('id-%s' % (kwargs['name']), kwargs['name'],
+                                 checksum=hashlib.md5(contents).hexdigest())
+            self.existing.append(image)
+            self.created.append(kwargs)
+            self.contents[image.id] = contents
+        return image
+
+    def update(self, image_id, **kwargs):
+        self.updated.append((image_id, kwargs))
+
+    def delete(self, image_id):
+        self.deleted.append(image_id)
+
+
+class StandInClient(object):
+    def __init__(self, existing=()):
+        self.images = StandInImages(existing)
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.client = StandInClient([StandInImage('id-0', 'old', checksum='abc')])
+        self.registry = glance.Registry(self.client)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _location(self):
+        location = {
+            'container_format': 'ami',
+            'disk_format': 'ami',
+        }
+        for kind in ['kernel', 'ramdisk', 'root']:
+            fn = os.path.join(self.tmp_dir, kind)
+            with open(fn, 'wb') as fh:
+                fh.write(kind)
+            if kind == 'root':
+                location['file_name'] = fn
+            else:
+                location[kind] = {
+                    'file_name': fn,
+                    'container_format': kind[0:1] + 'ki',
+                    'disk_format': kind[0:1] + 'ki',
+                }
+        return location
+
+    def test_listed_once(self):
+        self.assertTrue('old' in self.registry)
+        self.assertFalse('new' in self.registry)
+        self.assertEquals(self.registry.find_checksum('abc'), 'id-0')
+        self.assertEquals(self.client.images.list_calls, 1)
+
+    def test_register_updates_index(self):
+        img = glance.Image(self.client, 'http://a/new.tar.gz', True, None,
+                           registry=self.registry)
+        img_id = img._register('new', self._location())
+        self.assertEquals(self.client.images.list_calls, 1)
+        for name in ['new', 'new-vmlinuz', 'new-initrd']:
+            self.assertTrue(name in self.registry)
+        self.assertEquals(self.registry.find_checksum(hashlib.md5('root').hexdigest()), img_id)
+        root_args = self.client.images.created[-1]
+        self.assertEquals(root_args['properties'], {
+            'kernel_id': 'id-new-vmlinuz',
+            'ramdisk_id': 'id-new-initrd',
+        })
+        # Uploading it again is caught without listing again
+        self.assertRaises(IOError, img._register, 'new', self._location())
+        self.assertEquals(self.client.images.list_calls, 1)
+
+    def test_register_reuses_parts(self):
+        self.client.images.existing.append(StandInImage('id-k', 'other-vmlinuz',
+                                                        checksum=hashlib.md5('kernel').hexdigest()))
+        img = glance.Image(self.client, 'http://a/new.tar.gz', True, None,
+                           registry=self.registry)
+        img._register('new', self._location())
+        # The kernel glance already has is used instead of uploading it again
+        created = [c['name'] for c in self.client.images.created]
+        self.assertEquals(created, ['new-initrd', 'new'])
+        self.assertEquals(self.client.images.created[-1]['properties'], {
+            'kernel_id': 'id-k',
+            'ramdisk_id': 'id-new-initrd',
+        })
+        self.assertFalse('new-vmlinuz' in self.registry)
+
+    def test_register_parallel(self):
+        img = glance.Image(self.client, 'http://a/new.tar.gz', True, None,
+                           registry=self.registry, parallel=True)
+        img_id = img._register('new', self._location())
+        self.assertEquals(img_id, 'id-new')
+        created = [c['name'] for c in self.client.images.created]
+        self.assertEquals(sorted(created[0:2]), ['new-initrd', 'new-vmlinuz'])
+        self.assertEquals(created[2], 'new')
+        self.assertEquals(self.client.images.created[2]['properties'], {
+            'kernel_id': 'id-new-vmlinuz',
+            'ramdisk_id': 'id-new-initrd',
+        })
+
+    def test_register_checks_names_first(self):
+        self.registry.add(StandInImage('id-x', 'new'))
+        img = glance.Image(self.client, 'http://a/new.tar.gz', True, None,
+                           registry=self.registry)
+        self.assertRaises(IOError, img._register, 'new', self._location())
+        self.assertEquals(self.client.images.created, [])
+
+    def test_same_name_concurrently(self):
+        # Two urls that end up with the same image name
+        first = glance.Image(self.client, 'http://a/new.tar.gz', True, None,
+                             registry=self.registry, parallel=True)
+        second = glance.Image(self.client, 'http://b/new.tar.gz', True, None,
+                              registry=self.registry, parallel=True)
+        self.client.images.gate = threading.Event()
+        results = []
+        uploader = threading.Thread(target=lambda: results.append(first._register('new', self._location())))
+        uploader.start()
+        try:
+            # Wait for the first one to have started uploading
+            for _i in range(0, 500):
+                if 'new' in self.registry:
+                    break
+                self.client.images.gate.wait(0.01)
+            self.assertRaises(IOError, second._register, 'new', self._location())
+        finally:
+            self.client.images.gate.set()
+            uploader.join()
+        self.assertEquals(results, ['id-new'])
+        created = [c['name'] for c in self.client.images.created]
+        self.assertEquals(sorted(created), ['new', 'new-initrd', 'new-vmlinuz'])
+
+    def test_failed_upload_releases(self):
+        self.client.images.gate = threading.Event()
+        self.client.images.gate.set()
+        self.client.images.gate_passes = False
+        img = glance.Image(self.client, 'http://a/new.tar.gz', True, None,
+                           registry=self.registry)
+        self.assertRaises(IOError, img._register, 'new', self._location())
+        self.assertFalse('new' in self.registry)
+        self.client.images.gate_passes = True
+        self.assertEquals(img._register('new', self._location()), 'id-new')
+
+
+class TestUnpacker(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_tar(self, name, members):
+        src_dir = os.path.join(self.tmp_dir, 'src')
+        os.makedirs(src_dir)
+        arc_fn = os.path.join(self.tmp_dir, name)
+        with contextlib.closing(tarfile.open(arc_fn, 'w:gz')) as tfh:
+            for (member_name, contents) in members:
+                fn = os.path.join(src_dir, os.path.basename(member_name))
+                with open(fn, 'wb') as fh:
+                    fh.write(contents)
+                tfh.add(fn, arcname=member_name)
+        return arc_fn
+
+    def test_unpack_tar(self):
+        arc_fn = self._make_tar('img.tar.gz', [
+            ('img/.hidden.img', 'hidden'),
+            ('img/README', 'readme'),
+            ('img/img-vmlinuz', 'kernel'),
+            ('img/img-initrd', 'ramdisk'),
+            ('img/first.img', 'first'),
+            ('img/img.img', 'root'),
+        ])
+        out_dir = os.path.join(self.tmp_dir, 'out')
+        info = glance.Unpacker().unpack('img.tar.gz', arc_fn, out_dir)
+        self.assertEquals(info['disk_format'], 'ami')
+        # The first root candidate is used (the same as when streaming)
+        for (fn, contents) in [(info['file_name'], 'first'),
+                               (info['kernel']['file_name'], 'kernel'),
+                               (info['ramdisk']['file_name'], 'ramdisk')]:
+            with open(fn, 'rb') as fh:
+                self.assertEquals(fh.read(), contents)
+        # The other root candidate is not extracted
+        extracted = os.listdir(os.path.dirname(info['file_name']))
+        self.assertEquals(sorted(extracted), ['first.img', 'img-initrd', 'img-vmlinuz'])
+
+    def test_unpack_tar_external(self):
+        if not sh.which('gzip'):
+            raise nose.SkipTest("No external gzip available")
+        arc_fn = self._make_tar('img.tar.gz', [
+            ('img/img-vmlinuz', 'kernel'),
+            ('img/img.img', 'root'),
+        ])
+        unpacker = glance.Unpacker(glance.DECOMPRESS_AUTO)
+        # Stand in for pigz (which may not be installed)
+        unpacker._find_decompressor = lambda fn: [sh.which('gzip'), '-dc']
+        info = unpacker.unpack('img.tar.gz', arc_fn, os.path.join(self.tmp_dir, 'out'))
+        with open(info['file_name'], 'rb') as fh:
+            self.assertEquals(fh.read(), 'root')
+        with open(info['kernel']['file_name'], 'rb') as fh:
+            self.assertEquals(fh.read(), 'kernel')
+
+    def test_unpack_tar_external_failure(self):
+        if not sh.which('gzip'):
+            raise nose.SkipTest("No external gzip available")
+        arc_fn = self._make_tar('img.tar.gz', [('img/img.img', 'root')])
+        unpacker = glance.Unpacker(glance.DECOMPRESS_AUTO)
+        # Decompresses fine but then fails (the archive is given as $0)
+        unpacker._find_decompressor = lambda fn: ['sh', '-c', 'gzip -dc "$0"; exit 3']
+        self.assertRaises(IOError, unpacker.unpack,
+                          'img.tar.gz', arc_fn, os.path.join(self.tmp_dir, 'out'))
+
+    def test_unpack_tar_external_broken(self):
+        arc_fn = self._make_tar('img.tar.gz', [('img/img.img', 'root')])
+        unpacker = glance.Unpacker(glance.DECOMPRESS_AUTO)
+        unpacker._find_decompressor = lambda fn: ['false']
+        # What went wrong reading the archive is not replaced
+        self.assertRaises(tarfile.ReadError, unpacker.unpack,
+                          'img.tar.gz', arc_fn, os.path.join(self.tmp_dir, 'out'))
+
+    def test_bad_decompressor(self):
+        self.assertRaises(ValueError, glance.UploadService, {}, {},
+                          cache_dir=self.tmp_dir, decompressor='bogus')
+
+    def test_unpack_tar_no_root(self):
+        arc_fn = self._make_tar('img.tar.gz', [('img/README', 'readme')])
+        self.assertRaises(IOError, glance.Unpacker().unpack,
+                          'img.tar.gz', arc_fn, os.path.join(self.tmp_dir, 'out'))
+
+
+class TestStreamUpload(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.client = StandInClient()
+        self.cache = cache.ArtifactCache(os.path.join(self.tmp_dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_tar(self, members):
+        arc_fn = os.path.join(self.tmp_dir, 'img.tar.gz')
+        with contextlib.closing(tarfile.open(arc_fn, 'w:gz')) as tfh:
+            for (member_name, contents) in members:
+                fn = os.path.join(self.tmp_dir, os.path.basename(member_name))
+                with open(fn, 'wb') as fh:
+                    fh.write(contents)
+                tfh.add(fn, arcname=member_name)
+        return arc_fn
+
+    def test_stream_root_first(self):
+        arc_fn = self._make_tar([
+            ('img/img.img', 'root' * 100),
+            ('img/img-vmlinuz', 'kernel'),
+        ])
+        img = glance.Image(self.client, arc_fn, True, self.cache, stream_upload=True)
+        (name, img_id) = img.install()
+        self.assertEquals(name, 'img')
+        self.assertEquals(self.client.images.contents[img_id], 'root' * 100)
+        self.assertEquals(self.client.images.contents['id-img-vmlinuz'], 'kernel')
+        self.assertEquals(self.client.images.created[0]['size'], 400)
+        # The kernel came after the root so the root gets updated
+        self.assertEquals(self.client.images.updated, [
+            (img_id, {'properties': {'kernel_id': 'id-img-vmlinuz'}, 'purge_props': False}),
+        ])
+        # What was streamed was also cached for later (non-streaming) runs
+        (digest, _path) = self.cache.get(arc_fn, stamp=None)
+        details_fn = os.path.join(self.cache.extras_path(digest), 'details.yaml')
+        self.assertTrue(img._validate_unpacked(details_fn))
+
+    def test_stream_no_root(self):
+        arc_fn = self._make_tar([('img/img-vmlinuz', 'kernel')])
+        img = glance.Image(self.client, arc_fn, True, self.cache, stream_upload=True)
+        self.assertRaises(IOError, img.install)
+        self.assertEquals(self.client.images.deleted, ['id-img-vmlinuz'])
+
+    def test_stream_duplicate_member(self):
+        members = [
+            ('img/img.img', 'root'),
+            ('img/img-vmlinuz', 'kernel'),
+            ('other/img.img', 'other root'),
+        ]
+        arc_fn = self._make_tar(members)
+        img = glance.Image(self.client, arc_fn, True, self.cache, stream_upload=True)
+        (_name, img_id) = img.install()
+        self.assertEquals(self.client.images.contents[img_id], 'root')
+        self.assertEquals(len(self.client.images.created), 2)
+        # Extracting (instead of streaming) picks the same member
+        info = glance.Unpacker().unpack('img.tar.gz', arc_fn, os.path.join(self.tmp_dir, 'out'))
+        with open(info['file_name'], 'rb') as fh:
+            self.assertEquals(fh.read(), 'root')
+
+    def test_same_contents_concurrently(self):
+        arc_fn = self._make_tar([('img/img.img', 'root')])
+        copy_fn = os.path.join(self.tmp_dir, 'copy.tar.gz')
+        shutil.copy(arc_fn, copy_fn)
+        unpacked = []
+        unpack = glance.Unpacker.unpack
+
+        def slow_unpack(unpacker, file_name, file_location, tmp_dir):
+            unpacked.append(file_name)
+            time.sleep(0.2)
+            return unpack(unpacker, file_name, file_location, tmp_dir)
+
+        glance.Unpacker.unpack = slow_unpack
+        try:
+            threads = []
+            for fn in [arc_fn, copy_fn]:
+                img = glance.Image(self.client, fn, True, self.cache, parallel=True)
+                threads.append(threading.Thread(target=img.install))
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            glance.Unpacker.unpack = unpack
+        # Both have the same contents, so the second used what the first unpacked
+        self.assertEquals(len(unpacked), 1)
+        names = sorted([kwargs['name'] for kwargs in self.client.images.created])
+        self.assertEquals(names, ['copy', 'img'])
+        (digest, _path) = self.cache.get(copy_fn)
+        self.assertFalse(digest in self.cache._pinned())
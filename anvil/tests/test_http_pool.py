@@ -0,0 +1,97 @@
+import BaseHTTPServer
+import socket
+import SocketServer
+import threading
+import time
+import unittest
+
+from anvil import http_pool
+from anvil import utils
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    clients = set()
+    methods = []
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        self.clients.add(self.client_address)
+        self.methods.append(self.command)
+        if self.path == '/moved':
+            self.send_response(302)
+            self.send_header('Location', '/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._reply('x' * 100)
+
+    def do_GET(self):
+        self._reply('x' * 100)
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Kept alive connections would otherwise block the single serving thread
+    daemon_threads = True
+
+
+def _unused_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        KeepAliveHandler.clients = set()
+        KeepAliveHandler.methods = []
+        self.server = StandInServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%s/" % (self.server.server_port)
+        self.pool = http_pool.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.clear()
+        http_pool.get_pool().clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        for _i in range(0, 3):
+            resp = self.pool.request('GET', self.url)
+            self.assertEquals(resp.read(), 'x' * 100)
+        self.assertEquals(len(KeepAliveHandler.clients), 1)
+
+    def test_probe_uses_head(self):
+        self.assertEquals(self.pool.probe(self.url), 200)
+        self.assertEquals(KeepAliveHandler.methods, ['HEAD'])
+
+    def test_redirect(self):
+        resp = self.pool.request('GET', self.url + 'moved')
+        self.assertEquals(resp.status, 200)
+        self.assertEquals(resp.read(), 'x' * 100)
+
+    def test_wait_for_url(self):
+        start = time.time()
+        utils.wait_for_url(self.url, timeout=5)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_wait_for_url_timeout(self):
+        url = "http://127.0.0.1:%s/" % (_unused_port())
+        start = time.time()
+        self.assertRaises(IOError, utils.wait_for_url, url, timeout=0.5)
+        self.assertTrue(time.time() - start < 2)
@@ -0,0 +1,382 @@
+import crypt
+import json
+import os
+import shutil
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+from anvil import exceptions as excp
+from anvil.components.helpers import keystone
+
+
+class StandInCatalog(object):
+    def get_token(self):
+        return {
+            'id': 'token',
+            'expires': '2030-01-01T00:00:00Z',
+        }
+
+
+class StandInKeystoneModule(object):
+    made = 0
+
+    class Client(object):
+        def __init__(self, **kwargs):
+            StandInKeystoneModule.made += 1
+            self.auth_token = 'token-%s' % (StandInKeystoneModule.made)
+            self.service_catalog = StandInCatalog()
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'anvil', 'tokens.json')
+        StandInKeystoneModule.made = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_put_get(self):
+        cache = keystone.TokenCache(self.path)
+        self.assertEquals(cache.get('http://k', 'admin', 'admin'), None)
+        cache.put('http://k', 'admin', 'admin', 'abc', time.time() + 3600)
+        self.assertEquals(cache.get('http://k', 'admin', 'admin'), 'abc')
+        self.assertEquals(cache.get('http://k', 'admin', 'service'), None)
+        self.assertEquals(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+
+    def test_near_expiry(self):
+        cache = keystone.TokenCache(self.path, min_remaining=60)
+        cache.put('http://k', 'admin', 'admin', 'abc', time.time() + 30)
+        self.assertEquals(cache.get('http://k', 'admin', 'admin'), None)
+
+    def test_invalidate(self):
+        cache = keystone.TokenCache(self.path)
+        cache.put('http://k', 'admin', 'admin', 'abc', time.time() + 3600)
+        cache.invalidate('http://k', 'admin', 'admin')
+        self.assertEquals(cache.get('http://k', 'admin', 'admin'), None)
+
+    def test_get_token_cached(self):
+        cache = keystone.TokenCache(self.path)
+        for _i in range(0, 3):
+            token = keystone.get_token(StandInKeystoneModule, 'http://k', 'admin',
+                                       'secret', 'admin', cache=cache)
+            self.assertEquals(token, 'token-1')
+        self.assertEquals(StandInKeystoneModule.made, 1)
+        # The expiry given by keystone is what is remembered
+        with open(self.path, 'rb') as fh:
+            self.assertTrue('1893456000' in fh.read())
+
+    def test_get_token_password_lazy(self):
+        cache = keystone.TokenCache(self.path)
+        asked = []
+
+        def password():
+            asked.append(True)
+            return 'secret'
+
+        cache.put('http://k', 'admin', 'admin', 'abc', time.time() + 3600)
+        token = keystone.get_token(StandInKeystoneModule, 'http://k', 'admin',
+                                   password, 'admin', cache=cache)
+        self.assertEquals((token, asked), ('abc', []))
+        # A rejected token is invalidated, now the password is needed
+        cache.invalidate('http://k', 'admin', 'admin')
+        token = keystone.get_token(StandInKeystoneModule, 'http://k', 'admin',
+                                   password, 'admin', cache=cache)
+        self.assertEquals((token, asked), ('token-1', [True]))
+
+
+class StandInEntity(object):
+    def __init__(self, kind, name, details):
+        self.id = "%s-%s" % (kind, name)
+        self.name = name
+        for (k, v) in details.items():
+            setattr(self, k, v)
+        if kind == 'services':
+            self.type = details.get('service_type')
+
+
+class StandInManager(object):
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+        self.entities = {}
+
+    def _record(self, name, details=None, call='create'):
+        with self.client.lock:
+            if name in self.client.fail_on:
+                raise IOError("Failed making %s" % (name))
+            self.client.calls.append((self.kind, name, details or {}, call))
+            self.client.threads.add(threading.current_thread().name)
+        # Give others a chance to run at the same time
+        time.sleep(0.01)
+        return StandInEntity(self.kind, name, details or {})
+
+    def list(self):
+        return list(self.entities.values())
+
+    def create(self, *args, **kwargs):
+        if args:
+            name = args[0]
+        else:
+            name = kwargs.get('name') or kwargs.get('tenant_name') or kwargs.get('region')
+        entity = self._record(name, kwargs)
+        if self.kind == 'endpoints':
+            entity.id = "endpoint-%s-%s" % (kwargs['service_id'], kwargs['region'])
+        with self.client.lock:
+            self.entities[entity.id] = entity
+        return entity
+
+    def update(self, entity, **kwargs):
+        if not isinstance(entity, basestring):
+            entity = entity.id
+        self._record(entity, kwargs, call='update')
+        for (k, v) in kwargs.items():
+            setattr(self.entities[entity], k, v)
+
+    def update_password(self, user, password):
+        self._record(user.id, {'password': password}, call='password')
+
+    def delete(self, entity_id):
+        self._record(entity_id, call='delete')
+        with self.client.lock:
+            self.entities.pop(entity_id)
+
+    def add_user_role(self, user, role, tenant):
+        self._record("%s:%s:%s" % (user.name, role.name, tenant.name), call='add')
+        with self.client.lock:
+            self.client.bindings.setdefault((user.id, tenant.id), []).append(role)
+
+    def roles_for_user(self, user, tenant):
+        self._record("%s:%s" % (user.name, tenant.name), call='get')
+        with self.client.lock:
+            return list(self.client.bindings.get((user.id, tenant.id), []))
+
+
+class StandInAdminClient(object):
+    def __init__(self, fail_on=()):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.threads = set()
+        self.bindings = {}
+        self.fail_on = list(fail_on)
+        for kind in ['tenants', 'users', 'roles', 'services', 'endpoints']:
+            setattr(self, kind, StandInManager(self, kind))
+
+
+class StandInInitializer(keystone.Initializer):
+    def __init__(self, client, max_workers):
+        keystone.Initializer.__init__(self, 'token', 'http://k', max_workers=max_workers)
+        self.client = client
+
+    def _get_client(self):
+        return self.client
+
+
+def _catalog(user_count=10):
+    users = []
+    for i in range(0, user_count):
+        users.append({
+            'name': 'user%s' % (i),
+            'password': 'pw',
+            'email': 'user%s@example.com' % (i),
+            'roles': ['member:service', 'admin:admin'],
+        })
+    return {
+        'tenants': [
+            {'name': 'admin', 'description': 'Admins'},
+            {'name': 'service', 'description': 'Services'},
+        ],
+        'users': users,
+        'roles': ['admin', 'member'],
+        'services': [{'name': 'glance', 'type': 'image'}],
+        'endpoints': [{
+            'service': 'glance',
+            'region': 'RegionOne',
+            'public_url': 'http://g',
+            'admin_url': 'http://g',
+            'internal_url': 'http://g',
+        }],
+    }
+
+
+class TestInitializer(unittest.TestCase):
+    def test_levels(self):
+        client = StandInAdminClient()
+        StandInInitializer(client, 4).initialize(**_catalog())
+        kinds = [c[0] for c in client.calls]
+        self.assertEquals(len(kinds), 2 + 10 + 2 + 1 + 20 + 1)
+        # Nothing in the second level happens before the first level is done
+        last_first = max([i for (i, k) in enumerate(kinds) if k in ['tenants', 'users', 'services']])
+        first_second = min([i for (i, k) in enumerate(kinds) if k == 'endpoints'])
+        self.assertTrue(last_first < first_second)
+        endpoint = [c for c in client.calls if c[0] == 'endpoints'][0]
+        self.assertEquals(endpoint[2]['service_id'], 'services-glance')
+        self.assertTrue(len(client.threads) > 1)
+
+    def test_nothing_changed(self):
+        client = StandInAdminClient()
+        StandInInitializer(client, 4).initialize(**_catalog())
+        client.calls = []
+        StandInInitializer(client, 4).initialize(**_catalog())
+        # Only lookups of the existing role bindings are done
+        self.assertEquals(set([c[3] for c in client.calls]), set(['get']))
+
+    def test_changes_only(self):
+        client = StandInAdminClient()
+        StandInInitializer(client, 4).initialize(**_catalog())
+        client.calls = []
+        catalog = _catalog(user_count=11)
+        catalog['tenants'][0]['description'] = 'Administrators'
+        catalog['endpoints'][0]['public_url'] = 'http://g2'
+        StandInInitializer(client, 4).initialize(**catalog)
+        changes = sorted([(c[0], c[1], c[3]) for c in client.calls if c[3] != 'get'])
+        self.assertEquals(changes, [
+            ('endpoints', 'RegionOne', 'create'),
+            ('endpoints', 'endpoint-services-glance-RegionOne', 'delete'),
+            ('roles', 'user10:admin:admin', 'add'),
+            ('roles', 'user10:member:service', 'add'),
+            ('tenants', 'tenants-admin', 'update'),
+            ('users', 'user10', 'create'),
+        ])
+        self.assertTrue(len(client.threads) > 1)
+
+    def test_password_changed(self):
+        client = StandInAdminClient()
+        applied = _catalog()
+        StandInInitializer(client, 4).initialize(**applied)
+        client.calls = []
+        catalog = _catalog()
+        catalog['users'][1]['password'] = 'new-pw'
+        catalog['users'][2]['email'] = 'other@example.com'
+        StandInInitializer(client, 4).initialize(applied=applied, **catalog)
+        changes = sorted([(c[0], c[1], c[2], c[3]) for c in client.calls if c[3] != 'get'])
+        self.assertEquals(changes, [
+            ('users', 'users-user1', {'password': 'new-pw'}, 'password'),
+            ('users', 'users-user2', {'email': 'other@example.com'}, 'update'),
+        ])
+        # Without knowing what was applied passwords are left alone
+        client.calls = []
+        StandInInitializer(client, 4).initialize(**catalog)
+        self.assertEquals(set([c[3] for c in client.calls]), set(['get']))
+
+    def test_failures_aggregated(self):
+        client = StandInAdminClient(fail_on=['user3', 'user7'])
+        initializer = StandInInitializer(client, 4)
+        try:
+            initializer.initialize(**_catalog())
+            self.fail("Initializing should have failed")
+        except excp.InitializeException as e:
+            self.assertEquals(sorted([what for (what, _e) in e.failures]),
+                              [('user', 'user3'), ('user', 'user7')])
+        # The second level is never started
+        self.assertFalse([c for c in client.calls if c[0] == 'endpoints'])
+
+    def test_bad_reference(self):
+        client = StandInAdminClient()
+        catalog = _catalog()
+        catalog['users'][0]['roles'].append('missing:admin')
+        self.assertRaises(RuntimeError, StandInInitializer(client, 4).initialize, **catalog)
+        self.assertEquals(client.calls, [])
+
+
+# Roughly what keystone (folsom) creates when its database is synced
+OLD_SCHEMA = [
+    'CREATE TABLE tenant (id VARCHAR(64) PRIMARY KEY, name VARCHAR(64) UNIQUE, extra TEXT)',
+    'CREATE TABLE user (id VARCHAR(64) PRIMARY KEY, name VARCHAR(64) UNIQUE, extra TEXT)',
+    'CREATE TABLE role (id VARCHAR(64) PRIMARY KEY, name VARCHAR(64) UNIQUE, extra TEXT)',
+    'CREATE TABLE metadata (user_id VARCHAR(64), tenant_id VARCHAR(64), data TEXT)',
+    'CREATE TABLE user_tenant_membership (user_id VARCHAR(64), tenant_id VARCHAR(64))',
+    'CREATE TABLE service (id VARCHAR(64) PRIMARY KEY, type VARCHAR(255), extra TEXT)',
+    'CREATE TABLE endpoint (id VARCHAR(64) PRIMARY KEY, region VARCHAR(255), '
+    'service_id VARCHAR(64), extra TEXT)',
+]
+
+# Roughly what keystone (grizzly) creates when its database is synced
+NEW_SCHEMA = [
+    'CREATE TABLE project (id VARCHAR(64) PRIMARY KEY, name VARCHAR(64), '
+    'domain_id VARCHAR(64) NOT NULL, description TEXT, enabled INTEGER, extra TEXT, '
+    'UNIQUE (domain_id, name))',
+    'CREATE TABLE user (id VARCHAR(64) PRIMARY KEY, name VARCHAR(64), '
+    'domain_id VARCHAR(64) NOT NULL, password VARCHAR(128), enabled INTEGER, extra TEXT, '
+    'UNIQUE (domain_id, name))',
+    'CREATE TABLE role (id VARCHAR(64) PRIMARY KEY, name VARCHAR(64) UNIQUE, extra TEXT)',
+    'CREATE TABLE user_project_metadata (user_id VARCHAR(64), project_id VARCHAR(64), data TEXT)',
+    'CREATE TABLE service (id VARCHAR(64) PRIMARY KEY, type VARCHAR(255), extra TEXT)',
+    'CREATE TABLE endpoint (id VARCHAR(64) PRIMARY KEY, legacy_endpoint_id VARCHAR(64), '
+    'interface VARCHAR(8), region VARCHAR(255), service_id VARCHAR(64), url TEXT, extra TEXT)',
+]
+
+
+class TestSqlInitializer(unittest.TestCase):
+    def _connect(self, schema):
+        conn = sqlite3.connect(':memory:')
+        for statement in schema:
+            conn.execute(statement)
+        conn.commit()
+        return conn
+
+    def _initializer(self, conn):
+        return keystone.SqlInitializer(conn, sqlite3.paramstyle, hash_rounds=1000)
+
+    def _select(self, conn, sql):
+        return conn.execute(sql).fetchall()
+
+    def test_old_schema(self):
+        conn = self._connect(OLD_SCHEMA)
+        catalog = _catalog(user_count=2)
+        self._initializer(conn).initialize(**catalog)
+        self.assertEquals(self._select(conn, 'SELECT COUNT(*) FROM tenant'), [(2,)])
+        (user_id, extra) = self._select(conn, "SELECT id, extra FROM user WHERE name = 'user0'")[0]
+        extra = json.loads(extra)
+        self.assertTrue(extra['password'].startswith('$6$rounds=1000$'))
+        self.assertEquals(crypt.crypt('pw', extra['password']), extra['password'])
+        self.assertEquals(extra['email'], 'user0@example.com')
+        roles = self._select(conn, "SELECT data FROM metadata WHERE user_id = '%s'" % (user_id))
+        self.assertEquals(len(roles), 2)
+        for (data,) in roles:
+            self.assertEquals(len(json.loads(data)['roles']), 1)
+        self.assertEquals(len(self._select(conn, 'SELECT * FROM user_tenant_membership')), 4)
+        (service_id, extra) = self._select(conn, 'SELECT id, extra FROM service')[0]
+        self.assertEquals(json.loads(extra)['name'], 'glance')
+        (ep_service_id, extra) = self._select(conn, 'SELECT service_id, extra FROM endpoint')[0]
+        self.assertEquals(ep_service_id, service_id)
+        self.assertEquals(json.loads(extra)['publicurl'], 'http://g')
+
+    def test_new_schema(self):
+        conn = self._connect(NEW_SCHEMA)
+        catalog = _catalog(user_count=2)
+        self._initializer(conn).initialize(**catalog)
+        self.assertEquals(self._select(conn, "SELECT description, enabled, domain_id FROM project WHERE name = 'admin'"),
+                          [('Admins', 1, 'default')])
+        (password, domain_id, extra) = self._select(conn, "SELECT password, domain_id, extra FROM user WHERE name = 'user1'")[0]
+        self.assertEquals(crypt.crypt('pw', password), password)
+        self.assertEquals(domain_id, 'default')
+        self.assertFalse('domain_id' in json.loads(extra))
+        endpoints = self._select(conn, 'SELECT legacy_endpoint_id, interface FROM endpoint')
+        self.assertEquals(sorted([e[1] for e in endpoints]), ['admin', 'internal', 'public'])
+        self.assertEquals(len(set([e[0] for e in endpoints])), 1)
+        self.assertEquals(len(self._select(conn, 'SELECT * FROM user_project_metadata')), 4)
+
+    def test_not_fresh(self):
+        conn = self._connect(NEW_SCHEMA)
+        catalog = _catalog(user_count=2)
+        self._initializer(conn).initialize(**catalog)
+        self.assertRaises(excp.InitializeException, self._initializer(conn).initialize, **catalog)
+        self.assertEquals(self._select(conn, 'SELECT COUNT(*) FROM project'), [(2,)])
+
+    def test_rolled_back(self):
+        conn = self._connect(NEW_SCHEMA)
+        catalog = _catalog(user_count=2)
+        catalog['endpoints'].append(dict(catalog['endpoints'][0]))
+        catalog['endpoints'][1]['service'] = 'missing'
+        self.assertRaises(RuntimeError, self._initializer(conn).initialize, **catalog)
+        conn.execute("CREATE TRIGGER broken BEFORE INSERT ON endpoint "
+                     "BEGIN SELECT RAISE(ABORT, 'broken'); END")
+        catalog['endpoints'].pop()
+        self.assertRaises(sqlite3.Error, self._initializer(conn).initialize, **catalog)
+        for table in ['project', 'user', 'role', 'service', 'user_project_metadata']:
+            self.assertEquals(self._select(conn, 'SELECT COUNT(*) FROM %s' % (table)), [(0,)])
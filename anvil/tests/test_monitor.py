@@ -0,0 +1,82 @@
+import csv
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from anvil import monitor
+
+
+class TestSampler(unittest.TestCase):
+    def setUp(self):
+        # A shell with a child (the child should be counted as part of it)
+        self.proc = subprocess.Popen(['sh', '-c', 'sleep 10 & wait'])
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        subprocess.call(['pkill', '-P', str(self.proc.pid)])
+        self.proc.kill()
+        self.proc.wait()
+        shutil.rmtree(self.tmp_dir)
+
+    def _wait_for_child(self, sampler):
+        for _i in range(0, 100):
+            samples = sampler.sample([('comp', 'app', self.proc.pid)])
+            if samples[0]['processes'] == 2:
+                return samples
+            time.sleep(0.05)
+        return samples
+
+    def test_sample(self):
+        sampler = monitor.Sampler()
+        samples = self._wait_for_child(sampler)
+        self.assertEquals(len(samples), 1)
+        sample = samples[0]
+        self.assertEquals(sample['pid'], self.proc.pid)
+        self.assertEquals(sample['processes'], 2)
+        self.assertTrue(sample['rss'] > 0)
+        self.assertTrue(sample['threads'] >= 2)
+        self.assertTrue(sample['fds'] > 0)
+        self.assertTrue(sample['cpu_percent'] >= 0)
+        again = sampler.sample([('comp', 'app', self.proc.pid)])[0]
+        self.assertTrue(again['time'] >= sample['time'])
+        # Taken from the (one) snapshot given
+        snapshot = sampler.snapshot()
+        self.assertFalse(snapshot.details)
+        given = sampler.sample([('comp', 'app', self.proc.pid)], snapshot=snapshot)[0]
+        self.assertEquals(given['time'], snapshot.taken)
+        self.assertEquals(given['processes'], 2)
+
+    def test_not_running(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        samples = monitor.Sampler().sample([('comp', 'gone', proc.pid), ('comp', 'unknown', None)])
+        for sample in samples:
+            self.assertEquals(sample['processes'], None)
+            self.assertEquals(sample['rss'], None)
+        lines = monitor.format_table(samples)
+        self.assertEquals(len(lines), 3)
+        self.assertTrue(lines[0].startswith('COMPONENT'))
+        self.assertTrue('gone' in lines[1])
+
+    def test_writers(self):
+        samples = self._wait_for_child(monitor.Sampler())
+        csv_fn = os.path.join(self.tmp_dir, 'samples.csv')
+        json_fn = os.path.join(self.tmp_dir, 'samples.jsonl')
+        for fn in [csv_fn, json_fn]:
+            writer = monitor.make_writer(fn)
+            writer.write(samples)
+            writer.write(samples)
+            writer.close()
+        with open(csv_fn, 'rb') as fh:
+            rows = list(csv.DictReader(fh))
+        self.assertEquals(len(rows), 2)
+        self.assertEquals(int(rows[0]['pid']), self.proc.pid)
+        with open(json_fn, 'rb') as fh:
+            rows = [json.loads(line) for line in fh]
+        self.assertEquals(len(rows), 2)
+        self.assertEquals(rows[1]['processes'], 2)
+        self.assertRaises(TypeError, monitor.SampleWriter, json_fn)
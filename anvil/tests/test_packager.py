@@ -0,0 +1,248 @@
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+from anvil import components as comp
+from anvil import exceptions as excp
+from anvil import packager as pack
+from anvil import shell as sh
+from anvil import trace as tr
+
+# Shared by the stand-in packagers so that the tests can see what happened
+INSTALLED = []
+TRANSACTIONS = []
+HOOKED = []
+
+
+class StandInPackageObject(object):
+    def verGE(self, other):
+        return True
+
+
+def _import_yum_packager():
+    # The yum module is only there on distros that use yum, when it is not
+    # the yum packager is imported with stand-ins for what importing it needs
+    # (which are then taken away again, so only this test sees them)
+    try:
+        from anvil.packaging import yum
+        return yum
+    except ImportError:
+        pass
+    yum_module = types.ModuleType('yum')
+    yum_module.YumBase = object
+    packages_module = types.ModuleType('yum.packages')
+    packages_module.PackageObject = StandInPackageObject
+    yum_module.packages = packages_module
+    stand_ins = {
+        'yum': yum_module,
+        'yum.packages': packages_module,
+    }
+    imported = ['anvil.packaging.yum', 'anvil.packaging.helpers.yum_helper']
+    for name in imported:
+        sys.modules.pop(name, None)
+    sys.modules.update(stand_ins)
+    try:
+        from anvil.packaging import yum
+        return yum
+    finally:
+        for name in stand_ins.keys() + imported:
+            sys.modules.pop(name, None)
+        import anvil.packaging
+        import anvil.packaging.helpers
+        for (module, name) in [(anvil.packaging, 'yum'), (anvil.packaging.helpers, 'yum_helper')]:
+            if hasattr(module, name):
+                delattr(module, name)
+
+
+yum = _import_yum_packager()
+
+
+class StandInPackager(pack.Packager):
+    def _anything_there(self, pkg):
+        if pkg['name'] in INSTALLED:
+            return pkg['name']
+        return None
+
+    def _install(self, pkg):
+        TRANSACTIONS.append([pkg['name']])
+        INSTALLED.append(pkg['name'])
+
+    def _remove(self, pkg):
+        pass
+
+
+class BatchingPackager(StandInPackager):
+    def install_batch(self, pkgs):
+        names = [p['name'] for p in pkgs if not self._anything_there(p)]
+        if names:
+            TRANSACTIONS.append(names)
+            INSTALLED.extend(names)
+
+
+class StandInYumHelper(object):
+    # Instead of reading the rpm database
+    uncached = 0
+
+    def get_installed(self, name):
+        if name in INSTALLED:
+            return [StandInPackageObject()]
+        return []
+
+    def uncache(self):
+        StandInYumHelper.uncached += 1
+
+
+class StandInYumPackager(yum.YumPackager):
+    def __init__(self, distro, remove_default=False):
+        yum.YumPackager.__init__(self, distro, remove_default)
+        self.helper = StandInYumHelper()
+
+    def _install_special(self, name, info):
+        if name.startswith('special'):
+            HOOKED.append(('special', name))
+            return True
+        return False
+
+    def _installed(self, pkg):
+        HOOKED.append(('installed', pkg['name']))
+
+
+class StandInDistro(object):
+    package_manager_class = BatchingPackager
+
+
+class StandInYumDistro(object):
+    package_manager_class = StandInYumPackager
+
+
+class StandInInstaller(comp.PkgInstallComponent):
+    def __init__(self, tmp_dir, name, pkgs, batching, distro=None):
+        options = {
+            'trace_dir': tmp_dir,
+            'packages': pkgs,
+            'package_batching': batching,
+        }
+        comp.PkgInstallComponent.__init__(self, name, {}, {}, options, {}, distro or StandInDistro(), {})
+
+
+class TestBatching(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        del INSTALLED[:]
+        del TRANSACTIONS[:]
+        self.pkgs = [
+            {'name': 'a'},
+            {'name': 'b', 'packager_name': 'anvil.tests.test_packager:StandInPackager'},
+            {'name': 'c'},
+            {'name': 'd', 'packager_name': 'anvil.tests.test_packager:StandInPackager'},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _traced(self, installer):
+        reader = tr.TraceReader(installer.tracewriter.filename())
+        return [p['name'] for p in reader.packages_installed()]
+
+    def test_group(self):
+        groups = comp.group_packages(self.pkgs, StandInDistro())
+        self.assertEquals([[p['name'] for p in group] for (_installer, group) in groups],
+                          [['a', 'c'], ['b', 'd']])
+
+    def test_component(self):
+        INSTALLED.append('c')
+        installer = StandInInstaller(self.tmp_dir, 'stand-in', self.pkgs, comp.BATCH_COMPONENT)
+        installer.install()
+        self.assertEquals(TRANSACTIONS, [['a'], ['b'], ['d']])
+        # Everything is still recorded (even what was already there)
+        self.assertEquals(self._traced(installer), ['a', 'c', 'b', 'd'])
+
+    def test_none(self):
+        installer = StandInInstaller(self.tmp_dir, 'stand-in', self.pkgs[0:1] + self.pkgs[2:3], comp.BATCH_NONE)
+        installer.install()
+        self.assertEquals(TRANSACTIONS, [['a'], ['c']])
+
+    def test_none_order(self):
+        # Installed in the order listed (not grouped by packager)
+        installer = StandInInstaller(self.tmp_dir, 'stand-in', self.pkgs, comp.BATCH_NONE)
+        installer.install()
+        self.assertEquals(TRANSACTIONS, [['a'], ['b'], ['c'], ['d']])
+        self.assertEquals(self._traced(installer), ['a', 'b', 'c', 'd'])
+
+    def test_persona(self):
+        first = StandInInstaller(self.tmp_dir, 'first', [{'name': 'a'}, {'name': 'c'}], comp.BATCH_PERSONA)
+        second = StandInInstaller(self.tmp_dir, 'second', [{'name': 'e'}, {'name': 'a'}], comp.BATCH_PERSONA)
+        self.assertEquals(comp.install_packages([first, second]), 3)
+        self.assertEquals(TRANSACTIONS, [['a', 'c', 'e']])
+        first.install()
+        second.install()
+        self.assertEquals(len(TRANSACTIONS), 1)
+
+
+class TestYumBatching(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        del INSTALLED[:]
+        del TRANSACTIONS[:]
+        del HOOKED[:]
+        StandInYumHelper.uncached = 0
+        # Yum itself is not ran, what it would have been ran with is kept
+        self.execute = sh.execute
+        sh.execute = self._execute
+
+    def tearDown(self):
+        sh.execute = self.execute
+        shutil.rmtree(self.tmp_dir)
+
+    def _execute(self, *cmd, **kwargs):
+        names = list(cmd[len(yum.YUM_CMD + yum.YUM_INSTALL):])
+        TRANSACTIONS.append(names)
+        if 'broken' in names:
+            raise excp.ProcessExecutionError(cmd=" ".join(cmd), exit_code=1)
+        for name in names:
+            # Without the version (if any) that it was asked for with
+            if '-' in name and name.rsplit('-', 1)[1][0].isdigit():
+                name = name.rsplit('-', 1)[0]
+            INSTALLED.append(name)
+        return ('', '')
+
+    def test_batch(self):
+        INSTALLED.append('b')
+        packager = StandInYumPackager(None)
+        pkgs = [
+            {'name': 'a'},
+            {'name': 'b'},
+            {'name': 'special-c'},
+            {'name': 'd', 'version': '1.0'},
+            {'name': 'd', 'version': '1.0'},
+        ]
+        packager.install_batch(pkgs)
+        # One transaction (without what is already there, or is special)
+        self.assertEquals(TRANSACTIONS, [['a', 'd-1.0']])
+        self.assertEquals(HOOKED, [('special', 'special-c'), ('installed', 'a'),
+                                   ('installed', 'd'), ('installed', 'd')])
+        self.assertEquals(StandInYumHelper.uncached, 1)
+        # Nothing left to do
+        packager.install_batch(pkgs)
+        self.assertEquals(len(TRANSACTIONS), 1)
+
+    def test_batch_failed(self):
+        packager = StandInYumPackager(None)
+        self.assertRaises(excp.ProcessExecutionError, packager.install_batch,
+                          [{'name': 'a'}, {'name': 'broken'}])
+        self.assertEquals(HOOKED, [])
+        # What is installed may have changed anyway
+        self.assertEquals(StandInYumHelper.uncached, 1)
+
+    def test_components(self):
+        first = StandInInstaller(self.tmp_dir, 'first', [{'name': 'a'}, {'name': 'c'}],
+                                 comp.BATCH_PERSONA, distro=StandInYumDistro())
+        second = StandInInstaller(self.tmp_dir, 'second', [{'name': 'e'}, {'name': 'a'}],
+                                  comp.BATCH_PERSONA, distro=StandInYumDistro())
+        self.assertEquals(comp.install_packages([first, second]), 3)
+        self.assertEquals(TRANSACTIONS, [['a', 'c', 'e']])
+        first.install()
+        second.install()
+        self.assertEquals(len(TRANSACTIONS), 1)
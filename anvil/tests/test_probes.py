@@ -0,0 +1,130 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from anvil import probes
+
+
+class TestProbes(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_tcp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        probe = probes.TcpProbe('127.0.0.1', port, timeout=0.5)
+        # Bound but not yet listening
+        self.assertFalse(probe.check()[0])
+        sock.listen(1)
+        try:
+            self.assertEquals(probe.check(), (True, None))
+        finally:
+            sock.close()
+
+    def test_log(self):
+        log_fn = os.path.join(self.tmp_dir, 'app.stderr')
+        probe = probes.LogProbe([log_fn], r'Started on port \d+$')
+        self.assertFalse(probe.check()[0])
+        with open(log_fn, 'ab') as fh:
+            fh.write("Starting up\nStarted on port 1")
+        # The line is not complete yet (more digits may be coming)
+        self.assertFalse(probe.check()[0])
+        with open(log_fn, 'ab') as fh:
+            fh.write("2\n")
+        self.assertEquals(probe.check(), (True, None))
+
+    def test_log_truncated(self):
+        log_fn = os.path.join(self.tmp_dir, 'app.stdout')
+        with open(log_fn, 'wb') as fh:
+            fh.write("blah\n" * 100)
+        probe = probes.LogProbe([log_fn], r'^ready$')
+        self.assertFalse(probe.check()[0])
+        with open(log_fn, 'wb') as fh:
+            fh.write("ready\n")
+        self.assertEquals(probe.check(), (True, None))
+
+    def test_log_left_over(self):
+        log_fn = os.path.join(self.tmp_dir, 'app.stdout')
+        with open(log_fn, 'wb') as fh:
+            fh.write("ready\n")
+        probe = probes.LogProbe([log_fn], r'^ready$')
+        # That was from a previous run
+        self.assertFalse(probe.check()[0])
+        probe.rewind()
+        self.assertEquals(probe.check(), (True, None))
+
+    def test_log_large(self):
+        log_fn = os.path.join(self.tmp_dir, 'app.stdout')
+        probe = probes.LogProbe([log_fn], r'^ready$')
+        with open(log_fn, 'wb') as fh:
+            fh.write(("x" * 99 + "\n") * (3 * probes.LOG_CHUNK_SIZE / 100))
+            fh.write("ready\n")
+        self.assertEquals(probe.check(), (True, None))
+        # Stays ready (even when the file is then rotated away)
+        os.rename(log_fn, log_fn + ".1")
+        with open(log_fn, 'wb') as fh:
+            fh.write("blah\n" * 100)
+        self.assertEquals(probe.check(), (True, None))
+
+    def test_log_replaced(self):
+        log_fn = os.path.join(self.tmp_dir, 'app.stdout')
+        with open(log_fn, 'wb') as fh:
+            fh.write("blah\n")
+        probe = probes.LogProbe([log_fn], r'^ready$')
+        # Replaced by a new (bigger) file, which is read from its start
+        os.rename(log_fn, log_fn + ".1")
+        with open(log_fn, 'wb') as fh:
+            fh.write("ready\n" + "blah\n" * 10)
+        self.assertEquals(probe.check(), (True, None))
+
+    def test_log_rotated(self):
+        log_fn = os.path.join(self.tmp_dir, 'app.stdout')
+        with open(log_fn, 'wb') as fh:
+            fh.write("ready\n")
+        probe = probes.LogProbe([log_fn, log_fn + ".1"], r'^ready$')
+        # Rotated away (but that was from a previous run)
+        os.rename(log_fn, log_fn + ".1")
+        with open(log_fn, 'wb') as fh:
+            fh.write("blah\n")
+        self.assertFalse(probe.check()[0])
+        with open(log_fn, 'ab') as fh:
+            fh.write("rea")
+        self.assertFalse(probe.check()[0])
+        # The rest of the line goes out before it gets rotated
+        with open(log_fn, 'ab') as fh:
+            fh.write("dy\n")
+        os.rename(log_fn, log_fn + ".1")
+        with open(log_fn, 'wb') as fh:
+            fh.write("blah\n")
+        self.assertEquals(probe.check(), (True, None))
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, probes.Probe, 'abstract')
+
+    def test_wait_for(self):
+        calls = []
+
+        def ready_third_time():
+            calls.append(time.time())
+            return (len(calls) >= 3, 'not yet')
+
+        start = time.time()
+        failures = probes.wait_for([probes.CallableProbe('third', ready_third_time)], timeout=5)
+        self.assertEquals(failures, [])
+        self.assertEquals(len(calls), 3)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_wait_for_timeout(self):
+        never = probes.CallableProbe('never', lambda: (False, 'broken'))
+        always = probes.CallableProbe('always', lambda: (True, None))
+        start = time.time()
+        failures = probes.wait_for([always, never], timeout=0.3)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEquals(failures, [(never, 'broken')])
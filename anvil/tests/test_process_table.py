@@ -0,0 +1,64 @@
+import os
+import subprocess
+import time
+import unittest
+
+from anvil import process_table
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_self(self):
+        snapshot = process_table.Snapshot().refresh()
+        me = snapshot.get(os.getpid())
+        self.assertTrue(me is not None)
+        self.assertEquals(me.ppid, os.getppid())
+        self.assertEquals(me.cwd, os.getcwd())
+        self.assertTrue(me.rss > 0)
+        self.assertTrue(me.start_time <= time.time())
+        self.assertTrue(snapshot.is_running(os.getpid()))
+
+    def test_no_details(self):
+        snapshot = process_table.Snapshot(details=False).refresh()
+        me = snapshot.get(os.getpid())
+        self.assertEquals(me.cmdline, [])
+        self.assertEquals(me.cwd, None)
+        self.assertTrue(me.num_threads >= 1)
+        self.assertTrue(snapshot.open_fds(os.getpid()) > 0)
+
+    def test_started_later(self):
+        snapshot = process_table.Snapshot().refresh()
+        proc = subprocess.Popen(['sleep', '10'])
+        try:
+            # Not in the snapshot, but found anyway
+            info = snapshot.get(proc.pid)
+            self.assertTrue(info is not None)
+            self.assertEquals(info.cmdline, ['sleep', '10'])
+            self.assertEquals(info.name, 'sleep')
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def test_pid_reused(self):
+        snapshot = process_table.Snapshot().refresh()
+        me = snapshot.get(os.getpid())
+        self.assertTrue(snapshot.is_running(os.getpid(), start_ticks=me.start_ticks))
+        self.assertFalse(snapshot.is_reused(os.getpid(), me.start_ticks))
+        # Some other process that had this pid before...
+        self.assertFalse(snapshot.is_running(os.getpid(), start_ticks=me.start_ticks - 1))
+        self.assertTrue(snapshot.is_reused(os.getpid(), me.start_ticks - 1))
+        # Not known, so not reused
+        self.assertTrue(snapshot.is_running(os.getpid(), start_ticks=None))
+
+    def test_gone(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        snapshot = process_table.Snapshot().refresh()
+        self.assertFalse(snapshot.is_running(proc.pid))
+        self.assertFalse(snapshot.is_running('not-a-pid'))
+
+    def test_shared(self):
+        snapshot = process_table.get_snapshot()
+        taken = snapshot.taken
+        self.assertEquals(process_table.get_snapshot(max_age=60).taken, taken)
+        time.sleep(0.01)
+        self.assertNotEquals(process_table.get_snapshot(max_age=0).taken, taken)
@@ -0,0 +1,333 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from anvil import components as comp
+from anvil import exceptions as excp
+from anvil import probes
+from anvil import runners as base
+from anvil import shell as sh
+
+from anvil.components import nova
+
+# Shared by the stand-in runners so that the tests can see what happened
+STARTED = []
+STOPPED = []
+RESTARTED = []
+STARTED_LOCK = threading.Lock()
+PRIVILEGED = []
+PRIVILEGES = {'root': False}
+
+
+class StandInRunner(base.Runner):
+    def start(self, app_name, app_pth, app_dir, opts):
+        time.sleep(0.2)
+        if app_name.startswith('broken'):
+            raise RuntimeError("Can not start %s" % (app_name))
+        with STARTED_LOCK:
+            STARTED.append((app_name, time.time()))
+        return "%s.trace" % (app_name)
+
+    def stop(self, app_name):
+        time.sleep(0.2)
+        with STARTED_LOCK:
+            STOPPED.append(app_name)
+
+
+class RestartingRunner(StandInRunner):
+    def restart(self, app_name):
+        with STARTED_LOCK:
+            RESTARTED.append(app_name)
+        return True
+
+
+class PrivilegedRunner(StandInRunner):
+    # Records if it was ran with root privileges (as the stand-in privilege
+    # state says), like the real runners it switches to root itself for only
+    # what needs it
+    def start(self, app_name, app_pth, app_dir, opts):
+        with STARTED_LOCK:
+            PRIVILEGED.append(('start', app_name, PRIVILEGES['root']))
+        with sh.Rooted(True):
+            return StandInRunner.start(self, app_name, app_pth, app_dir, opts)
+
+    def stop(self, app_name):
+        with sh.Rooted(True):
+            if app_name.startswith('slow'):
+                time.sleep(0.4)
+            StandInRunner.stop(self, app_name)
+            with STARTED_LOCK:
+                PRIVILEGED.append(('stop', app_name, PRIVILEGES['root']))
+
+
+class StandInInstaller(object):
+    def __init__(self, cfg_dir, config_files):
+        self.cfg_dir = cfg_dir
+        self.config_files = config_files
+
+    def target_config(self, config_fn):
+        return os.path.join(self.cfg_dir, config_fn)
+
+    @property
+    def symlinks(self):
+        return {}
+
+
+class StandInRuntime(comp.PythonRuntime):
+    def __init__(self, tmp_dir, apps, ready=None, installer=None):
+        options = {
+            'trace_dir': tmp_dir,
+            'app_dir': tmp_dir,
+            'run_type': 'anvil.tests.test_runtime:StandInRunner',
+        }
+        siblings = {}
+        if installer is not None:
+            siblings['install'] = installer
+        comp.PythonRuntime.__init__(self, 'stand-in', {}, {}, options, siblings, None, {})
+        self.apps = apps
+        self.ready = ready or {}
+
+    @property
+    def apps_to_start(self):
+        return self.apps
+
+    def app_probes(self, app_name):
+        if app_name in self.ready:
+            return [probes.CallableProbe(app_name, self.ready[app_name])]
+        return []
+
+
+class TestPythonRuntime(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        del STARTED[:]
+        del STOPPED[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _traced(self, rt):
+        return [name for (name, _trace_fn, _how) in rt.tracereader.apps_started()]
+
+    def test_concurrent(self):
+        apps = [{'name': 'app%s' % (i)} for i in range(0, 6)]
+        rt = StandInRuntime(self.tmp_dir, apps)
+        start = time.time()
+        self.assertEquals(rt.start(), 6)
+        self.assertTrue(time.time() - start < 1.0)
+        # Traced in the order given (not the order they finished in)
+        self.assertEquals(self._traced(rt), [a['name'] for a in apps])
+
+    def test_groups(self):
+        started_at = {}
+
+        def api_ready():
+            with STARTED_LOCK:
+                for (name, when) in STARTED:
+                    started_at[name] = when
+            return ('api' in started_at, 'not started')
+
+        apps = [
+            {'name': 'scheduler', 'start_group': 1},
+            {'name': 'compute', 'start_group': 1},
+            {'name': 'api'},
+        ]
+        rt = StandInRuntime(self.tmp_dir, apps, ready={'api': api_ready})
+        self.assertEquals(rt.start(), 3)
+        started = dict(STARTED)
+        self.assertTrue(started['api'] < started['scheduler'])
+        self.assertTrue(started['api'] < started['compute'])
+        self.assertEquals(self._traced(rt), ['api', 'scheduler', 'compute'])
+
+    def test_failure_traced(self):
+        apps = [{'name': 'app1'}, {'name': 'broken'}, {'name': 'app2'}]
+        rt = StandInRuntime(self.tmp_dir, apps)
+        self.assertRaises(RuntimeError, rt.start)
+        # What did start can still be found (and stopped)
+        self.assertEquals(self._traced(rt), ['app1', 'app2'])
+
+    def test_concurrent_stop(self):
+        apps = [{'name': 'app%s' % (i)} for i in range(0, 6)]
+        rt = StandInRuntime(self.tmp_dir, apps)
+        rt.start()
+        start = time.time()
+        self.assertEquals(rt.stop(), 6)
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEquals(sorted(STOPPED), sorted([a['name'] for a in apps]))
+
+    def test_app_scheduling(self):
+        rt = StandInRuntime(self.tmp_dir, [{'name': 'api'}, {'name': 'compute'}])
+        rt.options['nice'] = 5
+        rt.options['ionice_class'] = None
+        rt.options['app_scheduling'] = {'compute': {'nice': 10, 'cpu_affinity': '1'}}
+        self.assertEquals(rt.app_scheduling('api'), {'nice': 5})
+        self.assertEquals(rt.app_scheduling('compute'), {'nice': 10, 'cpu_affinity': '1'})
+        rt.options['app_scheduling'] = {'compute': {'nice': 100}}
+        self.assertRaises(excp.ConfigException, rt.app_scheduling, 'compute')
+
+
+class TestPrivileges(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        del STOPPED[:]
+        del PRIVILEGED[:]
+        PRIVILEGES['root'] = False
+        # Privileges are not really switched (these tests may not be ran as
+        # root) but the switching is tracked the same way
+        self.switchers = (sh.got_root, sh.root_mode, sh.user_mode)
+        sh.got_root = lambda: PRIVILEGES['root']
+        sh.root_mode = lambda quiet=True: PRIVILEGES.update(root=True)
+        sh.user_mode = lambda quiet=True: PRIVILEGES.update(root=False)
+
+    def tearDown(self):
+        (sh.got_root, sh.root_mode, sh.user_mode) = self.switchers
+        shutil.rmtree(self.tmp_dir)
+
+    def _runtime(self, name, apps):
+        tmp_dir = os.path.join(self.tmp_dir, name)
+        os.mkdir(tmp_dir)
+        rt = StandInRuntime(tmp_dir, apps)
+        rt.options['run_type'] = 'anvil.tests.test_runtime:PrivilegedRunner'
+        return rt
+
+    def test_concurrent_runtimes(self):
+        fast = self._runtime('fast', [{'name': 'app'}])
+        slow = self._runtime('slow', [{'name': 'slow-app'}])
+        fast.start()
+        slow.start()
+        self.assertFalse(PRIVILEGES['root'])
+        del PRIVILEGED[:]
+        # The fast one (which switched to root first) finishing must not take
+        # root away from the slow one that is still stopping
+        threads = [threading.Thread(target=rt.stop) for rt in [fast, slow]]
+        for t in threads:
+            t.start()
+            time.sleep(0.05)
+        for t in threads:
+            t.join()
+        self.assertEquals(sorted(PRIVILEGED), [('stop', 'app', True), ('stop', 'slow-app', True)])
+        self.assertFalse(PRIVILEGES['root'])
+
+    def test_runtime_not_rooted(self):
+        # Only the runners (not the runtime, which writes traces into the
+        # users directories) switch to root
+        rt = self._runtime('rt', [{'name': 'api'}, {'name': 'compute', 'start_group': 1}])
+        rt.start()
+        self.assertEquals(sorted(PRIVILEGED), [('start', 'api', False), ('start', 'compute', False)])
+        self.assertFalse(PRIVILEGES['root'])
+
+    def test_nested(self):
+        with sh.Rooted(True):
+            with sh.Rooted(True):
+                self.assertTrue(PRIVILEGES['root'])
+            self.assertTrue(PRIVILEGES['root'])
+            with sh.Rooted(False):
+                self.assertTrue(PRIVILEGES['root'])
+        self.assertFalse(PRIVILEGES['root'])
+        # Already root (without switching) stays that way
+        PRIVILEGES['root'] = True
+        with sh.Rooted(True):
+            pass
+        self.assertTrue(PRIVILEGES['root'])
+
+
+class ConfigRuntime(nova.NovaRuntime):
+    # The real nova runtime (which only gives its apis the paste config) with
+    # its programs started by the stand-in runner
+    def __init__(self, tmp_dir, installer):
+        options = {
+            'trace_dir': tmp_dir,
+            'app_dir': tmp_dir,
+            'cfg_dir': tmp_dir,
+            'run_type': 'anvil.tests.test_runtime:StandInRunner',
+        }
+        subsystems = {
+            'api-os-compute': {},
+            'scheduler': {},
+        }
+        nova.NovaRuntime.__init__(self, 'nova', subsystems, {}, options, {'install': installer}, None, {})
+
+    def app_probes(self, app_name):
+        return []
+
+
+class TestConfigRestart(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        del STARTED[:]
+        del STOPPED[:]
+        del RESTARTED[:]
+        self.installer = StandInInstaller(self.tmp_dir, [nova.API_CONF, nova.PASTE_CONF])
+        for fn in self.installer.config_files:
+            self._write(fn, 'initial')
+        bin_dir = os.path.join(self.tmp_dir, nova.BIN_DIR)
+        os.mkdir(bin_dir)
+        for name in ['nova-api-os-compute', 'nova-scheduler']:
+            with open(os.path.join(bin_dir, name), 'wb') as fh:
+                fh.write("#!/bin/sh\n")
+            os.chmod(os.path.join(bin_dir, name), 0755)
+        self.rt = ConfigRuntime(self.tmp_dir, self.installer)
+        self.rt.start()
+        self.rt.record_config_digests()
+        del STARTED[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, fn, contents):
+        with open(self.installer.target_config(fn), 'wb') as fh:
+            fh.write(contents)
+
+    def _restarted(self):
+        return sorted([name for (name, _when) in STARTED])
+
+    def test_unchanged(self):
+        self.assertEquals(self.rt.restart_changed(), 0)
+        self.assertEquals(STOPPED, [])
+        self.assertEquals(STARTED, [])
+
+    def test_app_changed(self):
+        self._write(nova.PASTE_CONF, 'changed')
+        self.assertEquals(self.rt.changed_config_apps(), ['nova-api-os-compute'])
+        self.assertEquals(self.rt.restart_changed(), 1)
+        self.assertEquals(STOPPED, ['nova-api-os-compute'])
+        self.assertEquals(self._restarted(), ['nova-api-os-compute'])
+        # Recorded again, so nothing more to do
+        self.assertEquals(self.rt.restart_changed(), 0)
+
+    def test_shared_changed(self):
+        self._write(nova.API_CONF, 'changed')
+        self.assertEquals(self.rt.restart_changed(), 2)
+        self.assertEquals(sorted(STOPPED), ['nova-api-os-compute', 'nova-scheduler'])
+        self.assertEquals(self._restarted(), ['nova-api-os-compute', 'nova-scheduler'])
+
+    def test_runner_restarts(self):
+        # Runners that can restart apps themselves are asked to (instead of
+        # the apps being stopped and started again)
+        self.rt.stop()
+        del STOPPED[:]
+        rt = ConfigRuntime(self.tmp_dir, self.installer)
+        rt.options['run_type'] = 'anvil.tests.test_runtime:RestartingRunner'
+        rt.start()
+        rt.record_config_digests()
+        del STARTED[:]
+        self._write(nova.API_CONF, 'changed')
+        self.assertEquals(rt.restart_changed(), 2)
+        self.assertEquals(sorted(RESTARTED), ['nova-api-os-compute', 'nova-scheduler'])
+        self.assertEquals(STOPPED, [])
+        self.assertEquals(STARTED, [])
+
+    def test_nothing_recorded(self):
+        os.unlink(os.path.join(self.tmp_dir, comp.CONFIG_DIGESTS_FN))
+        self.assertEquals(self.rt.changed_config_apps(), ['nova-api-os-compute', 'nova-scheduler'])
+
+    def test_not_started(self):
+        self.rt.stop()
+        del STOPPED[:]
+        self._write(nova.API_CONF, 'changed')
+        rt = ConfigRuntime(self.tmp_dir, self.installer)
+        self.assertEquals(rt.restart_changed(), 0)
+        self.assertEquals(STOPPED, [])
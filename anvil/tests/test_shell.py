@@ -0,0 +1,236 @@
+import os
+import shutil
+import signal
+import StringIO
+import subprocess
+import tempfile
+import time
+import unittest
+
+from anvil import process_table
+from anvil import shell as sh
+
+BLOCK = sh.SPARSE_BLOCK_SIZE
+
+
+class TestSparse(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def _read(self, path):
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+    def _contents(self):
+        return ('a' * BLOCK) + ('\0' * BLOCK * 64) + ('b' * 10) + ('\0' * BLOCK * 64)
+
+    def test_pipe_sparse(self):
+        contents = self._contents()
+        with open(self._path('out'), 'wb') as ofh:
+            amount = sh.pipe_in_out(StringIO.StringIO(contents), ofh,
+                                    chunk_size=BLOCK * 3, sparse=True)
+        self.assertEquals(amount, len(contents))
+        self.assertEquals(self._read(self._path('out')), contents)
+        # Not all filesystems support holes, but most that we run on do...
+        st = os.stat(self._path('out'))
+        self.assertTrue(st.st_blocks * 512 <= st.st_size)
+
+    def test_trailing_hole(self):
+        with open(self._path('out'), 'wb') as ofh:
+            writer = sh.SparseWriter(ofh)
+            writer.write('x')
+            writer.write('\0' * BLOCK * 2)
+            writer.finish()
+        self.assertEquals(self._read(self._path('out')), 'x' + '\0' * BLOCK * 2)
+
+    def test_copy_sparse(self):
+        contents = self._contents()
+        with open(self._path('src'), 'wb') as fh:
+            fh.write(contents)
+        sh.copy_sparse(self._path('src'), self._path('dst'))
+        self.assertEquals(self._read(self._path('dst')), contents)
+
+    def test_data_extents(self):
+        with open(self._path('src'), 'wb') as fh:
+            writer = sh.SparseWriter(fh)
+            writer.write(self._contents())
+            writer.finish()
+        with open(self._path('src'), 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            extents = list(sh.data_extents(fh.fileno(), size))
+        self.assertTrue(extents)
+        # Whatever the extents are they must cover the data
+        covered = sum([length for (_offset, length) in extents])
+        self.assertTrue(covered >= BLOCK + 10)
+        self.assertTrue(covered <= size)
+
+
+class TestTail(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmp_dir, 'app.stdout')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_tail(self):
+        with open(self.fn, 'wb') as fh:
+            for i in range(0, 1000):
+                fh.write("line %s\n" % (i))
+        self.assertEquals(sh.tail_file(self.fn, 9), "line 999\n")
+        self.assertEquals(sh.tail_file(self.fn, 0), "")
+
+    def test_tail_small(self):
+        with open(self.fn, 'wb') as fh:
+            fh.write("small")
+        self.assertEquals(sh.tail_file(self.fn, 1024), "small")
+
+
+class TestRotatingOutput(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmp_dir, 'app.stdout')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _read(self, fn):
+        with open(fn, 'rb') as fh:
+            return fh.read()
+
+    def test_rotate_on_lines(self):
+        writer = sh.RotatingWriter(self.fn, 25, backups=2)
+        for i in range(0, 10):
+            writer.write("line %04d\n" % (i))
+        writer.close()
+        self.assertEquals(self._read(self.fn), "line 0008\nline 0009\n")
+        self.assertEquals(self._read(self.fn + '.1'), "line 0006\nline 0007\n")
+        self.assertEquals(self._read(self.fn + '.2'), "line 0004\nline 0005\n")
+        self.assertFalse(os.path.exists(self.fn + '.3'))
+
+    def test_long_line(self):
+        writer = sh.RotatingWriter(self.fn, 10, backups=1)
+        writer.write("x" * 15)
+        writer.close()
+        self.assertEquals(self._read(self.fn), "x" * 5)
+        self.assertEquals(self._read(self.fn + '.1'), "x" * 10)
+
+    def test_fork_capped(self):
+        pid_fn = os.path.join(self.tmp_dir, 'app.pid')
+        err_fn = os.path.join(self.tmp_dir, 'app.stderr')
+        script = "for i in $(seq 1 100); do echo \"line $i\"; echo \"error $i\" >&2; done"
+        sh.fork('sh', self.tmp_dir, pid_fn, self.fn, err_fn, '-c', script,
+                output_max_size=100, output_backups=2)
+        expected_end = "line 100\n"
+        for _i in range(0, 100):
+            if os.path.isfile(self.fn) and self._read(self.fn).endswith(expected_end):
+                break
+            time.sleep(0.05)
+        self.assertTrue(self._read(self.fn).endswith(expected_end))
+        for fn in [self.fn, err_fn]:
+            self.assertTrue(os.path.isfile(fn + '.2'))
+            self.assertFalse(os.path.exists(fn + '.3'))
+            for piece in [fn, fn + '.1', fn + '.2']:
+                self.assertTrue(os.path.getsize(piece) <= 100)
+
+
+def _default_signals():
+    # The shell ignores interrupts for background jobs (and so may whatever
+    # is running these tests) so make sure they are not ignored
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+class TestKill(unittest.TestCase):
+    def _spawn(self, script):
+        proc = subprocess.Popen(['sh', '-c', script], preexec_fn=_default_signals)
+        # Give the shell a moment to get going (and set up its traps)
+        time.sleep(0.1)
+        return proc
+
+    def test_prompt_exit(self):
+        proc = self._spawn('exec sleep 10')
+        start = time.time()
+        (killed, _attempts) = sh.kill(proc.pid)
+        self.assertTrue(killed)
+        self.assertTrue(time.time() - start < 0.5)
+        proc.wait()
+
+    def test_escalates(self):
+        proc = self._spawn("trap '' INT; sleep 10")
+        start = time.time()
+        (killed, _attempts) = sh.kill(proc.pid, timeout=0.4)
+        self.assertTrue(killed)
+        self.assertTrue(time.time() - start < 1.0)
+        proc.wait()
+
+    def test_group(self):
+        # The backgrounded sleep ignores interrupts so it will have to be
+        # killed (even after its parent has exited)
+        proc = self._spawn("sleep 10 & wait")
+        children = [p for p in process_table.get_snapshot(max_age=0).processes() if p.ppid == proc.pid]
+        self.assertEquals(len(children), 1)
+        (killed, _attempts) = sh.kill(proc.pid, timeout=0.4, group=True)
+        self.assertTrue(killed)
+        proc.wait()
+        info = process_table.read_process(children[0].pid)
+        self.assertTrue(info is None or info.is_zombie)
+
+
+class TestScheduling(unittest.TestCase):
+    def test_prefix(self):
+        self.assertEquals(sh.scheduling_prefix(None), [])
+        self.assertEquals(sh.scheduling_prefix({'nice': 0}), [])
+        scheduling = {
+            'cpu_affinity': [0, 2],
+            'ionice_class': 'best-effort',
+            'ionice_level': 7,
+            'nice': 10,
+        }
+        self.assertEquals(sh.scheduling_prefix(scheduling),
+                          ['taskset', '-c', '0,2', 'ionice', '-c', '2', '-n', '7', 'nice', '-n', '10'])
+        # The idle class has no levels
+        self.assertEquals(sh.scheduling_prefix({'ionice_class': 'idle', 'ionice_level': 3}),
+                          ['ionice', '-c', '3'])
+
+    def test_invalid(self):
+        for scheduling in [{'nice': 20}, {'nice': 'high'}, {'ionice_class': 'fast'},
+                           {'ionice_class': 2, 'ionice_level': 8}, {'cpu_affinity': 'all'}]:
+            self.assertRaises(ValueError, sh.scheduling_prefix, scheduling)
+
+    def test_execute(self):
+        scheduling = {
+            'cpu_affinity': '0',
+            'ionice_class': 'idle',
+            'nice': 5,
+        }
+        script = 'grep Cpus_allowed_list /proc/self/status; ionice -p $$; cut -d" " -f19 /proc/$$/stat'
+        (stdout, _stderr) = sh.execute('sh', '-c', script, scheduling=scheduling, run_as_root=True)
+        lines = stdout.splitlines()
+        self.assertEquals(lines[0].split()[-1], '0')
+        self.assertEquals(lines[1], 'idle')
+        self.assertEquals(int(lines[2]), min(19, os.nice(0) + 5))
+
+    def test_fork(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            pid_fn = os.path.join(tmp_dir, 'app.pid')
+            out_fn = os.path.join(tmp_dir, 'app.stdout')
+            sh.fork('sh', tmp_dir, pid_fn, out_fn, None, '-c', 'echo $$; cut -d" " -f19 /proc/$$/stat',
+                    scheduling={'nice': 3})
+            for _i in range(0, 100):
+                if os.path.isfile(pid_fn) and os.path.isfile(out_fn) and len(open(out_fn).read().splitlines()) == 2:
+                    break
+                time.sleep(0.05)
+            (pid, nice) = open(out_fn).read().split()
+            # Still the pid that was forked (the prefix exec's the program)
+            self.assertEquals(int(open(pid_fn).read()), int(pid))
+            self.assertEquals(int(nice), min(19, os.nice(0) + 3))
+        finally:
+            shutil.rmtree(tmp_dir)
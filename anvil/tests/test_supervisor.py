@@ -0,0 +1,98 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from anvil.runners import supervisor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _wait_until(functor, timeout=10):
+    start = time.time()
+    while time.time() - start < timeout:
+        result = functor()
+        if result:
+            return result
+        time.sleep(0.05)
+    return None
+
+
+def _count_in(fn, text):
+    # The output file is made by the program (after the supervisor answers)
+    if not os.path.exists(fn):
+        return 0
+    with open(fn, 'rb') as fh:
+        return fh.read().count(text)
+
+
+def _default_signals():
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sock = os.path.join(self.tmp_dir, 'supervisor.sock')
+        with open(os.devnull, 'wb') as null:
+            self.proc = subprocess.Popen([sys.executable, '-m', 'anvil.runners.supervisor',
+                                          '--restart-wait', '0.1', self.sock],
+                                         cwd=ROOT_DIR, stdout=null, stderr=null,
+                                         preexec_fn=_default_signals)
+        self.assertTrue(_wait_until(lambda: os.path.exists(self.sock)))
+
+    def tearDown(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _request(self, **kwargs):
+        return supervisor.request(self.sock, kwargs)
+
+    def _app(self, name):
+        return self._request(action='status', name=name)['apps'].get(name)
+
+    def test_restart_on_crash(self):
+        stdout_fn = os.path.join(self.tmp_dir, 'sleeper.stdout')
+        answer = self._request(action='start', name='sleeper', program='sh',
+                               args=['-c', 'echo started; exec sleep 30'],
+                               stdout=stdout_fn, app_dir=self.tmp_dir)
+        self.assertTrue(answer['ok'])
+        pid = answer['pid']
+        self.assertEquals(self._app('sleeper')['state'], supervisor.RUNNING)
+        self.assertTrue(_wait_until(lambda: _count_in(stdout_fn, "started") == 1))
+        os.kill(pid, signal.SIGKILL)
+
+        def restarted():
+            app = self._app('sleeper')
+            return app['state'] == supervisor.RUNNING and app['pid'] != pid and app
+        app = _wait_until(restarted)
+        self.assertTrue(app)
+        self.assertEquals(app['restarts'], 1)
+        self.assertTrue(_wait_until(lambda: _count_in(stdout_fn, "started") == 2))
+
+        answer = self._request(action='restart', name='sleeper')
+        self.assertTrue(answer['ok'])
+        self.assertNotEquals(answer['pid'], app['pid'])
+
+        answer = self._request(action='stop', name='sleeper')
+        self.assertTrue(answer['ok'])
+        self.assertEquals(self.proc.wait(), 0)
+        self.assertFalse(os.path.exists(self.sock))
+
+    def test_bad_requests(self):
+        answer = self._request(action='explode')
+        self.assertFalse(answer['ok'])
+        answer = self._request(action='restart', name='missing')
+        self.assertFalse(answer['ok'])
+        answer = self._request(action='stop', name='missing')
+        self.assertTrue(answer['ok'])
+
+    def test_unreachable(self):
+        self.assertRaises(IOError, supervisor.request, os.path.join(self.tmp_dir, 'missing.sock'),
+                          {'action': 'status'})
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose import SkipTest
+
+from anvil import exceptions as excp
+
+try:
+    from anvil.distros import rhel
+    from anvil.packaging import yum
+    from anvil.packaging.helpers import yum_helper
+    from yum.packages import PackageObject
+except ImportError:
+    # Only there on distros that use yum
+    yum = None
+
+# What the stand-in helper lists as installed (and how many times it did)
+INSTALLED = []
+LISTED = []
+
+
+def _make_pkg(name, version, release='1', arch='x86_64'):
+    pkg = PackageObject()
+    pkg.name = name
+    pkg.version = version
+    pkg.release = release
+    pkg.arch = arch
+    pkg.epoch = '0'
+    return pkg
+
+
+if yum is not None:
+    class StandInHelper(yum_helper.Helper):
+        def _list_installed(self):
+            # Instead of reading the real rpm database
+            LISTED.append(True)
+            installed = {}
+            for p in INSTALLED:
+                installed.setdefault(p.name.lower(), []).append(p)
+            return installed
+
+
+class TestHelper(unittest.TestCase):
+    def setUp(self):
+        if yum is None:
+            raise SkipTest("yum is not available")
+        self.tmp_dir = tempfile.mkdtemp()
+        del INSTALLED[:]
+        del LISTED[:]
+        INSTALLED.append(_make_pkg('Foo', '1.0'))
+        INSTALLED.append(_make_pkg('foo-devel', '1.0'))
+        INSTALLED.append(_make_pkg('bar', '2.0', arch='noarch'))
+        self.helper = StandInHelper()
+        self.helper.uncache()
+        self.yum_cmd = list(yum.YUM_CMD)
+
+    def tearDown(self):
+        yum.YUM_CMD[:] = self.yum_cmd
+        self.helper.uncache()
+        shutil.rmtree(self.tmp_dir)
+
+    def _names(self, name):
+        return sorted([p.name for p in self.helper.get_installed(name)])
+
+    def test_index(self):
+        self.assertEquals(self._names('foo'), ['Foo'])
+        self.assertTrue(self.helper.is_installed('BAR'))
+        self.assertFalse(self.helper.is_installed('baz'))
+        # Read once (and then looked up) until uncached
+        self.assertEquals(len(LISTED), 1)
+        self.helper.uncache()
+        self.assertTrue(self.helper.is_installed('foo'))
+        self.assertEquals(len(LISTED), 2)
+
+    def test_patterns(self):
+        self.assertEquals(self._names('foo.x86_64'), ['Foo'])
+        self.assertEquals(self._names('foo-devel-1.0'), ['foo-devel'])
+        self.assertEquals(self._names('foo-1.0-1.x86_64'), ['Foo'])
+        self.assertEquals(self._names('foo*'), ['Foo', 'foo-devel'])
+        self.assertEquals(self._names('*.noarch'), ['bar'])
+        self.assertEquals(self._names('foo-2.0'), [])
+        self.assertEquals(self._names('baz*'), [])
+
+    def _packager(self, cls):
+        packager = cls(None)
+        packager.helper = self.helper
+        return packager
+
+    def test_uncached_after_yum(self):
+        packager = self._packager(yum.YumPackager)
+        self.assertTrue(self.helper.is_installed('foo'))
+        yum.YUM_CMD[:] = ['true']
+        packager._execute_yum(['install', 'baz'])
+        self.assertTrue(self.helper.is_installed('foo'))
+        self.assertEquals(len(LISTED), 2)
+        # Even when yum fails (it may have changed something anyway)
+        yum.YUM_CMD[:] = ['false']
+        self.assertRaises(excp.ProcessExecutionError, packager._execute_yum, ['install', 'baz'])
+        self.assertTrue(self.helper.is_installed('foo'))
+        self.assertEquals(len(LISTED), 3)
+
+    def test_relinks(self):
+        packager = self._packager(rhel.YumPackagerWithRelinks)
+        source = os.path.join(self.tmp_dir, 'source-1.0')
+        target = os.path.join(self.tmp_dir, 'target')
+        with open(source, 'wb') as fh:
+            fh.write("blah")
+        links = [{'source': os.path.join(self.tmp_dir, 'source-*'), 'target': target}]
+        pkg = {'name': 'foo', 'packager_options': {'links': links}}
+        packager._installed(pkg)
+        self.assertEquals(os.readlink(target), source)
+        # Already there, so left alone
+        packager._installed(pkg)
+        self.assertEquals(os.readlink(target), source)
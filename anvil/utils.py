@@ -18,12 +18,13 @@
 #    under the License.
 
 import contextlib
+import httplib
 import os
 import random
 import re
 import socket
 import tempfile
-import urllib2
+import time
 
 try:
     # Only in python 2.7+
@@ -42,6 +43,7 @@ import yaml
 from Cheetah.Template import Template
 
 from anvil import colorizer
+from anvil import http_pool
 from anvil import log as logging
 from anvil import pprint
 from anvil import settings
@@ -355,37 +357,41 @@ def has_any(text, *look_for):
     return False
 
 
-def wait_for_url(url, max_attempts=3, wait_between=5):
-    excps = []
-    LOG.info("Waiting for url %s to become active (max_attempts=%s, seconds_between=%s)",
-             colorizer.quote(url), max_attempts, wait_between)
+def backoff_delays(initial=0.1, maximum=5.0, factor=2.0, jitter=0.25):
+    # Produces an endless sequence of exponentially increasing (and
+    # jittered, so that many waiters do not act in lockstep) delays.
+    delay = max(0.0, float(initial))
+    while True:
+        yield max(0.0, delay * random.uniform(1.0 - jitter, 1.0 + jitter))
+        delay = min(float(maximum), delay * factor)
 
-    def waiter():
-        LOG.info("Sleeping for %s seconds, %s is still not active.", wait_between, colorizer.quote(url))
-        sh.sleep(wait_between)
 
-    def success(attempts):
-        LOG.info("Url %s became active after %s attempts!", colorizer.quote(url), attempts)
-
-    for i in range(0, max_attempts):
+def wait_for_url(url, timeout=30, max_wait=5, initial_wait=0.1):
+    LOG.info("Waiting for url %s to become active (timeout=%s seconds)",
+             colorizer.quote(url), timeout)
+    if sh.is_dry_run():
+        return
+    pool = http_pool.get_pool()
+    start_time = time.time()
+    attempts = 0
+    for delay in backoff_delays(initial_wait, max_wait):
+        attempts += 1
         try:
-            with contextlib.closing(urllib2.urlopen(urllib2.Request(url))) as req:
-                req.read()
-                success(i + 1)
-                return
-        except urllib2.HTTPError as e:
-            if e.code in xrange(200, 499) or e.code in [501]:
+            code = pool.probe(url)
+            if code in xrange(200, 499) or code in [501]:
                 # Should be ok, at least its responding...
-                success(i + 1)
+                LOG.info("Url %s became active after %s attempts (%.03f seconds)!",
+                         colorizer.quote(url), attempts, time.time() - start_time)
                 return
-            else:
-                excps.append(e)
-                waiter()
-        except IOError as e:
-            excps.append(e)
-            waiter()
-    if excps:
-        raise excps[-1]
+            err = IOError("Url %s responded with code %s" % (url, code))
+        except (IOError, httplib.HTTPException) as e:
+            err = e
+        remaining = timeout - (time.time() - start_time)
+        if remaining <= 0:
+            raise err
+        delay = min(delay, remaining)
+        LOG.debug("Sleeping for %.03f seconds, %s is still not active: %s", delay, url, err)
+        sh.sleep(delay)
 
 
 def add_header(fn, contents, adjusted=True):
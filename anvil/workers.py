@@ -0,0 +1,120 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import Queue
+import sys
+import threading
+
+from anvil import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# Placed on the work queue to tell a worker thread to exit
+_STOP = object()
+
+
+class Job(object):
+    def __init__(self, functor, args, kwargs):
+        self.functor = functor
+        self.args = args
+        self.kwargs = kwargs
+        self.exc_info = None
+        self._result = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self._result = self.functor(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self._done.set()
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.done()
+
+    def result(self):
+        self._done.wait()
+        if self.exc_info:
+            # Re-raise with the original traceback (so that its useful)
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self._result
+
+
+class WorkerPool(object):
+    """
+    A bounded set of threads that run submitted jobs (in submission order).
+
+    Threads are only created as jobs are submitted (up to the maximum).
+    """
+
+    def __init__(self, max_workers, name='worker'):
+        self.max_workers = max(1, int(max_workers))
+        self.name = name
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                break
+            job.run()
+
+    def submit(self, functor, *args, **kwargs):
+        job = Job(functor, args, kwargs)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Can not submit work to a closed pool")
+            self._queue.put(job)
+            if len(self._threads) < self.max_workers:
+                thread_name = "%s-%s" % (self.name, len(self._threads) + 1)
+                t = threading.Thread(target=self._work, name=thread_name)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        return job
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for _t in self._threads:
+                self._queue.put(_STOP)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+
+
+def wait_all(jobs):
+    # Waits for all the jobs to finish and then returns there results (in
+    # the order given); the first failure found (if any) is re-raised but
+    # only after all the others have finished so that nothing is left running.
+    for j in jobs:
+        j.wait()
+    return [j.result() for j in jobs]
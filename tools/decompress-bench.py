@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""Compare the throughput of the image archive decompressors.
+
+Generates gzip and bzip2 compressed image archives and then times how long
+reading every image out of them takes with each of the decompressors that
+the glance helper supports.
+"""
+
+from optparse import OptionParser
+
+import contextlib
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+
+if os.path.exists(os.path.join(possible_topdir,
+                               'anvil',
+                               '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+
+from anvil import log as logging
+from anvil.components.helpers import glance
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def make_image(path, size):
+    # Somewhat image like, runs of zeros mixed with (compressible) junk
+    words = ['kernel', 'module', 'init', 'root', 'boot', 'lib', 'usr', 'etc']
+    with open(path, 'wb') as fh:
+        written = 0
+        while written < size:
+            if random.random() < 0.5:
+                data = '\0' * CHUNK_SIZE
+            else:
+                data = " ".join([random.choice(words) for _i in xrange(0, CHUNK_SIZE / 4)])
+            data = data[0:min(CHUNK_SIZE, size - written)]
+            fh.write(data)
+            written += len(data)
+
+
+def make_archive(work_dir, size, compression):
+    img_fn = os.path.join(work_dir, 'bench.img')
+    if not os.path.isfile(img_fn):
+        make_image(img_fn, size)
+    arc_fn = os.path.join(work_dir, 'bench.tar.%s' % (compression))
+    with contextlib.closing(tarfile.open(arc_fn, 'w:%s' % (compression))) as tfh:
+        tfh.add(img_fn, arcname='bench/bench.img')
+    return arc_fn
+
+
+def read_all(unpacker, arc_fn):
+    amount = 0
+    for (_kind, _member, mfh) in unpacker.iter_tar(arc_fn):
+        with contextlib.closing(mfh):
+            while True:
+                data = mfh.read(CHUNK_SIZE)
+                if not data:
+                    break
+                amount += len(data)
+    return amount
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-s", '--size', dest='size', type='int', default=256,
+                      help='size (in megabytes) of the generated image (default: %default)', metavar='MB')
+    parser.add_option("-r", '--repeat', dest='repeat', type='int', default=3,
+                      help='how many times to time each decompressor (default: %default)', metavar='N')
+    (options, args) = parser.parse_args()
+    logging.setupLogging(logging.WARNING)
+    work_dir = tempfile.mkdtemp()
+    try:
+        for compression in ['gz', 'bz2']:
+            arc_fn = make_archive(work_dir, options.size * 1024 * 1024, compression)
+            for decompressor in glance.DECOMPRESS_TYPES:
+                unpacker = glance.Unpacker(decompressor)
+                using = unpacker._find_decompressor(arc_fn) or ['tarfile']
+                best = None
+                for _i in range(0, options.repeat):
+                    start = time.time()
+                    amount = read_all(unpacker, arc_fn)
+                    taken = max(time.time() - start, 0.001)
+                    if best is None or taken < best:
+                        best = taken
+                print("%s: %s (%s) read %s bytes in %.03f seconds (%.02f MB/s)"
+                      % (os.path.basename(arc_fn), decompressor, os.path.basename(using[0]),
+                         amount, best, amount / best / (1024 * 1024)))
+    finally:
+        shutil.rmtree(work_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,6 +18,7 @@ if os.path.exists(os.path.join(possible_topdir,
 
 from anvil import log as logging
 from anvil.components.helpers import glance
+from anvil.components.helpers import keystone
 
 from anvil import passwords
 
@@ -44,17 +45,34 @@ def main():
                       help='keystone endpoint uri to authenticate with', metavar='KEYSTONE')
     parser.add_option('-i', '--image', dest='images',
                       action='append', help="image archive file or uri to upload to glance")
+    parser.add_option("-p", '--parallel', dest='parallel', type='int', default=1,
+                      help="how many images to download+extract+upload at the same time (default: %default)",
+                      metavar='N')
+    parser.add_option("-s", '--stream', dest='stream', action='store_true', default=False,
+                      help="upload archive members as they are decompressed (instead of extracting them first)")
     (options, args) = parser.parse_args()
     # Why can't i iterate over this, sad...
     if (not options.user or not options.tenant or not options.glance_uri
         or not options.keystone_uri or not options.images):
         parser.error("options are missing, please try -h")
+    if options.parallel < 1:
+        parser.error("parallel must be at least 1")
     logging.setupLogging(logging.DEBUG)
+    token_cache = keystone.TokenCache()
+    passwords_read = {}
+
+    def read_password():
+        # Only asked for when a new token is needed (no usable cached token
+        # or the cached one was rejected), and then only once
+        if 'password' not in passwords_read:
+            passwords_read['password'] = get_password(options.user)
+        return passwords_read['password']
+
     params = {
         'keystone': {
             'admin_tenant': options.tenant,
             'admin_user': options.user,
-            'admin_password': get_password(options.user),
+            'admin_password': read_password,
             'endpoints': {
                 'public': {
                     'uri': options.keystone_uri,
@@ -70,7 +88,10 @@ def main():
         },
     }
     img_am = len(options.images)
-    uploader = glance.UploadService(**params)
+    uploader = glance.UploadService(parallel=options.parallel,
+                                    stream_upload=options.stream,
+                                    token_cache=token_cache,
+                                    **params)
     am_installed = uploader.install(options.images)
     if img_am == am_installed:
         return 0